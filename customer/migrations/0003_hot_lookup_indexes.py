@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notifications',
+            index=models.Index(fields=['user', 'seen'], name='customer_no_user_id_49549f_idx'),
+        ),
+    ]
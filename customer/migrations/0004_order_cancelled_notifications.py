@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0003_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notifications',
+            name='type',
+            field=models.CharField(choices=[('New Order', 'New Order'), ('Item Shipped', 'Item Shipped'), ('Item Delivered', 'Item Delivered'), ('Order Cancelled', 'Order Cancelled')], default=None, max_length=100),
+        ),
+    ]
@@ -8,6 +8,7 @@ TYPE = (
     ("New Order", "New Order"),
     ("Item Shipped", "Item Shipped"),
     ("Item Delivered", "Item Delivered"),
+    ("Order Cancelled", "Order Cancelled"),
 )
 
 class Wishlist(models.Model):
@@ -50,6 +51,9 @@ class Notifications(models.Model):
     
     class Meta:
         verbose_name_plural = "Notification"
+        indexes = [
+            models.Index(fields=['user', 'seen']), # unseen notifications of a user
+        ]
     
     def __str__(self):
         return self.type
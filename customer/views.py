@@ -30,7 +30,7 @@ def dashboard(request):
 @login_required
 def orders(request):
     orders = store_models.Order.objects.filter(customer=request.user)
-    orders = paginate_queryset(request, orders, 6)
+    orders = paginate_queryset(request, orders, 6, keyset=True)
 
     context = {
         "orders": orders,
@@ -108,7 +108,7 @@ def add_to_wishlist(request, id):
 def notis(request):
     # get me all the notifications that belongs to this user and only the unseen ones
     notis_list = customer_models.Notifications.objects.filter(user=request.user, seen=False) 
-    notis = paginate_queryset(request, notis_list, 10)
+    notis = paginate_queryset(request, notis_list, 10, keyset=True)
 
     context = {
         "notis": notis,
@@ -97,6 +97,40 @@ DATABASES = {
 }
 
 
+# Cache
+# Set REDIS_URL to share the cache (categories, cart counts etc) between workers, otherwise each process keeps its own
+REDIS_URL = env("REDIS_URL", None)
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Cached pages that are invalidated when rows change (product detail, categories - store/cache.py) are only kept
+# when every worker sees the same cache: a per-process cache can only be invalidated in the worker that saved the row
+STORE_SHARED_CACHE = env.bool("STORE_SHARED_CACHE", bool(REDIS_URL))
+# Carts live in the shared cache when there is one and are persisted at checkout / by `manage.py flush_carts`
+# (store/cart.py), a per-process LocMem cache can't hold them so they stay in the Cart table
+STORE_CART_BACKEND = env("STORE_CART_BACKEND", "store.cart.CacheCartStore" if REDIS_URL else "store.cart.DatabaseCartStore")
+# Carts untouched for this many days are deleted by `manage.py purge_carts`
+STORE_CART_TTL_DAYS = env.int("STORE_CART_TTL_DAYS", 30)
+# Stock taken by an unpaid order is given back after this many minutes (`manage.py release_stock_holds`)
+STORE_STOCK_HOLD_MINUTES = env.int("STORE_STOCK_HOLD_MINUTES", 30)
+# Order, item and payout ids are reserved from the database this many at a time per worker thread (store/ids.py)
+STORE_ID_BLOCK_SIZE = env.int("STORE_ID_BLOCK_SIZE", 100)
+# A payment event still failing after this many tries is left for a person to look at (`manage.py process_payment_events`)
+STORE_PAYMENT_EVENT_MAX_ATTEMPTS = env.int("STORE_PAYMENT_EVENT_MAX_ATTEMPTS", 5)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -185,6 +219,33 @@ PAYSTACK_PRIVATE_KEY = env("PAYSTACK_PRIVATE_KEY")
 FLUTTERWAVE_PUBLIC_KEY=env("FLUTTERWAVE_PUBLIC_KEY")
 FLUTTERWAVE_PRIVATE_KEY=env("FLUTTERWAVE_PRIVATE_KEY")
 
+# Outgoing calls to the payment gateways (plugin/http_client.py)
+GATEWAY_HTTP_CONNECT_TIMEOUT = env.float("GATEWAY_HTTP_CONNECT_TIMEOUT", 3.05) # seconds
+GATEWAY_HTTP_READ_TIMEOUT = env.float("GATEWAY_HTTP_READ_TIMEOUT", 10)
+GATEWAY_HTTP_RETRIES = env.int("GATEWAY_HTTP_RETRIES", 2)
+GATEWAY_HTTP_BACKOFF = env.float("GATEWAY_HTTP_BACKOFF", 0.5) # seconds, doubled on every retry (with jitter)
+GATEWAY_CIRCUIT_FAILURES = env.int("GATEWAY_CIRCUIT_FAILURES", 5)
+GATEWAY_CIRCUIT_RESET_SECONDS = env.int("GATEWAY_CIRCUIT_RESET_SECONDS", 30)
+
+# Exchange rates are refreshed in the background once they are older than this many seconds (plugin/exchange_rate.py)
+EXCHANGE_RATE_TTL = env.int("EXCHANGE_RATE_TTL", 60 * 60)
+# The model whose manager keeps the last rates fetched (save_snapshot / load_snapshot), as "app_label.Model"
+EXCHANGE_RATE_SNAPSHOT_MODEL = env("EXCHANGE_RATE_SNAPSHOT_MODEL", "store.ExchangeRate")
+
+# Webhook secrets (store/gateways.py) - Paystack signs its webhooks with PAYSTACK_PRIVATE_KEY
+STRIPE_WEBHOOK_SECRET = env("STRIPE_WEBHOOK_SECRET", "")
+PAYPAL_WEBHOOK_ID = env("PAYPAL_WEBHOOK_ID", "")
+FLUTTERWAVE_SECRET_HASH = env("FLUTTERWAVE_SECRET_HASH", "")
+
+# Load testing (`manage.py benchmark_checkout`) - every gateway is replaced by the fake gateway (plugin/fake_gateway.py),
+# payments are never charged and every order can be "paid": never turn it on in production
+STORE_FAKE_GATEWAY = env.bool("STORE_FAKE_GATEWAY", False)
+# The fake gateway runs inside each process unless this points at one started with `manage.py fake_gateway`
+FAKE_GATEWAY_URL = env("FAKE_GATEWAY_URL", "")
+FAKE_GATEWAY_LATENCY_MS = env.int("FAKE_GATEWAY_LATENCY_MS", 100) # average time the fake gateway takes per call
+FAKE_GATEWAY_FAILURE_RATE = env.float("FAKE_GATEWAY_FAILURE_RATE", 0.0) # share of the calls answered with a 503
+FAKE_GATEWAY_DECLINE_RATE = env.float("FAKE_GATEWAY_DECLINE_RATE", 0.0) # share of the payments declined
+
 
 
 # GRAPH_MODELS ={
@@ -1,26 +1,142 @@
+import threading
+import time
 from decimal import Decimal
+
 import requests
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+from plugin import http_client
+
+# Exchange rates (USD -> every currency the API knows)
+# Nothing is fetched at import time. The rates live in the shared cache with the time they were fetched:
+# - older than EXCHANGE_RATE_TTL -> still served, and one background thread (single-flight across workers
+#   through a cache.add() lock) fetches fresh rates
+# - not in the cache -> loaded from the last snapshot saved in the database (settings.EXCHANGE_RATE_SNAPSHOT_MODEL,
+#   store.ExchangeRate), so a restart or an unreachable API never leaves checkout without rates
+# - no snapshot either (a brand new database) -> the only time a request waits for the API: one request fetches
+#   under the same lock, the others wait for its rates
+# RatesUnavailable is raised when there is no rate at all for a currency.
+
+RATES_URL = 'https://api.exchangerate-api.com/v4/latest/USD'
+RATES_KEY = "exchange_rates"
+REFRESH_LOCK_KEY = "exchange_rates:refresh"
+REFRESH_LOCK_TIMEOUT = 60
+FIRST_LOAD_POLL = 0.1
+
+
+class RatesUnavailable(Exception):
+    pass
+
 
 def fetch_exchange_rates(): # Fetch exchange rates from an external API
-    response = requests.get('https://api.exchangerate-api.com/v4/latest/USD')
-    data = response.json() # Parse the JSON response to get the exchange rates
-    return {
-        'INR': Decimal(data['rates']['INR']),
-        'NGN': Decimal(data['rates']['NGN'])
-    }
+    try:
+        response = http_client.client("ExchangeRate").get(RATES_URL)
+        response.raise_for_status()
+        data = response.json() # Parse the JSON response to get the exchange rates
+    except (requests.RequestException, ValueError) as e:
+        raise RatesUnavailable(str(e))
+    return {currency: Decimal(str(rate)) for currency, rate in data['rates'].items()}
+
+
+def cache_rates(rates, fetched):
+    # -> no timeout: old rates beat no rates, the next refresh replaces them
+    cache.set(RATES_KEY, {"rates": rates, "fetched": fetched}, None)
+
+
+def snapshots():
+    return apps.get_model(settings.EXCHANGE_RATE_SNAPSHOT_MODEL).objects
+
+
+def save_snapshot(rates, now):
+    snapshots().save_snapshot(rates, now)
+
+
+def load_snapshot():
+    return snapshots().load_snapshot()
+
+
+# Returns the new rates, or None when another thread or worker is already refreshing
+def refresh():
+    if not cache.add(REFRESH_LOCK_KEY, True, REFRESH_LOCK_TIMEOUT):
+        return None
+
+    try:
+        rates = fetch_exchange_rates()
+        now = timezone.now()
+        save_snapshot(rates, now)
+        cache_rates(rates, now.timestamp())
+        return rates
+    finally:
+        cache.delete(REFRESH_LOCK_KEY)
+
+
+# No rates anywhere yet -> one request fetches them, the others wait for its result instead of all asking the API
+def first_load():
+    rates = refresh()
+    if rates is not None:
+        return rates
+
+    deadline = time.monotonic() + REFRESH_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(FIRST_LOAD_POLL)
+        cached = cache.get(RATES_KEY)
+        if cached is None and cache.get(REFRESH_LOCK_KEY) is None:
+            cached = cache.get(RATES_KEY) # -> the fetch may have finished between the two reads
+            if cached is None:
+                raise RatesUnavailable("Fetching the exchange rates failed")
+        if cached is not None:
+            return cached["rates"]
+    raise RatesUnavailable("Timed out waiting for the exchange rates")
+
+
+def refresh_in_background():
+    def run():
+        try:
+            refresh()
+        except RatesUnavailable:
+            pass # -> the current rates stay, the next stale read tries again
+        finally:
+            connection.close() # -> the thread's own database connection
+
+    if cache.get(REFRESH_LOCK_KEY) is None:
+        threading.Thread(target=run, daemon=True).start()
+
+
+def get_rates():
+    cached = cache.get(RATES_KEY)
+    if cached is None:
+        snapshot = load_snapshot()
+        if snapshot is None:
+            return first_load() # -> first use ever, nothing to fall back on
+        cache_rates(*snapshot)
+        cached = {"rates": snapshot[0], "fetched": snapshot[1]}
+
+    if time.time() - cached["fetched"] > settings.EXCHANGE_RATE_TTL:
+        refresh_in_background()
+    return cached["rates"]
+
+
+def get_rate(currency):
+    rate = get_rates().get(currency)
+    if rate is None:
+        raise RatesUnavailable(f"No exchange rate for {currency}")
+    return rate
 
-exchange_rates = fetch_exchange_rates() # Fetch exchange rates once at module load time
 
 def get_usd_to_inr_rate():
-    return exchange_rates['INR']
+    return get_rate('INR')
 
 def get_usd_to_ngn_rate():
-    return exchange_rates['NGN']
+    return get_rate('NGN')
 
 
 def convert_usd_to_inr(usd_amount):
     inr_rate = get_usd_to_inr_rate()
-    return usd_amount * inr_rate 
+    return usd_amount * inr_rate
 
 def convert_usd_to_kobo(usd_amount):
     ngn_rate = get_usd_to_ngn_rate()
@@ -30,4 +146,3 @@ def convert_usd_to_kobo(usd_amount):
 def convert_usd_to_ngn(usd_amount):
     ngn_rate = get_usd_to_ngn_rate()
     return usd_amount * ngn_rate
-
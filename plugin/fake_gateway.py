@@ -0,0 +1,127 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+from django.conf import settings
+
+# Fake payment gateway, for load testing checkout without a network (store/gateways.py -> FakeGateway)
+# A small HTTP server with a hosted-payment flow like the real gateways:
+# - POST /sessions                -> a new open session {"id", "status", "url"}, url is its payment page
+# - GET  /pay/<id>                -> the customer pays: the session becomes paid (declined for FAKE_GATEWAY_DECLINE_RATE
+#                                    of them) and the page redirects to the session's return_url with ?reference=<id>
+# - GET  /sessions/<id>           -> the session and its status (open / paid / declined / refunded)
+# - POST /sessions/<id>/refund    -> a paid session becomes refunded
+# Every call waits FAKE_GATEWAY_LATENCY_MS (+-50%) and FAKE_GATEWAY_FAILURE_RATE of the calls are turned away with a
+# 503, before anything is done - the retries and the circuit breaker of plugin/http_client.py get exercised too.
+#
+# url() starts the server in-process on first use, unless FAKE_GATEWAY_URL points at one already running
+# (`manage.py fake_gateway`, shared by several web / worker processes). Sessions only live in memory.
+
+
+class FakeGatewayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms, failure_rate, decline_rate):
+        super().__init__(address, FakeGatewayHandler)
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.decline_rate = decline_rate
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class FakeGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # -> keep-alive, the pooled connections are reused as with a real gateway
+
+    def do_GET(self):
+        self.answer("GET")
+
+    def do_POST(self):
+        self.answer("POST")
+
+    def log_message(self, format, *args):
+        pass # -> no line on stderr per call
+
+    def answer(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+
+        time.sleep(random.uniform(0.5, 1.5) * server.latency_ms / 1000)
+        if random.random() < server.failure_rate:
+            return self.reply(503, {"error": "Service unavailable"})
+
+        path = self.path.split("?")[0].strip("/").split("/")
+        with server.lock:
+            if method == "POST" and path == ["sessions"]:
+                session_id = f"fake_{uuid.uuid4().hex}"
+                server.sessions[session_id] = {"id": session_id, "status": "open", "amount": body.get("amount"),
+                                               "order_id": body.get("order_id"), "return_url": body.get("return_url", "")}
+                return self.reply(200, {"id": session_id, "status": "open", "url": f"{server.url}/pay/{session_id}"})
+
+            session = server.sessions.get(path[1]) if len(path) > 1 else None
+            if session is None:
+                return self.reply(404, {"error": "No such session"})
+
+            if method == "GET" and path[0] == "pay":
+                if session["status"] == "open":
+                    session["status"] = "declined" if random.random() < server.decline_rate else "paid"
+                separator = "&" if "?" in session["return_url"] else "?"
+                return self.reply(302, {}, location=session["return_url"] + separator + urlencode({"reference": session["id"]}))
+
+            if method == "GET" and path[0] == "sessions" and len(path) == 2:
+                return self.reply(200, session)
+
+            if method == "POST" and path[0] == "sessions" and path[2:] == ["refund"]:
+                if session["status"] != "paid":
+                    return self.reply(409, {"error": f"A {session['status']} session can't be refunded"})
+                session["status"] = "refunded"
+                return self.reply(200, session)
+
+        self.reply(404, {"error": "Not found"})
+
+    def reply(self, status, data, location=None):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if location:
+            self.send_header("Location", location)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+# Starts the in-process server (once) - a running one just takes the new latency / failure / decline rates
+def start(latency_ms=None, failure_rate=None, decline_rate=None, host="127.0.0.1", port=0):
+    global _server
+
+    with _server_lock:
+        if _server is None:
+            _server = FakeGatewayServer((host, port), settings.FAKE_GATEWAY_LATENCY_MS, settings.FAKE_GATEWAY_FAILURE_RATE,
+                                        settings.FAKE_GATEWAY_DECLINE_RATE)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+
+        if latency_ms is not None:
+            _server.latency_ms = latency_ms
+        if failure_rate is not None:
+            _server.failure_rate = failure_rate
+        if decline_rate is not None:
+            _server.decline_rate = decline_rate
+        return _server
+
+
+def url():
+    return settings.FAKE_GATEWAY_URL or start().url
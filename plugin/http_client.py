@@ -0,0 +1,213 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Shared HTTP client for the payment gateways
+# client(name) returns one HttpClient per gateway for the whole process:
+# - a requests.Session, so connections are pooled per host and kept alive between calls (no new TCP + TLS
+#   handshake per verification)
+# - connect / read timeouts on every call, a gateway can never hang a worker
+# - bounded retries with exponential backoff and full jitter, for connection errors and 429 / 502 / 503 / 504 -
+#   a POST is only retried when the gateway never processed it (connect error, 429 / 503), other methods are safe to repeat
+# - a circuit breaker: after GATEWAY_CIRCUIT_FAILURES failed calls in a row the gateway is not called for
+#   GATEWAY_CIRCUIT_RESET_SECONDS, then a single trial call decides whether it is back - a call is counted once
+#   whatever the number of retries it took
+# - latency metrics per gateway (stats()) for every attempt, each is also logged at DEBUG level
+# SDK calls (Stripe) go through HttpClient.call, which applies the breaker and the metrics around them.
+
+RETRY_STATUSES = (429, 502, 503, 504)
+REJECTED_STATUSES = (429, 503) # -> the gateway turned the request away unprocessed, a POST can be retried on these only
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class CircuitOpen(requests.RequestException):
+    pass # -> raised instead of calling a gateway that keeps failing
+
+
+class CircuitBreaker:
+    def __init__(self, failures, reset_seconds):
+        self.max_failures = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    # closed -> every call goes through; open -> none until reset_seconds passed; then one trial call at a time
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.reset_seconds:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures, self.opened, self.trial = 0, None, False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened is not None or self.failures >= self.max_failures:
+                self.opened = time.monotonic() # -> (re)open, the failed trial call starts a new wait
+
+
+class Metrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, elapsed_ms, ok):
+        with self.lock:
+            self.calls += 1
+            self.errors += 0 if ok else 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "avg_ms": round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+                "max_ms": round(self.max_ms, 1),
+            }
+
+
+class HttpClient:
+    def __init__(self, name, timeout, retries, backoff, breaker, pool_size=10):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.metrics = Metrics()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size) # -> one pool per host, pool_size connections each
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        method = method.upper()
+        retry_statuses = RETRY_STATUSES if method in SAFE_METHODS else REJECTED_STATUSES
+
+        with self.breaker_call() as outcome:
+            for attempt in range(self.retries + 1):
+                last_attempt = attempt == self.retries
+                try:
+                    response = self.attempt(self.session.request, method, url, **kwargs)
+                except requests.ConnectionError as e:
+                    if last_attempt or (method not in SAFE_METHODS and not never_sent(e)):
+                        raise
+                except requests.Timeout:
+                    if last_attempt or method not in SAFE_METHODS: # -> a POST that timed out reading may have been processed
+                        raise
+                else:
+                    if response.status_code not in retry_statuses or last_attempt:
+                        outcome["ok"] = response.status_code < 500
+                        return response
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt)) # -> full jitter, retries don't arrive in waves
+
+    # Runs one SDK call (Stripe, which retries on its own) through the breaker and the metrics
+    def call(self, func, *args, **kwargs):
+        with self.breaker_call() as outcome:
+            try:
+                result = self.attempt(func, *args, **kwargs)
+            except Exception as e:
+                outcome["ok"] = succeeded(error=e)
+                raise
+            outcome["ok"] = succeeded(result)
+            return result
+
+    # One logical call for the breaker: refused while the circuit is open, then one success or one failure
+    @contextmanager
+    def breaker_call(self):
+        if not self.breaker.allow():
+            raise CircuitOpen(f"{self.name} is failing, calls are paused for {self.breaker.reset_seconds}s")
+
+        outcome = {"ok": False} # -> an exception the call let through is a failure
+        try:
+            yield outcome
+        finally:
+            if outcome["ok"]:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+
+    # One attempt, timed for the metrics
+    def attempt(self, func, *args, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            ok = succeeded(error=e)
+            raise
+        else:
+            ok = succeeded(result)
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.metrics.record(elapsed_ms, ok)
+            logger.debug("%s %s %.1fms %s", self.name, getattr(func, "__name__", "call"), elapsed_ms, "ok" if ok else "failed")
+
+
+# A 4xx (or an SDK error carrying one) is our mistake, not a failing gateway
+def succeeded(result=None, error=None):
+    if error is not None:
+        status = getattr(error, "http_status", None) # -> SDK errors carry the status of the gateway's answer
+        return status is not None and status < 500
+    return getattr(result, "status_code", 200) < 500
+
+
+# A connection error raised before the request was written -> the gateway never saw it
+def never_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", error.args[0]) if error.args else None # -> urllib3's MaxRetryError wraps the cause
+    return type(reason).__name__ in ("NewConnectionError", "NameResolutionError", "ConnectTimeoutError")
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client(name):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = HttpClient(
+                name,
+                timeout=(settings.GATEWAY_HTTP_CONNECT_TIMEOUT, settings.GATEWAY_HTTP_READ_TIMEOUT),
+                retries=settings.GATEWAY_HTTP_RETRIES,
+                backoff=settings.GATEWAY_HTTP_BACKOFF,
+                breaker=CircuitBreaker(settings.GATEWAY_CIRCUIT_FAILURES, settings.GATEWAY_CIRCUIT_RESET_SECONDS),
+            )
+        return _clients[name]
+
+
+# {"PayPal": {"calls": 12, "errors": 0, "avg_ms": 231.4, "max_ms": 402.9}, ...}
+def stats():
+    with _clients_lock:
+        return {name: http.metrics.snapshot() for name, http in _clients.items()}
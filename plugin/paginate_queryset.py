@@ -1,7 +1,190 @@
+import base64
+import datetime
+import json
+
+from django.core.exceptions import FieldDoesNotExist
 from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models
+from django.db.models.constants import LOOKUP_SEP
+from django.utils.functional import cached_property
+
+def paginate_queryset(request, queryset, per_page, keyset=False, estimate_count=False):
+    # keyset=True -> cursor pagination: no COUNT(*) and no OFFSET, so deep pages cost the same as the first one
+    # (an ordering the cursor can't follow falls back to the numbered pages below, see KeysetPaginator.resolve_ordering)
+    if keyset:
+        try:
+            return KeysetPaginator(queryset, per_page, estimate_count=estimate_count).get_page(request.GET.get('page'))
+        except UnsupportedOrdering:
+            pass
 
-def paginate_queryset(request, queryset, per_page):
     paginator = Paginator(queryset, per_page) # splits your queryset into pages
     page_number = request.GET.get('page') # fetches the current page number from the query string
     # returns a Page object (handles invalid page numbers automatically by returning the first/last page)
     return paginator.get_page(page_number)
+
+
+# DjangoJSONEncoder rounds datetimes to milliseconds, which would break the equality test on ties
+class CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class UnsupportedOrdering(ValueError):
+    pass
+
+
+# Keyset (cursor) pagination
+# The page is selected with a WHERE on the ordering columns of the last/first row shown instead of OFFSET n,
+# e.g. ordering ('-date', '-id') -> WHERE date < d OR (date = d AND id < i) ORDER BY date DESC, id DESC
+# The cursor is an opaque token carried in the same ?page= parameter, so the existing templates keep working:
+# next_page_number / previous_page_number return cursors and paginator.page_range is empty - the templates only show
+# Previous / Next when paginator.keyset is set.
+class KeysetPaginator:
+    keyset = True
+
+    def __init__(self, queryset, per_page, ordering=None, estimate_count=False):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = self.resolve_ordering(queryset, ordering)
+        self.estimate_count = estimate_count
+        self.page_range = range(0)
+
+    # the queryset's ordering (or Meta.ordering) with the primary key appended as a unique tie breaker
+    # Only plain, non-null columns of the model can be seeked and put in a cursor - expressions (F().desc()),
+    # related lookups (product__name), annotations, random ordering and nullable columns (NULL rows would never match
+    # the lt / gt of seek) raise UnsupportedOrdering
+    @staticmethod
+    def resolve_ordering(queryset, ordering=None):
+        model = queryset.model
+        fields = list(ordering or queryset.query.order_by or model._meta.ordering or ['-pk'])
+
+        for f in fields:
+            if not isinstance(f, str) or f == '?' or LOOKUP_SEP in f:
+                raise UnsupportedOrdering(f"Can't page {model.__name__} by {f!r} with a cursor")
+        fields = [f.replace('pk', model._meta.pk.name) if f.lstrip('-') == 'pk' else f for f in fields]
+
+        for f in fields:
+            try:
+                field = model._meta.get_field(f.lstrip('-'))
+            except FieldDoesNotExist:
+                raise UnsupportedOrdering(f"Can't page {model.__name__} by {f!r} with a cursor")
+            if not field.concrete or field.is_relation or field.null:
+                raise UnsupportedOrdering(f"Can't page {model.__name__} by {f!r} with a cursor")
+
+        if not any(f.lstrip('-') == model._meta.pk.name for f in fields):
+            descending = fields[-1].startswith('-')
+            fields.append(('-' if descending else '') + model._meta.pk.name)
+
+        return [(f.lstrip('-'), f.startswith('-')) for f in fields]
+
+    @cached_property
+    def count(self):
+        if self.estimate_count:
+            estimate = estimated_count(self.queryset)
+            if estimate is not None:
+                return estimate
+        return self.queryset.count()
+
+    @property
+    def num_pages(self):
+        return max(1, -(-self.count // self.per_page))
+
+    def encode_cursor(self, obj, direction):
+        values = [getattr(obj, name) for name, descending in self.ordering]
+        payload = json.dumps({"d": direction, "v": values}, cls=CursorEncoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            values = payload["v"]
+            if payload["d"] not in ("next", "prev") or len(values) != len(self.ordering):
+                return None, None
+            fields = [self.queryset.model._meta.get_field(name) for name, descending in self.ordering]
+            return payload["d"], [field.to_python(value) for field, value in zip(fields, values)]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return None, None # -> a tampered or stale cursor just shows the first page
+
+    # rows strictly after (forward) or before (backward) the cursor values in the page ordering
+    def seek(self, values, backward):
+        condition = models.Q()
+        for i, (name, descending) in enumerate(self.ordering):
+            after = descending != backward # -> "after" in a descending ordering means smaller values
+            step = models.Q(**{f"{name}__{'lt' if after else 'gt'}": values[i]})
+            for (prev_name, _), prev_value in zip(self.ordering[:i], values[:i]):
+                step &= models.Q(**{prev_name: prev_value})
+            condition |= step
+        return condition
+
+    # walking backwards flips every direction, the page is reversed again once fetched
+    def order_by(self, backward):
+        return [('-' if descending != backward else '') + name for name, descending in self.ordering]
+
+    def get_page(self, cursor=None):
+        direction, values = self.decode_cursor(cursor) if cursor else (None, None)
+        backward = direction == "prev"
+
+        queryset = self.queryset.order_by(*self.order_by(backward))
+        if values is not None:
+            queryset = queryset.filter(self.seek(values, backward))
+
+        rows = list(queryset[:self.per_page + 1]) # -> one extra row tells us whether there is another page
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if backward:
+            rows.reverse()
+            return KeysetPage(rows, self, cursor, has_next=True, has_previous=has_more)
+        return KeysetPage(rows, self, cursor, has_next=has_more, has_previous=values is not None)
+
+
+class KeysetPage:
+    def __init__(self, object_list, paginator, cursor, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.number = cursor or 1
+        self._has_next = has_next and bool(object_list)
+        self._has_previous = has_previous and bool(object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def next_page_number(self):
+        return self.paginator.encode_cursor(self.object_list[-1], "next")
+
+    def previous_page_number(self):
+        return self.paginator.encode_cursor(self.object_list[0], "prev")
+
+    next_cursor = property(next_page_number)
+    previous_cursor = property(previous_page_number)
+
+
+# PostgreSQL keeps a row estimate per table (pg_class.reltuples) which is good enough for "about N results"
+# on unfiltered listings; anything else returns None and the caller falls back to a real COUNT(*)
+def estimated_count(queryset):
+    if connection.vendor != 'postgresql' or queryset.query.where:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+
+    return row[0] if row and row[0] >= 0 else None
@@ -101,6 +101,8 @@ $(document).ready(function () {
         const update_type = button_el.attr("data-update_type"); // Get the type of update (increase or decrease) from the button's data attribute
         const product_id = button_el.attr("data-product_id"); // Get the product ID from the button's data attribute
         const item_id = button_el.attr("data-item_id"); // Get the item ID from the button's data attribute
+        const color = button_el.attr("data-color"); // Get the color of the cart line - together with the size it picks the line to update
+        const size = button_el.attr("data-size"); // Get the size of the cart line
         const cart_id = generateCartId(); // Generate or retrieve the cart ID from local storage
         var qty = $(".item-qty-" + item_id).val(); // Get the current quantity from the input field with class "item-qty-{item_id}"
 
@@ -125,6 +127,8 @@ $(document).ready(function () {
             data: {
                 id: product_id,
                 qty: qty,
+                color: color,
+                size: size,
                 cart_id: cart_id,
             },
 
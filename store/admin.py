@@ -19,6 +19,7 @@ class ProductAdmin(admin.ModelAdmin):
     list_display = ['name', 'category', 'price', 'regular_price', 'stock', 'status', 'featured', 'vendor', 'date']
     search_fields = ['name', 'category__title'] # from category display the title
     list_filter = ['status', 'featured', 'category']
+    readonly_fields = ['rating_avg', 'review_count'] # maintained from the reviews, see store/signals.py
     inlines = [GalleryInline, VariantInline]
     prepopulated_fields = {'slug': ('name',)}
 
@@ -35,14 +36,29 @@ class GalleryAdmin(admin.ModelAdmin):
     list_display = ['product', 'gallery_id']
     search_fields = ['product__name', 'gallery_id']
 
+class ProductFacetAdmin(admin.ModelAdmin):
+    list_display = ['product', 'facet', 'value', 'label']
+    search_fields = ['product__name', 'value']
+    list_filter = ['facet']
+
+class RelatedProductAdmin(admin.ModelAdmin):
+    list_display = ['product', 'related', 'score']
+    search_fields = ['product__name', 'related__name']
+
 class CartAdmin(admin.ModelAdmin):
     list_display = ['cart_id', 'product', 'user', 'qty', 'price', 'total', 'date']
     search_fields = ['cart_id', 'product__name', 'user__username']
     list_filter = ['date', 'product']
 
 class CouponAdmin(admin.ModelAdmin):
-    list_display = ['code', 'vendor', 'discount']
+    list_display = ['code', 'vendor', 'discount', 'active', 'valid_from', 'valid_to', 'min_basket', 'used', 'max_uses', 'max_uses_per_user']
     search_fields = ['code', 'vendor__username']
+    list_filter = ['active']
+    readonly_fields = ['used'] # counted by store/coupons.py
+
+class CouponUsageAdmin(admin.ModelAdmin):
+    list_display = ['coupon', 'user', 'used']
+    search_fields = ['coupon__code', 'user__username']
 
 class OrderAdmin(admin.ModelAdmin):
     list_display = ['order_id', 'customer', 'total', 'payment_status', 'order_status', 'payment_method', 'date']
@@ -55,6 +71,25 @@ class OrderItemAdmin(admin.ModelAdmin):
     search_fields = ['item_id', 'order__order_id', 'product__name']
     list_filter = ['order__date']
 
+class StockHoldAdmin(admin.ModelAdmin):
+    list_display = ['product', 'order', 'qty', 'status', 'expires', 'date']
+    search_fields = ['product__name', 'order__order_id']
+    list_filter = ['status']
+
+class PaymentAttemptAdmin(admin.ModelAdmin):
+    list_display = ['reference', 'gateway', 'order', 'status', 'gateway_status', 'updated']
+    search_fields = ['reference', 'order__order_id']
+    list_filter = ['gateway', 'status']
+
+class PaymentEventAdmin(admin.ModelAdmin):
+    list_display = ['event_id', 'gateway', 'event_type', 'order', 'status', 'attempts', 'updated']
+    search_fields = ['event_id', 'reference', 'order__order_id']
+    list_filter = ['gateway', 'status', 'event_type']
+
+class ExchangeRateAdmin(admin.ModelAdmin):
+    list_display = ['currency', 'rate', 'updated']
+    search_fields = ['currency']
+
 class ReviewAdmin(admin.ModelAdmin):
     list_display = ['user', 'product', 'rating', 'active', 'date']
     search_fields = ['user__username', 'product__name']
@@ -65,8 +100,15 @@ admin.site.register(store_models.Product, ProductAdmin)
 admin.site.register(store_models.Variant, VariantAdmin)
 admin.site.register(store_models.VariantItem, VariantItemAdmin)
 admin.site.register(store_models.Gallery, GalleryAdmin)
+admin.site.register(store_models.ProductFacet, ProductFacetAdmin)
+admin.site.register(store_models.RelatedProduct, RelatedProductAdmin)
 admin.site.register(store_models.Cart, CartAdmin)
 admin.site.register(store_models.Coupon, CouponAdmin)
+admin.site.register(store_models.CouponUsage, CouponUsageAdmin)
 admin.site.register(store_models.Order, OrderAdmin)
 admin.site.register(store_models.OrderItem, OrderItemAdmin)
 admin.site.register(store_models.Review, ReviewAdmin)
+admin.site.register(store_models.StockHold, StockHoldAdmin)
+admin.site.register(store_models.PaymentAttempt, PaymentAttemptAdmin)
+admin.site.register(store_models.PaymentEvent, PaymentEventAdmin)
+admin.site.register(store_models.ExchangeRate, ExchangeRateAdmin)
@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.core.cache import cache
+
+# Versioned cache keys
+# Instead of deleting every cached entry that depends on some rows, the entries embed a version number in
+# their key and the version is bumped when those rows change - old entries are simply never read again
+# and expire on their own.
+
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def get_version(name):
+    return cache.get_or_set(f"version:{name}", 1, None)
+
+
+def bump_version(name):
+    try:
+        return cache.incr(f"version:{name}")
+    except ValueError: # -> the version key was evicted, start a new series that can't collide with cached keys
+        cache.set(f"version:{name}", 2, None)
+        return 2
+
+
+def versioned_key(name, *parts):
+    return ":".join(str(p) for p in (name, f"v{get_version(name)}", *parts))
+
+
+# Categories - used by the global context processor on every page. The version is bumped in the worker that saved
+# the category, so they are only cached when every worker reads that version (settings.STORE_SHARED_CACHE).
+def cached_categories():
+    from store import models as store_models
+
+    if not settings.STORE_SHARED_CACHE:
+        return list(store_models.Category.objects.all())
+
+    key = versioned_key("categories")
+    categories = cache.get(key)
+
+    if categories is None:
+        categories = list(store_models.Category.objects.all())
+        cache.set(key, categories, CACHE_TIMEOUT)
+
+    return categories
+
+
+# Product detail - the product with its gallery, variants (with items) and active reviews, assembled by
+# Product.objects.for_detail() in a fixed number of queries and cached per slug until one of those rows changes.
+# The bundle holds the price and the stock, so it is only cached in a shared cache (settings.STORE_SHARED_CACHE).
+def product_detail_key(slug):
+    return f"product_detail:{slug}"
+
+
+def cached_product_detail(slug):
+    from store import models as store_models
+
+    if not settings.STORE_SHARED_CACHE:
+        return store_models.Product.objects.published().for_detail().get(slug=slug)
+
+    key = product_detail_key(slug)
+    product = cache.get(key)
+
+    if product is None:
+        product = store_models.Product.objects.published().for_detail().get(slug=slug) # -> raises Product.DoesNotExist
+        cache.set(key, product, CACHE_TIMEOUT)
+
+    return product
+
+
+def invalidate_product_detail(*slugs):
+    cache.delete_many([product_detail_key(slug) for slug in slugs if slug])
+
+
+# Product cards - the rendered card HTML of each product is cached under its id and Product.updated,
+# which moves forward whenever the product, its reviews, gallery, variants or category change
+# (see store/signals.py), so a grid is assembled with one cache.get_many and only stale cards are rendered
+def render_product_cards(products, template_name):
+    from django.template.loader import render_to_string
+    from django.utils.safestring import mark_safe
+
+    products = list(products)
+    keys = [f"product_card:{template_name}:{p.id}:{p.cache_version}" for p in products]
+    cached = cache.get_many(keys)
+
+    cards, rendered = [], {}
+    for key, product in zip(keys, products):
+        html = cached.get(key)
+        if html is None:
+            html = render_to_string(template_name, {"p": product})
+            rendered[key] = html
+        cards.append(mark_safe(html))
+
+    if rendered:
+        cache.set_many(rendered, CACHE_TIMEOUT)
+
+    return cards
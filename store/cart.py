@@ -0,0 +1,342 @@
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from store import models as store_models
+
+# Cart storage
+# The cart views and create_order talk to a cart store instead of the Cart table:
+# - DatabaseCartStore keeps every line in store_cart, as the views always did
+# - CacheCartStore keeps the active cart (lines, qty, variant choices and totals) in the Django cache and only
+#   writes it to store_cart at checkout (persist) or when `manage.py flush_carts` runs (write-behind),
+#   so browsing and editing a cart costs no database writes
+# settings.STORE_CART_BACKEND picks the store class (see ecomm_prj/settings.py).
+#
+# Anonymous carts are keyed by the cart_id the browser keeps in localStorage. A logged in customer has one cart
+# across devices, keyed by user_cart_id() and looked up by user - the anonymous cart of the session is merged
+# into it on login (store/signals.py -> merge_anonymous_cart).
+
+CART_TIMEOUT = 60 * 60 * 24 * 14 # -> an untouched cache cart lives two weeks, flushed carts can be reloaded from store_cart
+DIRTY_KEY = "cart:dirty"
+CART_LOCK_TIMEOUT = 5 # -> seconds a cart stays locked at most, so a worker that dies mid-change can't lock it for good
+DIRTY_LOCK_KEY = "cart:dirty:lock"
+
+
+def user_cart_id(user):
+    return f"user-{user.pk}" # -> browser cart ids are plain digits, so these never collide
+
+
+def line_totals(product, qty):
+    sub_total = Decimal(product.price) * Decimal(qty)
+    shipping = Decimal(product.shipping) * Decimal(qty)
+    return sub_total, shipping, sub_total + shipping
+
+
+class CartBusy(Exception):
+    pass # -> another request held the cart for longer than CART_LOCK_TIMEOUT, nothing was changed
+
+
+# A cache.add() lock - the key holds a token of its holder, so a holder that outlived its lock can't release the
+# next holder's one. The wait runs a little past CART_LOCK_TIMEOUT (the lock of a dead holder has expired by then),
+# after that CartBusy is raised rather than changing the cart without the lock.
+@contextmanager
+def cache_lock(key):
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + CART_LOCK_TIMEOUT + 1
+    while not cache.add(key, token, CART_LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise CartBusy(key)
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+# A cart line of the cache store - same attribute names as store_models.Cart so templates and create_order don't care
+class CartLine:
+    def __init__(self, id, product, qty, price, sub_total, shipping, total, color=None, size=None, cart_id=None, user=None):
+        self.id = id
+        self.product = product
+        self.qty = qty
+        self.price = price
+        self.sub_total = sub_total
+        self.shipping = shipping
+        self.total = total
+        self.color = color
+        self.size = size
+        self.cart_id = cart_id
+        self.user = user
+
+
+class CartStore(ABC):
+    def __init__(self, cart_id, user=None):
+        self.user = user if user is not None and user.is_authenticated else None
+        self.cart_id = user_cart_id(self.user) if self.user else cart_id
+
+    # the persisted lines of this cart -> by user (store_cart.user_id index) once logged in
+    def queryset(self):
+        if self.user:
+            return store_models.Cart.objects.filter(user=self.user)
+        return store_models.Cart.objects.filter(cart_id=self.cart_id)
+
+    @abstractmethod
+    def lines(self):
+        ...
+
+    # returns (line, created) - a line is one variant (size, color) of a product
+    @abstractmethod
+    def add(self, product, qty, color=None, size=None):
+        ...
+
+    # returns False when the line doesn't exist (or belongs to another product)
+    @abstractmethod
+    def remove(self, product, item_id):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    # {"count": lines, "sub_total": ..., "shipping": ...}
+    @abstractmethod
+    def totals(self):
+        ...
+
+    # write the cart to store_cart, a no-op for the database store
+    def persist(self):
+        pass
+
+    # move the lines of an anonymous cart into this (user) cart, adding up the qty of lines found in both
+    @abstractmethod
+    def merge(self, cart_id):
+        ...
+
+
+# Every mutation is one or two statements followed by one aggregate:
+# - add -> UPDATE of the line, and an INSERT when there was none. The unique_cart_line constraint
+#   (cart_id, product_id, size, color) refuses the INSERT of a concurrent click that lost the race, which then
+#   updates the winner's row - no duplicate lines, and `created` is only reported by the request that inserted it
+# - remove -> a single DELETE
+# and the aggregate (count, sub_total, shipping) is kept for the totals() call that follows in the view.
+class DatabaseCartStore(CartStore):
+    def __init__(self, cart_id, user=None):
+        super().__init__(cart_id, user)
+        self._totals = None
+
+    def lines(self):
+        return list(self.queryset().select_related('product', 'product__vendor'))
+
+    def add(self, product, qty, color=None, size=None):
+        item = store_models.Cart(cart_id=self.cart_id, product=product, user=self.user, qty=qty, price=product.price, color=color or "", size=size or "")
+        item.sub_total, item.shipping, item.total = line_totals(product, qty)
+        line = store_models.Cart.objects.filter(cart_id=self.cart_id, product=product, size=item.size, color=item.color)
+
+        created = False
+        for attempt in range(2):
+            if line.update(qty=item.qty, price=item.price, sub_total=item.sub_total, shipping=item.shipping, total=item.total,
+                           user=self.user, updated=timezone.now()):
+                break
+            try:
+                with transaction.atomic():
+                    item.save(force_insert=True)
+                created = True
+                break
+            except IntegrityError: # -> a concurrent add inserted the line first, update it instead
+                continue
+
+        self.aggregate()
+        return item, created
+
+    def remove(self, product, item_id):
+        deleted, _ = self.queryset().filter(product=product, id=item_id).delete()
+        self._totals = None
+        return bool(deleted)
+
+    def clear(self):
+        self.queryset().delete()
+        self._totals = None
+
+    def aggregate(self, **extra):
+        totals = self.queryset().aggregate(count=models.Count("id"), sub_total=models.Sum("sub_total"), shipping=models.Sum("shipping"), **extra)
+        totals["sub_total"] = totals["sub_total"] or Decimal("0.00")
+        totals["shipping"] = totals["shipping"] or Decimal("0.00")
+        self._totals = totals
+        return totals
+
+    def totals(self):
+        return self._totals if self._totals is not None else self.aggregate()
+
+    # set-based -> three statements whatever the size of either cart
+    def merge(self, cart_id):
+        anonymous = store_models.Cart.objects.filter(cart_id=cart_id, user__isnull=True)
+        in_anonymous = anonymous.filter(product=models.OuterRef('product'), size=models.OuterRef('size'), color=models.OuterRef('color'))
+        in_user_cart = self.queryset().filter(product=models.OuterRef('product'), size=models.OuterRef('size'), color=models.OuterRef('color'))
+        now = timezone.now()
+
+        with transaction.atomic():
+            # lines in both carts -> add the anonymous qty and amounts to the user's line, then drop the anonymous one
+            self.queryset().filter(models.Exists(in_anonymous)).update(
+                qty=models.F('qty') + models.Subquery(in_anonymous.values('qty')[:1]),
+                sub_total=models.F('sub_total') + models.Subquery(in_anonymous.values('sub_total')[:1]),
+                shipping=models.F('shipping') + models.Subquery(in_anonymous.values('shipping')[:1]),
+                total=models.F('total') + models.Subquery(in_anonymous.values('total')[:1]),
+                updated=now,
+            )
+            anonymous.filter(models.Exists(in_user_cart)).delete()
+
+            # the rest simply changes owner
+            anonymous.update(cart_id=self.cart_id, user=self.user, updated=now)
+
+        self._totals = None
+
+
+class CacheCartStore(CartStore):
+    def __init__(self, cart_id, user=None):
+        super().__init__(cart_id, user)
+        self.key = f"cart:{self.cart_id}"
+        self._data = None
+
+    # the cached cart: {"next_id": int, "lines": [{id, product_id, qty, price, sub_total, shipping, total, color, size}]}
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = cache.get(self.key) if self.cart_id else None
+            if self._data is None:
+                self._data = self.load()
+        return self._data
+
+    # cache miss -> start from whatever was last persisted for this cart
+    def load(self):
+        rows = self.queryset().order_by('id').values('product_id', 'qty', 'price', 'sub_total', 'shipping', 'total', 'color', 'size') if self.cart_id else []
+        lines = [dict(row, id=i) for i, row in enumerate(rows, start=1)]
+        return {"next_id": len(lines) + 1, "lines": lines}
+
+    # Every change is a read-modify-write of the whole cart blob -> two requests changing the same cart (two tabs,
+    # a double click) would each write back their own copy and lose the other's line. The cache.add() lock runs
+    # them one after the other, and the cart is read again once it is held so the change applies to the latest copy.
+    @contextmanager
+    def locked(self):
+        with cache_lock(f"{self.key}:lock"):
+            self._data = None
+            yield
+
+    def save(self):
+        if self.user:
+            self.data["user_id"] = self.user.id # -> remembered for flushes, which run without a request
+        cache.set(self.key, self.data, CART_TIMEOUT)
+        mark_dirty(self.cart_id)
+
+    def lines(self):
+        rows = self.data["lines"]
+        products = store_models.Product.objects.select_related('vendor').in_bulk([row["product_id"] for row in rows])
+        return [
+            CartLine(product=products[row["product_id"]], cart_id=self.cart_id, user=self.user, **{k: v for k, v in row.items() if k != "product_id"})
+            for row in rows if row["product_id"] in products # -> products deleted since are dropped
+        ]
+
+    def add(self, product, qty, color=None, size=None):
+        color, size = color or "", size or ""
+        sub_total, shipping, total = line_totals(product, qty)
+        with self.locked():
+            row = next((row for row in self.data["lines"] if (row["product_id"], row["size"], row["color"]) == (product.id, size, color)), None)
+            created = row is None
+            if created:
+                row = {"id": self.data["next_id"], "product_id": product.id}
+                self.data["next_id"] += 1
+                self.data["lines"].append(row)
+
+            row.update(qty=int(qty), price=product.price, sub_total=sub_total, shipping=shipping, total=total, color=color, size=size)
+            self.save()
+
+        return CartLine(product=product, cart_id=self.cart_id, user=self.user, **{k: v for k, v in row.items() if k != "product_id"}), created
+
+    def remove(self, product, item_id):
+        with self.locked():
+            lines = self.data["lines"]
+            kept = [row for row in lines if not (str(row["id"]) == str(item_id) and row["product_id"] == product.id)]
+            if len(kept) == len(lines):
+                return False
+
+            self.data["lines"] = kept
+            self.save()
+            return True
+
+    def clear(self):
+        cache.delete(self.key)
+        self._data = None
+        self.queryset().delete()
+
+    def merge(self, cart_id):
+        anonymous = CacheCartStore(cart_id)
+        with self.locked(), anonymous.locked():
+            for row in anonymous.data["lines"]:
+                key = (row["product_id"], row["size"], row["color"])
+                line = next((line for line in self.data["lines"] if (line["product_id"], line["size"], line["color"]) == key), None)
+                if line:
+                    for field in ("qty", "sub_total", "shipping", "total"):
+                        line[field] += row[field]
+                else:
+                    self.data["lines"].append(dict(row, id=self.data["next_id"]))
+                    self.data["next_id"] += 1
+
+            self.save()
+            anonymous.clear()
+
+    def totals(self):
+        lines = self.data["lines"]
+        return {
+            "count": len(lines),
+            "sub_total": sum((row["sub_total"] for row in lines), Decimal("0.00")),
+            "shipping": sum((row["shipping"] for row in lines), Decimal("0.00")),
+        }
+
+    # replace the persisted copy of this cart with the cached lines
+    def persist(self):
+        user_id = self.user.id if self.user else self.data.get("user_id")
+        rows = [
+            store_models.Cart(cart_id=self.cart_id, user_id=user_id, product_id=row["product_id"], qty=row["qty"], price=row["price"],
+                              sub_total=row["sub_total"], shipping=row["shipping"], total=row["total"], color=row["color"], size=row["size"])
+            for row in self.data["lines"]
+        ]
+        with transaction.atomic():
+            self.queryset().delete()
+            store_models.Cart.objects.bulk_create(rows)
+
+
+# Write-behind bookkeeping - the cart ids changed since the last flush
+# The index is a read-modify-write of one cache entry -> every change of it (and the flush taking it) holds its lock,
+# so no id is lost between a change and a flush.
+def mark_dirty(cart_id):
+    with cache_lock(DIRTY_LOCK_KEY):
+        dirty = cache.get(DIRTY_KEY) or set()
+        if cart_id not in dirty:
+            dirty.add(cart_id)
+            cache.set(DIRTY_KEY, dirty, None)
+
+
+def flush_carts():
+    with cache_lock(DIRTY_LOCK_KEY):
+        dirty = cache.get(DIRTY_KEY) or set()
+        cache.delete(DIRTY_KEY)
+
+    flushed = 0
+    for cart_id in dirty:
+        if cache.get(f"cart:{cart_id}") is not None: # -> expired carts have nothing left to write
+            CacheCartStore(cart_id).persist()
+            flushed += 1
+    return flushed
+
+
+def get_cart_store(request, cart_id=None):
+    backend = import_string(getattr(settings, "STORE_CART_BACKEND", "store.cart.DatabaseCartStore"))
+    return backend(cart_id or request.session.get('cart_id'), request.user)
@@ -1,27 +1,35 @@
-from store import models as store_models # need to import the stotre models to access the database
+from django.utils.functional import SimpleLazyObject
+
+from store.cache import cached_categories
+from store.cart import get_cart_store
 # from customer import models as customer_models
 
 # This is the context processor for the store app that will be used to provide data to the templates Globally
-# Its going to hold the items in the cart that when a user adds an item to the cart,
-# it will be stored in the session without disappearing when a refresh is made 
-def default(request): 
-    category_ = store_models.Category.objects.all() # Get all categories from the database
+# Every value is lazy -> nothing is queried unless the rendered template actually reads it
+# - the categories come from a versioned cache entry that store/signals.py invalidates on Category save/delete
+# - the cart item count lives in the session and is kept current by the cart views (add_to_cart, delete_cart_item, clear_cart_items)
+def cart_item_count(request):
+    if "total_cart_items" in request.session: # the cart views keep this up to date
+        return request.session['total_cart_items']
 
-    try: # Try to get the cart_id from the session
-        cart_id = request.session['cart_id'] # If it exists, use it
-        total_cart_items = store_models.Cart.objects.filter(cart_id=cart_id).count() # Count the number of items in the cart
+    cart_id = request.session.get('cart_id')
+    if not cart_id and not request.user.is_authenticated: # no cart yet -> nothing in it
+        return 0
 
-    except: # If it does not exist, create a new cart_id and set it in the session
-        total_cart_items = 0 # if it does not exist, set the total cart items to 0
-        # then you need to pass this -> total_cart_items - to the cart number area in the base.html
+    # first page of a session that already has a cart (e.g. carried over a logout), or of a customer whose cart is
+    # found by user (store/cart.py -> user_cart_id) - count once and remember it
+    total_cart_items = get_cart_store(request, cart_id).totals()["count"]
+    request.session['total_cart_items'] = total_cart_items
+    return total_cart_items
 
+def default(request): 
     # try:
     #     wishlist_count = customer_models.Wishlist.objects.filter(user=request.user)
     # except:
     #     wishlist_count = 0
 
     return {
-        "total_cart_items": total_cart_items,
-        "category_": category_,
+        "total_cart_items": SimpleLazyObject(lambda: cart_item_count(request)),
+        "category_": SimpleLazyObject(cached_categories),
         # "wishlist_count": wishlist_count,
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,145 @@
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
+
+from store import models as store_models
+
+# Coupon rules
+# A code is unique per vendor and only discounts that vendor's items of an order. Before it is applied:
+# - the coupon must be active and inside its valid_from / valid_to window
+# - the vendor's items in the order must add up to at least min_basket
+# - max_uses and max_uses_per_user are enforced by conditional counter updates (UPDATE ... SET used = used + 1
+#   WHERE used < limit), so concurrent redemptions can never go over a limit
+# The coupons of a code are kept in the cache (invalidated from store/signals.py), and a coupon that runs out is
+# remembered there too, so a flash-sale storm on one code resolves from the cache instead of queueing on its row.
+# Coupons without a limit are never written to when redeemed.
+# A use is taken when the coupon is applied and lasts as long as the order's stock holds: when they expire unpaid
+# the use is given back (release, from inventory.release_expired_holds), and an order paid after that counts it
+# again (restore, from inventory.commit_holds) - an abandoned checkout doesn't keep a limited coupon used up.
+
+HOT_COUPON_TIMEOUT = 60 * 5
+
+
+class CouponError(Exception):
+    pass
+
+
+def coupon_key(code):
+    return f"coupon:{code}"
+
+
+def exhausted_key(coupon_id):
+    return f"coupon:exhausted:{coupon_id}"
+
+
+def cached_coupons(code):
+    coupons = cache.get(coupon_key(code))
+    if coupons is None:
+        coupons = list(store_models.Coupon.objects.filter(code=code))
+        cache.set(coupon_key(code), coupons, HOT_COUPON_TIMEOUT)
+    return coupons
+
+
+def invalidate_coupons(*codes):
+    cache.delete_many([coupon_key(code) for code in codes if code])
+
+
+def check(coupon, basket, now=None):
+    now = now or timezone.now()
+
+    if not coupon.active:
+        raise CouponError("This coupon is no longer active")
+    if coupon.valid_from and now < coupon.valid_from:
+        raise CouponError("This coupon is not valid yet")
+    if coupon.valid_to and now > coupon.valid_to:
+        raise CouponError("This coupon has expired")
+    if basket < coupon.min_basket:
+        raise CouponError(f"This coupon needs at least ${coupon.min_basket:,.2f} of the vendor's items in your order")
+    if coupon.max_uses is not None and cache.get(exhausted_key(coupon.id)):
+        raise CouponError("This coupon has been fully redeemed")
+
+
+# Must run inside the transaction that applies the coupon, a failed limit rolls back the counters already taken
+def redeem(coupon, user):
+    if coupon.max_uses is not None:
+        taken = store_models.Coupon.objects.filter(pk=coupon.pk, used__lt=models.F('max_uses')).update(used=models.F('used') + 1)
+        if not taken:
+            cache.set(exhausted_key(coupon.id), True, HOT_COUPON_TIMEOUT)
+            raise CouponError("This coupon has been fully redeemed")
+
+    if coupon.max_uses_per_user is not None:
+        if user is None:
+            raise CouponError("Log in to use this coupon")
+        store_models.CouponUsage.objects.bulk_create([store_models.CouponUsage(coupon=coupon, user=user)], ignore_conflicts=True)
+        taken = store_models.CouponUsage.objects.filter(coupon=coupon, user=user, used__lt=coupon.max_uses_per_user).update(used=models.F('used') + 1)
+        if not taken:
+            raise CouponError("You have already used this coupon the maximum number of times")
+
+
+# the coupons of the order that have a limit -> their uses are counted
+def limited_coupons(order):
+    return order.coupons.filter(models.Q(max_uses__isnull=False) | models.Q(max_uses_per_user__isnull=False))
+
+
+# The order's stock holds expired unpaid -> its uses go back to the coupons
+def release(order):
+    for coupon in limited_coupons(order):
+        if coupon.max_uses is not None:
+            store_models.Coupon.objects.filter(pk=coupon.pk, used__gt=0).update(used=models.F('used') - 1)
+            transaction.on_commit(lambda coupon_id=coupon.id: cache.delete(exhausted_key(coupon_id)))
+        if coupon.max_uses_per_user is not None and order.customer_id:
+            store_models.CouponUsage.objects.filter(coupon=coupon, user_id=order.customer_id, used__gt=0).update(used=models.F('used') - 1)
+
+
+# Paid after release() -> the uses are counted again, over the limit if need be: the customer has paid the discounted price
+def restore(order):
+    for coupon in limited_coupons(order):
+        if coupon.max_uses is not None:
+            store_models.Coupon.objects.filter(pk=coupon.pk).update(used=models.F('used') + 1)
+        if coupon.max_uses_per_user is not None and order.customer_id:
+            store_models.CouponUsage.objects.bulk_create([store_models.CouponUsage(coupon=coupon, user_id=order.customer_id)], ignore_conflicts=True)
+            store_models.CouponUsage.objects.filter(coupon=coupon, user_id=order.customer_id).update(used=models.F('used') + 1)
+
+
+# Applies one coupon to an order locked with select_for_update, with a fixed number of statements:
+# read the eligible items, one UPDATE for all their totals, one INSERT for the coupon links, one UPDATE of the order
+def apply(order, coupon):
+    # Note: If a vendor gives you a coupon and you select two items from different vendors, the coupon will only apply to the items from the vendor that issued the coupon to you not with the other vendors items
+    items = list(
+        store_models.OrderItem.objects.filter(order=order, product__vendor=coupon.vendor_id)
+        .exclude(coupon=coupon).only('id', 'total', 'saved')
+    )
+
+    check(coupon, sum((item.total for item in items), 0))
+
+    # the use would last as long as the stock holds -> once they expired it could never be given back
+    holds = order.stock_holds.aggregate(count=models.Count('id'), held=models.Count('id', filter=models.Q(status="Held")))
+    if holds["count"] and not holds["held"]:
+        raise CouponError("This checkout has expired, place your order again to use a coupon")
+
+    total_discount = 0
+    for item in items:
+        item_discount = item.total * coupon.discount / 100  # Discount for this item
+        total_discount += item_discount
+        item.total -= item_discount
+        item.saved += item_discount
+
+    if total_discount <= 0:
+        return 0
+
+    redeem(coupon, order.customer)
+
+    store_models.OrderItem.objects.bulk_update(items, ['total', 'saved'])
+    store_models.OrderItem.coupon.through.objects.bulk_create(
+        [store_models.OrderItem.coupon.through(orderitem_id=item.id, coupon_id=coupon.id) for item in items],
+        ignore_conflicts=True,
+    )
+    order.coupons.add(coupon)
+
+    order.total -= total_discount
+    order.sub_total -= total_discount
+    order.saved += total_discount
+    # -> update() rather than save(): only the totals change, the payment receivers in store/signals.py have nothing to do
+    store_models.Order.objects.filter(pk=order.pk).update(total=order.total, sub_total=order.sub_total, saved=order.saved)
+
+    return total_discount
@@ -0,0 +1,78 @@
+import threading
+import weakref
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, models, transaction
+
+# Public ids (Order.order_id, OrderItem.item_id, Payout.payout_id)
+# Random 6 digit ids collide after a few thousand rows (birthday bound), so the ids come from named sequences
+# (store_models.IdSequence) instead. Each thread reserves a block of STORE_ID_BLOCK_SIZE values with a single
+# UPDATE ... SET next_value = next_value + size and hands them out from memory: no two blocks ever overlap, so ids
+# are unique without a retry loop and a new block is only needed every STORE_ID_BLOCK_SIZE ids.
+# Values of a block that is never used are simply skipped - ids have gaps and only roughly follow creation order.
+#
+# A block reserved inside a transaction is undone if that transaction rolls back, and the same values would be
+# reserved again by another worker -> such a block is only trusted by the transaction that reserved it until it
+# commits, after a rollback the thread reserves a fresh one.
+
+FIRST_ID = 10_000_000 # -> above every legacy 6 digit id, so sequence ids never meet one
+
+_blocks = threading.local()
+
+
+class Block:
+    def __init__(self, start, end):
+        self.next = start
+        self.end = end
+        self.committed = not connection.in_atomic_block
+        if not self.committed:
+            # the queued on_commit hook is the only reference to `commit` -> Django drops it when the transaction
+            # rolls back, so the weak reference tells whether the reserving transaction is still open
+            def commit():
+                self.committed = True
+            self.pending = weakref.ref(commit)
+            transaction.on_commit(commit)
+
+    def usable(self):
+        if self.next >= self.end:
+            return False
+        return self.committed or self.pending() is not None
+
+
+def reserve(name, size):
+    IdSequence = apps.get_model('store', 'IdSequence')
+    sequence = IdSequence.objects.filter(name=name)
+
+    with transaction.atomic():
+        # UPDATE first -> the row stays locked until the block is read back, concurrent reservations queue on it
+        if not sequence.update(next_value=models.F('next_value') + size):
+            IdSequence.objects.bulk_create([IdSequence(name=name, next_value=FIRST_ID)], ignore_conflicts=True)
+            sequence.update(next_value=models.F('next_value') + size)
+        end = sequence.values_list('next_value', flat=True).get()
+
+    return Block(end - size, end)
+
+
+def next_id(name):
+    block = getattr(_blocks, name, None)
+    if block is None or not block.usable():
+        block = reserve(name, settings.STORE_ID_BLOCK_SIZE)
+        setattr(_blocks, name, block)
+
+    value = block.next
+    block.next += 1
+    return str(value)
+
+
+# Field defaults (referenced by the migrations, keep the names)
+def new_order_id():
+    return next_id("order")
+
+
+def new_item_id():
+    return next_id("order_item")
+
+
+def new_payout_id():
+    return next_id("payout")
@@ -0,0 +1,130 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from store import coupons
+from store import models as store_models
+from store.cache import invalidate_product_detail
+
+# Inventory holds
+# Stock is only ever changed with a conditional UPDATE ... SET stock = stock - qty WHERE stock >= qty, so two
+# checkouts racing for the last unit can't both get it: the database serialises the two updates and the second
+# one matches no row. The qty taken is recorded as a StockHold that is
+# - Held      -> taken at create_order, expires after STORE_STOCK_HOLD_MINUTES
+# - Committed -> the order was paid (commit_holds, called when an order turns Paid - see store/signals.py)
+# - Released  -> expired unpaid, the qty went back to stock (release_expired_holds / manage.py release_stock_holds),
+#                or paid too late to get it back (commit_holds)
+
+
+class OutOfStock(Exception):
+    def __init__(self, product):
+        self.product = product
+        super().__init__(f"{product} is out of stock")
+
+
+def take_stock(product_id, qty, now):
+    return store_models.Product.objects.filter(pk=product_id, stock__gte=qty).update(stock=models.F('stock') - qty, updated=now)
+
+
+def give_back_stock(product_id, qty, now):
+    store_models.Product.objects.filter(pk=product_id).update(stock=models.F('stock') + qty, updated=now)
+
+
+# the product detail bundle caches the stock -> drop it once the change is committed
+def stock_changed(product_ids):
+    slugs = list(store_models.Product.objects.filter(pk__in=product_ids).values_list('slug', flat=True))
+    transaction.on_commit(lambda: invalidate_product_detail(*slugs))
+
+
+# Must run inside the transaction that creates the order, so an OutOfStock rolls back the stock already taken.
+# Runs the same few statements however many products the order has.
+def place_holds(order, lines):
+    wanted = Counter()
+    products = {}
+    for line in lines:
+        wanted[line.product.id] += int(line.qty)
+        products[line.product.id] = line.product
+
+    now = timezone.now()
+    expires = now + timedelta(minutes=settings.STORE_STOCK_HOLD_MINUTES)
+
+    # -> lock the rows in id order first, so concurrent checkouts can't deadlock (a no-op on SQLite, which
+    #    serialises writers anyway), then take the stock of every product with one conditional UPDATE
+    stock = dict(store_models.Product.objects.select_for_update().filter(pk__in=wanted).order_by('pk').values_list('pk', 'stock'))
+    wanted_qty = models.Case(*[models.When(pk=product_id, then=n) for product_id, n in wanted.items()])
+    taken = store_models.Product.objects.filter(pk__in=wanted, stock__gte=wanted_qty).update(stock=models.F('stock') - wanted_qty, updated=now)
+    if taken < len(wanted):
+        short = next((p for p in sorted(wanted) if (stock.get(p) or 0) < wanted[p]), min(wanted))
+        raise OutOfStock(products[short]) # -> the caller's transaction rolls back the stock the UPDATE took
+
+    store_models.StockHold.objects.bulk_create([
+        store_models.StockHold(product_id=product_id, order=order, qty=qty, expires=expires)
+        for product_id, qty in wanted.items()
+    ])
+    stock_changed(list(wanted))
+
+
+# Returns the holds whose stock could not be taken again (they had expired and the units were sold meanwhile).
+# The order can't be shipped in full then -> nothing is committed, every unit it still had goes back to stock and
+# the holds stay Released (the order is cancelled and refunded, see store/payments.py -> cancel_oversold).
+def commit_holds(order):
+    now = timezone.now()
+    short = []
+
+    with transaction.atomic():
+        holds = list(store_models.StockHold.objects.select_for_update().filter(order=order, status__in=["Held", "Released"]).order_by('product_id'))
+
+        taken = [hold for hold in holds if hold.status == "Held"]
+        for hold in holds:
+            if hold.status == "Released": # -> paid after the hold expired
+                (taken if take_stock(hold.product_id, hold.qty, now) else short).append(hold)
+
+        if short:
+            for hold in taken:
+                give_back_stock(hold.product_id, hold.qty, now)
+            store_models.StockHold.objects.filter(pk__in=[h.pk for h in taken]).update(status="Released")
+            stock_changed([h.product_id for h in taken])
+            return short
+
+        store_models.StockHold.objects.filter(pk__in=[h.pk for h in holds]).update(status="Committed")
+        if any(h.status == "Released" for h in holds):
+            stock_changed([h.product_id for h in holds if h.status == "Released"])
+        if holds and all(h.status == "Released" for h in holds): # -> its coupon uses were given back on expiry
+            coupons.restore(order)
+
+    return short
+
+
+def release_expired_holds(batch_size=500):
+    now = timezone.now()
+    released = 0
+
+    while True:
+        with transaction.atomic():
+            # skip_locked -> holds being committed by a payment right now are left to it (ignored on SQLite)
+            holds = list(
+                store_models.StockHold.objects.select_for_update(skip_locked=True)
+                .filter(status="Held", expires__lt=now).order_by('id')[:batch_size]
+            )
+            if not holds:
+                return released
+
+            store_models.StockHold.objects.filter(pk__in=[h.pk for h in holds]).update(status="Released")
+
+            qty = Counter()
+            for hold in holds:
+                qty[hold.product_id] += hold.qty
+            for product_id in sorted(qty):
+                give_back_stock(product_id, qty[product_id], now)
+
+            stock_changed(list(qty))
+
+            # unpaid orders left without a held unit -> their coupon uses go back (an order paid meanwhile keeps them)
+            expired = store_models.Order.objects.filter(pk__in={h.order_id for h in holds}, payment_status="Processing").exclude(stock_holds__status="Held")
+            for order in expired:
+                coupons.release(order)
+
+            released += len(holds)
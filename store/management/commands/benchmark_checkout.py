@@ -0,0 +1,148 @@
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from customer import models as customer_models
+from plugin import fake_gateway
+from plugin import http_client
+from store import gateways
+from store import models as store_models
+from store import payments
+from userauths import models as userauths_models
+
+
+# Load test of checkout, end to end through the views and against the fake gateway (STORE_FAKE_GATEWAY), so it
+# needs no network. --concurrency customers (benchmark-<n>@example.com, created on the first run) check out
+# --orders orders between them, every order goes:
+#   add_to_cart -> create_order -> payment_session -> the fake gateway's payment page -> the redirect page ->
+#   payment_status, polled until the payment worker (process_events, run here in a thread) records the outcome
+# The orders are real: they take stock and notify the vendor -> run it against a test database.
+class Command(BaseCommand):
+    help = "Benchmark checkout throughput against the fake payment gateway (STORE_FAKE_GATEWAY=True)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, default=100)
+        parser.add_argument("--concurrency", type=int, default=10, help="Customers checking out at the same time")
+        parser.add_argument("--gateway", default="Stripe", choices=sorted(gateways.GATEWAYS))
+        parser.add_argument("--product", type=int, help="Id of the product to order, by default the first published one in stock")
+        parser.add_argument("--latency-ms", type=int, help="Overrides FAKE_GATEWAY_LATENCY_MS of the in-process fake gateway")
+        parser.add_argument("--failure-rate", type=float, help="Overrides FAKE_GATEWAY_FAILURE_RATE of the in-process fake gateway")
+        parser.add_argument("--decline-rate", type=float, help="Overrides FAKE_GATEWAY_DECLINE_RATE of the in-process fake gateway")
+        parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for the outcome of a payment")
+
+    def handle(self, *args, **options):
+        if not settings.STORE_FAKE_GATEWAY:
+            raise CommandError("Set STORE_FAKE_GATEWAY=True, the benchmark never pays through a real gateway")
+        if not settings.FAKE_GATEWAY_URL:
+            fake_gateway.start(options["latency_ms"], options["failure_rate"], options["decline_rate"])
+
+        products = store_models.Product.objects.filter(status="Published", stock__gte=options["orders"])
+        product = products.filter(id=options["product"]).first() if options["product"] else products.order_by('id').first()
+        if product is None:
+            raise CommandError(f"No published product with {options['orders']} items in stock")
+
+        self.options = options
+        self.product = product
+        self.host = next((host.lstrip(".") for host in settings.ALLOWED_HOSTS if host != "*"), "localhost")
+        customers = [self.customer(n) for n in range(options["concurrency"])]
+        share = [options["orders"] // len(customers) + (n < options["orders"] % len(customers)) for n in range(len(customers))]
+
+        stop = threading.Event()
+        worker = threading.Thread(target=self.payment_worker, args=(stop,), daemon=True)
+        worker.start()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(customers)) as executor:
+            results = [result for batch in executor.map(self.checkout_many, customers, share) for result in batch]
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        worker.join()
+        self.report(results, elapsed)
+
+    def customer(self, n):
+        user, created = userauths_models.User.objects.get_or_create(email=f"benchmark-{n}@example.com")
+        if created:
+            user.set_unusable_password()
+            user.save()
+        address, _ = customer_models.Address.objects.get_or_create(
+            user=user, defaults={"full_name": f"Benchmark {n}", "email": user.email, "country": "United States"}
+        )
+        return user, address
+
+    # The payment worker, as `manage.py process_payment_events --poll`
+    def payment_worker(self, stop):
+        try:
+            while not stop.is_set():
+                if not payments.process_events():
+                    time.sleep(0.05)
+        finally:
+            connection.close()
+
+    def checkout_many(self, customer, count):
+        try:
+            return [self.checkout(*customer) for _ in range(count)]
+        finally:
+            connection.close() # -> the thread's own database connection
+
+    # Returns (outcome, seconds) - outcome is "paid", "failed", "timeout" or the step that went wrong
+    def checkout(self, user, address):
+        client = Client(HTTP_HOST=self.host)
+        client.force_login(user)
+        cart_id = str(random.randint(10 ** 9, 10 ** 10))
+        started = time.perf_counter()
+
+        response = client.get(reverse("store:add_to_cart"), {"id": self.product.id, "qty": 1, "cart_id": cart_id})
+        if response.status_code != 200:
+            return "add_to_cart failed", time.perf_counter() - started
+
+        response = client.post(reverse("store:create_order"), {"address": address.id})
+        order_id = response.url.rstrip("/").rsplit("/", 1)[-1] if response.status_code == 302 else None
+        if order_id is None or response.url != reverse("store:checkout", args=[order_id]): # -> sent back to the cart
+            return "create_order failed", time.perf_counter() - started
+
+        response = client.post(reverse("store:payment_session", args=[self.options["gateway"], order_id]))
+        if response.status_code != 200:
+            return "payment_session failed", time.perf_counter() - started
+
+        # the customer pays on the gateway's page, which sends them back to the redirect page
+        try:
+            paid = requests.get(response.json()["redirect_url"], allow_redirects=False, timeout=self.options["timeout"])
+        except requests.RequestException:
+            return "payment page failed", time.perf_counter() - started
+        if paid.status_code != 302:
+            return "payment page failed", time.perf_counter() - started
+        return_url = urlsplit(paid.headers["Location"])
+        client.get(return_url.path + "?" + return_url.query)
+
+        deadline = time.monotonic() + self.options["timeout"]
+        while time.monotonic() < deadline:
+            payment_status = client.get(reverse("store:payment_status", args=[order_id]), {"format": "json"}).json()["payment_status"]
+            if payment_status != "pending":
+                return payment_status, time.perf_counter() - started
+            time.sleep(0.05)
+        return "timeout", time.perf_counter() - started
+
+    def report(self, results, elapsed):
+        outcomes = {}
+        for outcome, _ in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        seconds = sorted(seconds for outcome, seconds in results if outcome == "paid")
+
+        self.stdout.write(self.style.SUCCESS(f"{len(results)} checkouts in {elapsed:.1f}s -> {len(results) / elapsed:.1f} orders/s"))
+        self.stdout.write("Outcomes: " + ", ".join(f"{outcome} {count}" for outcome, count in sorted(outcomes.items())))
+        if seconds:
+            p50, p95 = seconds[len(seconds) // 2], seconds[min(int(len(seconds) * 0.95), len(seconds) - 1)]
+            self.stdout.write(f"Paid checkout: avg {statistics.mean(seconds):.3f}s, p50 {p50:.3f}s, p95 {p95:.3f}s, max {seconds[-1]:.3f}s")
+        for name, metrics in http_client.stats().items():
+            self.stdout.write(f"{name}: {metrics}")
@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from plugin import fake_gateway
+
+
+# Runs the fake payment gateway (plugin/fake_gateway.py) on its own, for load tests against several web / worker
+# processes - they reach it through FAKE_GATEWAY_URL (and STORE_FAKE_GATEWAY=True), sessions are shared that way.
+class Command(BaseCommand):
+    help = "Run the fake payment gateway used for load testing (STORE_FAKE_GATEWAY)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency-ms", type=int, default=settings.FAKE_GATEWAY_LATENCY_MS)
+        parser.add_argument("--failure-rate", type=float, default=settings.FAKE_GATEWAY_FAILURE_RATE)
+        parser.add_argument("--decline-rate", type=float, default=settings.FAKE_GATEWAY_DECLINE_RATE)
+
+    def handle(self, *args, **options):
+        server = fake_gateway.start(options["latency_ms"], options["failure_rate"], options["decline_rate"], host=options["host"], port=options["port"])
+        self.stdout.write(self.style.SUCCESS(f"Fake gateway running at {server.url} - set FAKE_GATEWAY_URL={server.url}"))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from store.cart import flush_carts
+
+
+class Command(BaseCommand):
+    help = "Write the carts changed in the cache since the last flush to the Cart table (run it periodically, e.g. every few minutes)"
+
+    def handle(self, *args, **options):
+        flushed = flush_carts()
+        self.stdout.write(self.style.SUCCESS(f"Flushed {flushed} carts"))
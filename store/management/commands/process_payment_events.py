@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store import payments
+
+
+# The payment worker - records the outcome of webhooks and redirect checks waiting in the payment inbox.
+# Run it with --poll to keep it running as a worker process, or without from a scheduler every few seconds.
+class Command(BaseCommand):
+    help = "Process received payment webhooks and checks (store/payments.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--poll", type=float, default=0, help="Keep running, looking for new events every this many seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            processed = payments.process_events(batch_size=options["batch_size"])
+            if processed or not options["poll"]:
+                self.stdout.write(self.style.SUCCESS(f"Processed {processed} payment events"))
+            if not options["poll"]:
+                return
+            time.sleep(options["poll"])
@@ -0,0 +1,71 @@
+import time
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.utils import timezone
+
+from store import models as store_models
+
+
+# Deletes abandoned carts (no line of the cart_id changed for --days) and expired sessions.
+# Rows go in primary key ranges of --batch-size, each range in its own short transaction, so the job never
+# holds a long write lock and can run while customers are shopping; --sleep leaves room between batches.
+class Command(BaseCommand):
+    help = "Delete carts idle for longer than STORE_CART_TTL_DAYS and expired sessions, in small batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.STORE_CART_TTL_DAYS)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--sleep", type=float, default=0, help="Seconds to pause between batches")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        carts, lines = self.purge_carts(cutoff, options["batch_size"], options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {lines} lines of {carts} carts idle since {cutoff:%Y-%m-%d %H:%M}"))
+
+        sessions = self.purge_sessions(options["batch_size"], options["sleep"])
+        if sessions is None:
+            self.stdout.write("Expired sessions cleared by the session engine")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Deleted {sessions} expired sessions"))
+
+    def purge_carts(self, cutoff, batch_size, pause):
+        # a line goes only when every line of its cart is stale -> a cart that is still being edited stays whole
+        active = store_models.Cart.objects.filter(cart_id=models.OuterRef('cart_id'), updated__gte=cutoff)
+        stale = store_models.Cart.objects.filter(updated__lt=cutoff).exclude(models.Exists(active))
+
+        bounds = stale.aggregate(low=models.Min('id'), high=models.Max('id'))
+        if bounds["low"] is None:
+            return 0, 0
+
+        carts, lines = set(), 0
+        for start in range(bounds["low"], bounds["high"] + 1, batch_size):
+            with transaction.atomic():
+                batch = stale.filter(id__gte=start, id__lt=start + batch_size)
+                carts.update(batch.values_list('cart_id', flat=True))
+                deleted, _ = batch.delete()
+            lines += deleted
+            if pause:
+                time.sleep(pause)
+
+        return len(carts), lines
+
+    def purge_sessions(self, batch_size, pause):
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        if not hasattr(session_store, "get_model_class"): # -> cache / cookie / file sessions expire on their own terms
+            session_store.clear_expired()
+            return None
+
+        expired = session_store.get_model_class().objects.filter(expire_date__lt=timezone.now())
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                keys = list(expired.values_list('pk', flat=True)[:batch_size])
+                if not keys:
+                    return deleted
+                deleted += expired.filter(pk__in=keys).delete()[0]
+            if pause:
+                time.sleep(pause)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from store import models as store_models
+
+
+class Command(BaseCommand):
+    help = "Rebuild the shop facet index (category, color, size, rating and price band) for every product"
+
+    def handle(self, *args, **options):
+        products = store_models.Product.objects.select_related('category')
+
+        for product in products.iterator(chunk_size=500):
+            product.update_facets()
+
+        total = store_models.ProductFacet.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} facet rows for {products.count()} products"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.db.models.functions import Coalesce, Now
+
+from store import models as store_models
+
+
+class Command(BaseCommand):
+    help = "Rebuild Product.rating_avg and Product.review_count from the active reviews in a single statement"
+
+    def handle(self, *args, **options):
+        # -> one correlated subquery per column, so every product is rebuilt in one UPDATE
+        active_reviews = (
+            store_models.Review.objects
+            .filter(product=models.OuterRef('pk'), active=True)
+            .order_by()
+            .values('product')
+        )
+        rating_avg = active_reviews.annotate(avg=models.Avg('rating')).values('avg')
+        review_count = active_reviews.annotate(count=models.Count('id')).values('count')
+
+        updated = store_models.Product.objects.update(
+            rating_avg=Coalesce(models.Subquery(rating_avg, output_field=models.FloatField()), models.Value(0.0)),
+            review_count=Coalesce(models.Subquery(review_count, output_field=models.IntegerField()), models.Value(0)),
+            updated=Now(), # -> invalidates the cached product cards
+        )
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt ratings for {updated} products"))
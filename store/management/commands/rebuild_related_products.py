@@ -0,0 +1,38 @@
+from collections import Counter
+from itertools import groupby, permutations
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store import models as store_models
+
+
+class Command(BaseCommand):
+    help = "Rebuild the co-purchase related products table from every paid order"
+
+    def handle(self, *args, **options):
+        items = (
+            store_models.OrderItem.objects
+            .filter(order__payment_status="Paid")
+            .order_by('order_id')
+            .values_list('order_id', 'product_id')
+            .distinct()
+        )
+
+        pairs = Counter()
+        for order_id, rows in groupby(items.iterator(), key=lambda row: row[0]):
+            product_ids = {product_id for _, product_id in rows}
+            pairs.update(permutations(product_ids, 2))
+
+        # -> keep the strongest pairs of every product only, same cap as the incremental updates
+        kept = {}
+        for (product_id, related_id), score in pairs.most_common():
+            kept.setdefault(product_id, [])
+            if len(kept[product_id]) < store_models.RelatedProduct.KEEP:
+                kept[product_id].append(store_models.RelatedProduct(product_id=product_id, related_id=related_id, score=score))
+
+        with transaction.atomic():
+            store_models.RelatedProduct.objects.all().delete()
+            store_models.RelatedProduct.objects.bulk_create([row for rows in kept.values() for row in rows], batch_size=1000)
+
+        self.stdout.write(self.style.SUCCESS(f"Stored {sum(len(rows) for rows in kept.values())} related product pairs"))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store import models as store_models
+from store import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text product search index from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        if backend is None:
+            raise CommandError("No full-text search backend for this database, searches fall back to name__icontains")
+
+        backend.clear()
+
+        batch, total = [], 0
+        for product in store_models.Product.objects.select_related('category', 'vendor__vendor').iterator(chunk_size=options["batch_size"]):
+            batch.append(product)
+            if len(batch) == options["batch_size"]:
+                backend.index(batch)
+                total += len(batch)
+                batch = []
+
+        if batch:
+            backend.index(batch)
+            total += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} products with {backend.__class__.__name__}"))
@@ -0,0 +1,40 @@
+# Generated by Django 4.2 on 2026-10-18 08:33
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+# -> every product in one UPDATE with correlated subqueries, as `manage.py rebuild_ratings` does
+def backfill_ratings(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Review = apps.get_model('store', 'Review')
+
+    active_reviews = Review.objects.filter(product=models.OuterRef('pk'), active=True).order_by().values('product')
+    rating_avg = active_reviews.annotate(avg=models.Avg('rating')).values('avg')
+    review_count = active_reviews.annotate(count=models.Count('id')).values('count')
+
+    Product.objects.update(
+        rating_avg=Coalesce(models.Subquery(rating_avg, output_field=models.FloatField()), models.Value(0.0)),
+        review_count=Coalesce(models.Subquery(review_count, output_field=models.IntegerField()), models.Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_avg',
+            field=models.FloatField(default=0, verbose_name='Average Rating'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_ratings, migrations.RunPython.noop),
+    ]
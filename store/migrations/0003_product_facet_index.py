@@ -0,0 +1,63 @@
+# Generated by Django 4.2 on 2026-10-18 08:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from store.models import RATING, price_band
+
+
+# -> the same rows Product.update_facets() writes, for every product already in the shop
+def backfill_facets(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    VariantItem = apps.get_model('store', 'VariantItem')
+    ProductFacet = apps.get_model('store', 'ProductFacet')
+
+    variants = {}
+    items = VariantItem.objects.filter(variant__product__status="Published", variant__name__in=["Color", "Size"], content__isnull=False)
+    for product_id, name, title, content in items.values_list('variant__product_id', 'variant__name', 'title', 'content').distinct():
+        variants.setdefault(product_id, []).append((name, content, title or content))
+
+    rows = []
+    for product in Product.objects.filter(status="Published").select_related('category').iterator(chunk_size=500):
+        facets = [("Price", *price_band(product.price))]
+        if product.category_id:
+            facets.append(("Category", str(product.category_id), product.category.title))
+        if product.review_count:
+            stars = max(1, int(product.rating_avg))
+            facets.append(("Rating", str(stars), dict(RATING)[stars]))
+        facets += variants.get(product.id, [])
+
+        rows += [ProductFacet(product_id=product.id, facet=facet, value=value[:100], label=(label or "")[:100]) for facet, value, label in facets]
+        if len(rows) >= 1000:
+            ProductFacet.objects.bulk_create(rows, ignore_conflicts=True)
+            rows = []
+    ProductFacet.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(choices=[('Category', 'Category'), ('Color', 'Color'), ('Size', 'Size'), ('Rating', 'Rating'), ('Price', 'Price')], max_length=20)),
+                ('value', models.CharField(max_length=100)),
+                ('label', models.CharField(blank=True, default='', max_length=100)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='store.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='productfacet',
+            index=models.Index(fields=['facet', 'value', 'product'], name='store_produ_facet_9358fb_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='productfacet',
+            unique_together={('product', 'facet', 'value')},
+        ),
+        migrations.RunPython(backfill_facets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2 on 2026-10-18 08:36
+
+from django.db import migrations
+
+from store import search
+
+# Full-text tables used by store/search.py - only the one matching the database vendor is created
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS store_product_fts USING fts5(name, description, category, vendor, tokenize = 'porter unicode61')",
+]
+SQLITE_REVERSE = [
+    "DROP TABLE IF EXISTS store_product_fts",
+]
+
+POSTGRES_FORWARD = [
+    "CREATE TABLE IF NOT EXISTS store_product_search (product_id bigint PRIMARY KEY REFERENCES store_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS store_product_search_document_gin ON store_product_search USING GIN (document)",
+]
+POSTGRES_REVERSE = [
+    "DROP TABLE IF EXISTS store_product_search",
+]
+
+
+# -> index the products already in the shop, same as `manage.py rebuild_search_index`
+def backfill_index(apps, schema_editor):
+    backend = search.get_backend()
+    if backend is None:
+        return
+
+    Product = apps.get_model('store', 'Product')
+    batch = []
+    for product in Product.objects.select_related('category', 'vendor__vendor').iterator(chunk_size=500):
+        batch.append(product)
+        if len(batch) == 500:
+            backend.index(batch)
+            batch = []
+    if batch:
+        backend.index(batch)
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, []):
+            schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_product_facet_index'),
+        ('vendor', '0001_initial'), # -> the vendor store names are indexed
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            run({"sqlite": SQLITE_REVERSE, "postgresql": POSTGRES_REVERSE}),
+        ),
+        migrations.RunPython(backfill_index, migrations.RunPython.noop),
+    ]
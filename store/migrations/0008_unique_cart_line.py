@@ -0,0 +1,42 @@
+# Generated by Django 4.2 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+def dedupe_cart_lines(apps, schema_editor):
+    Cart = apps.get_model('store', 'Cart')
+
+    Cart.objects.filter(size__isnull=True).update(size="")
+    Cart.objects.filter(color__isnull=True).update(color="")
+
+    # racing add_to_cart calls left duplicate lines behind -> keep the most recent one of each
+    duplicates = Cart.objects.values('cart_id', 'product', 'size', 'color').annotate(keep=models.Max('id'), count=models.Count('id')).filter(count__gt=1)
+    for line in duplicates:
+        Cart.objects.filter(cart_id=line['cart_id'], product=line['product'], size=line['size'], color=line['color']).exclude(id=line['keep']).delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_cart_lines, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='cart',
+            name='store_cart_cart_id_385511_idx',
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='color',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='size',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('cart_id', 'product', 'size', 'color'), name='unique_cart_line'),
+        ),
+    ]
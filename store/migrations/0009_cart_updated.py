@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+def backfill_updated(apps, schema_editor):
+    # -> the only known activity of existing lines is when they were added, otherwise every old cart would look fresh
+    Cart = apps.get_model('store', 'Cart')
+    Cart.objects.update(updated=models.F('date'))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_unique_cart_line'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_updated, migrations.RunPython.noop),
+    ]
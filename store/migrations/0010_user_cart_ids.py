@@ -0,0 +1,29 @@
+# Generated by Django 4.2 on 2026-10-18 08:48
+
+from django.db import migrations
+
+def key_carts_by_user(apps, schema_editor):
+    # logged in customers now have a single cart keyed "user-<id>" -> fold their lines from every browser into it,
+    # keeping the most recently changed line when the same product variant was added on several devices
+    Cart = apps.get_model('store', 'Cart')
+
+    seen = set()
+    for line in Cart.objects.filter(user__isnull=False).order_by('-updated', '-id').iterator():
+        key = (line.user_id, line.product_id, line.size, line.color)
+        if key in seen:
+            line.delete()
+        else:
+            seen.add(key)
+
+    for user_id in Cart.objects.filter(user__isnull=False).values_list('user_id', flat=True).distinct():
+        Cart.objects.filter(user_id=user_id).update(cart_id=f"user-{user_id}")
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_cart_updated'),
+    ]
+
+    operations = [
+        migrations.RunPython(key_carts_by_user, migrations.RunPython.noop),
+    ]
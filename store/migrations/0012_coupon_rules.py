@@ -0,0 +1,89 @@
+# Generated by Django 4.2 on 2026-10-18 08:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rename_duplicate_codes(apps, schema_editor):
+    # a vendor may have created the same code twice -> the oldest keeps it, the others get their id appended
+    Coupon = apps.get_model('store', 'Coupon')
+
+    duplicates = Coupon.objects.values('vendor', 'code').annotate(first=models.Min('id'), count=models.Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        for coupon in Coupon.objects.filter(vendor=duplicate['vendor'], code=duplicate['code']).exclude(id=duplicate['first']):
+            suffix = f"-{coupon.id}"
+            coupon.code = coupon.code[:100 - len(suffix)] + suffix # -> still fits max_length=100
+            coupon.save(update_fields=['code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0011_stock_holds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('used', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses',
+            field=models.PositiveIntegerField(blank=True, help_text='Leave empty for unlimited redemptions', null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses_per_user',
+            field=models.PositiveIntegerField(blank=True, help_text='Leave empty for unlimited redemptions per customer', null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='min_basket',
+            field=models.DecimalField(decimal_places=2, default=0.0, help_text="Minimum total of the vendor's items in the order", max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='used',
+            field=models.PositiveIntegerField(default=0, help_text='Redemptions so far (only counted when max uses is set)'),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_to',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(rename_duplicate_codes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='coupon',
+            constraint=models.UniqueConstraint(fields=('vendor', 'code'), name='unique_coupon_code_per_vendor'),
+        ),
+        migrations.AddField(
+            model_name='couponusage',
+            name='coupon',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usages', to='store.coupon'),
+        ),
+        migrations.AddField(
+            model_name='couponusage',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='couponusage',
+            constraint=models.UniqueConstraint(fields=('coupon', 'user'), name='unique_coupon_usage'),
+        ),
+    ]
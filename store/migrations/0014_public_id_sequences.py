@@ -0,0 +1,53 @@
+# Generated by Django 4.2 on 2026-10-18 08:57
+
+from django.db import migrations, models
+import store.ids
+
+def renumber_duplicate_ids(apps, schema_editor):
+    # random 6 digit ids have collided -> the oldest row keeps its id, the others get the next ids of the sequence
+    IdSequence = apps.get_model('store', 'IdSequence')
+
+    for model_name, field, sequence in (('Order', 'order_id', 'order'), ('OrderItem', 'item_id', 'order_item')):
+        Model = apps.get_model('store', model_name)
+        next_value = store.ids.FIRST_ID
+
+        duplicates = Model.objects.values(field).annotate(first=models.Min('id'), count=models.Count('id')).filter(count__gt=1)
+        for duplicate in duplicates:
+            for row in Model.objects.filter(**{field: duplicate[field]}).exclude(id=duplicate['first']):
+                setattr(row, field, str(next_value))
+                row.save(update_fields=[field])
+                next_value += 1
+
+        IdSequence.objects.create(name=sequence, next_value=next_value)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_payment_attempts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField()),
+            ],
+        ),
+        migrations.RunPython(renumber_duplicate_ids, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='orderitem',
+            name='store_order_item_id_7ef887_idx',
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='order_id',
+            field=models.CharField(default=store.ids.new_order_id, editable=False, max_length=25, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='item_id',
+            field=models.CharField(default=store.ids.new_item_id, editable=False, max_length=25, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_exchange_rates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='payment_status',
+            field=models.CharField(choices=[('Paid', 'Paid'), ('Processing', 'Processing'), ('Failed', 'Failed'), ('Refunded', 'Refunded')], default='Processing', max_length=100),
+        ),
+    ]
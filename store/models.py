@@ -5,6 +5,7 @@ from django.utils.text import slugify
 from django_ckeditor_5.fields import CKEditor5Field
 
 from userauths import models as user_models
+from store import ids
 # from vendor import models as vendor_models
 
 import shortuuid
@@ -21,6 +22,7 @@ PAYMENT_STATUS = (
     ("Paid", "Paid"),
     ("Processing", "Processing"),
     ("Failed", 'Failed'),
+    ("Refunded", "Refunded"),
 )
 
 PAYMENT_METHOD = (
@@ -53,9 +55,48 @@ RATING = (
     ( 4,  "★★★★☆"),
     ( 5,  "★★★★★"),
 )
+
+FACET_TYPE = (
+    ("Category", "Category"),
+    ("Color", "Color"),
+    ("Size", "Size"),
+    ("Rating", "Rating"),
+    ("Price", "Price"),
+)
+
+# (value, label, lower bound, upper bound) - upper bound is exclusive, None means no limit
+PRICE_BAND = (
+    ("0-25", "Under $25", 0, 25),
+    ("25-50", "$25 to $50", 25, 50),
+    ("50-100", "$50 to $100", 50, 100),
+    ("100-250", "$100 to $250", 100, 250),
+    ("250+", "$250 & Above", 250, None),
+)
+HOLD_STATUS = (
+    ("Held", "Held"),
+    ("Committed", "Committed"),
+    ("Released", "Released"),
+)
+EVENT_STATUS = (
+    ("Received", "Received"),
+    ("Processing", "Processing"),
+    ("Processed", "Processed"),
+    ("Ignored", "Ignored"),
+    ("Failed", "Failed"),
+)
+ATTEMPT_STATUS = (
+    ("Pending", "Pending"),
+    ("Paid", "Paid"),
+    ("Failed", "Failed"),
+)
 #*****
 #!
 
+def price_band(price):
+    for value, label, low, high in PRICE_BAND:
+        if (price or 0) >= low and (high is None or (price or 0) < high):
+            return value, label
+
 class Category(models.Model):
     title = models.CharField(max_length=100)
     image = models.ImageField(upload_to="images", default="category.jpg", null=True, blank=True)
@@ -70,6 +111,30 @@ class Category(models.Model):
     def products(self):
         return Product.objects.filter(category=self)
     
+# Listing, detail and dashboard pages each get one queryset that already knows which relations
+# their templates touch, so the number of queries per page does not grow with the number of products
+class ProductQuerySet(models.QuerySet):
+    def published(self):
+        return self.filter(status="Published")
+
+    # product cards -> image, name, price, category title and the denormalized rating
+    def for_listing(self):
+        return self.select_related('category', 'vendor')
+
+    # product detail page -> gallery, variants with their items and the reviews with their authors
+    def for_detail(self):
+        return self.select_related('category', 'vendor').prefetch_related(
+            'gallery_set',
+            models.Prefetch('variant_set', queryset=Variant.objects.prefetch_related('variant_items')),
+            models.Prefetch('reviews', queryset=Review.objects.filter(active=True).select_related('user')),
+        )
+
+    # vendor dashboard and products page -> card data plus the number of order items of each product
+    def for_vendor_dashboard(self):
+        return self.select_related('category').annotate(
+            vendor_order_count=models.Count('orderitem', filter=models.Q(orderitem__vendor=models.F('vendor')))
+        ).order_by('-id') # -> GROUP BY drops Meta.ordering, so restate it for the paginator
+
 class Product(models.Model):
     name = models.CharField(max_length=100)
     image = models.FileField(upload_to="images", blank=True, null=True, default="product.jpg")
@@ -92,30 +157,98 @@ class Product(models.Model):
     sku = ShortUUIDField(unique=True, length=5, max_length=50, prefix="SKU", alphabet="1234567890") # type: ignore
     slug = models.SlugField(null=True, blank=True)
     
+    # denormalized from the active reviews - kept current by the review signals in store/signals.py
+    # so listings can read the rating without running an aggregate per product card
+    rating_avg = models.FloatField(default=0, verbose_name="Average Rating")
+    review_count = models.PositiveIntegerField(default=0)
+
     date = models.DateTimeField(default=timezone.now)
+    # moved forward on every change that shows on the product card/page - used as the fragment cache version
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = ProductQuerySet.as_manager()
 
     class Meta:
         ordering = ['-id']
         verbose_name_plural = "Products"
+        indexes = [
+            models.Index(fields=['status', 'category']), # published listings and category pages (vendor is covered by its FK index)
+        ]
 
     def __str__(self):
         return self.name
     
+    # the average of the active reviews, 0 when there is none (templates format it with floatformat)
     def average_rating(self):
-        return Review.objects.filter(product=self).aggregate(avg_rating=models.Avg('rating'))['avg_rating']
+        return self.rating_avg if self.review_count else 0
+
+    # recalculates rating_avg and review_count from the active reviews of this product
+    def update_rating(self):
+        stats = Review.objects.filter(product=self, active=True).aggregate(avg=models.Avg('rating'), count=models.Count('id'))
+        self.rating_avg = stats['avg'] or 0
+        self.review_count = stats['count']
+        # update() instead of save() so the rest of the row (stock, price etc) is never overwritten
+        Product.objects.filter(pk=self.pk).update(rating_avg=self.rating_avg, review_count=self.review_count, updated=timezone.now())
+
+    # "customers also bought" first, then the best rated products of the same category to fill the list
+    def related_products(self, limit=8):
+        related = list(
+            Product.objects.published().for_listing()
+            .filter(related_to__product=self)
+            .order_by('-related_to__score', '-related_to__id')[:limit]
+        )
+
+        if len(related) < limit and self.category_id: # type: ignore
+            neighbours = (
+                Product.objects.published().for_listing()
+                .filter(category_id=self.category_id) # type: ignore
+                .exclude(id__in=[self.pk] + [p.pk for p in related])
+                .order_by('-rating_avg', '-id')
+            )
+            related += list(neighbours[:limit - len(related)])
+
+        return related
+
+    @property
+    def cache_version(self):
+        return int(self.updated.timestamp() * 1000000) if self.updated else 0
     
-    def reviews(self):
-        return Review.objects.filter(product=self)
-
+    # these go through the related managers so they are served from the for_detail() prefetch cache
     def gallery(self):
-        return Gallery.objects.filter(product=self)
+        return self.gallery_set.all() # type: ignore
   
     def variants(self):
-        return Variant.objects.filter(product=self)
+        return self.variant_set.all() # type: ignore
 
     def vendor_orders(self):
         return OrderItem.objects.filter(product=self, vendor=self.vendor)
 
+    # rewrites the rows of this product in the facet index used by the shop sidebar and filter
+    def update_facets(self):
+        facets = []
+
+        if self.status == "Published":
+            if self.category_id: # type: ignore
+                facets.append(("Category", str(self.category_id), self.category.title)) # type: ignore
+
+            band, band_label = price_band(self.price) # type: ignore
+            facets.append(("Price", band, band_label))
+
+            # -> same star count the product cards display for this average
+            if self.review_count:
+                stars = max(1, int(self.rating_avg))
+                facets.append(("Rating", str(stars), dict(RATING)[stars]))
+
+            items = VariantItem.objects.filter(variant__product=self, variant__name__in=["Color", "Size"], content__isnull=False)
+            for name, title, content in items.values_list('variant__name', 'title', 'content').distinct():
+                facets.append((name, content, title or content))
+
+        ProductFacet.objects.filter(product=self).delete()
+        ProductFacet.objects.bulk_create(
+            [ProductFacet(product=self, facet=facet, value=value[:100], label=(label or "")[:100]) for facet, value, label in facets],
+            ignore_conflicts=True,
+        )
+
     # for slugify the product name and generating a random characters
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -128,7 +261,7 @@ class Variant(models.Model):
     name = models.CharField(max_length=1000, verbose_name="Variant Name", null=True, blank=True)
 
     def items(self):
-        return VariantItem.objects.filter(variant=self)
+        return self.variant_items.all() # type: ignore
     
     def __str__(self):
         return self.name
@@ -152,6 +285,81 @@ class Gallery(models.Model):
     class Meta:
         verbose_name_plural = "Gallery"
         
+class ProductFacetQuerySet(models.QuerySet):
+    # ids of the products carrying any of the given values for one facet - used as an IN (subquery) filter
+    def product_ids(self, facet, values):
+        return self.filter(facet=facet, value__in=values).values('product_id')
+
+    # sidebar entries for one facet -> [{"content": value, "title": label, "count": n}, ...]
+    def counts(self, facet):
+        return (
+            self.filter(facet=facet)
+            .values(content=models.F('value'), title=models.F('label'))
+            .annotate(count=models.Count('product_id'))
+            .order_by('title')
+        )
+
+# Precomputed facet index for the shop, one row per (product, facet value)
+# The rows are rewritten by Product.update_facets() whenever a product, its variants or its reviews change
+class ProductFacet(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="facets")
+    facet = models.CharField(max_length=20, choices=FACET_TYPE)
+    value = models.CharField(max_length=100)
+    label = models.CharField(max_length=100, blank=True, default="")
+
+    objects = ProductFacetQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['product', 'facet', 'value']
+        indexes = [models.Index(fields=['facet', 'value', 'product'])] # covers the product_ids() subquery
+
+    def __str__(self):
+        return f"{self.facet}: {self.value}"
+
+class RelatedProductQuerySet(models.QuerySet):
+    # counts every pair of different products bought together in a paid order
+    def record_order(self, order):
+        product_ids = set(OrderItem.objects.filter(order=order).values_list('product_id', flat=True))
+        if len(product_ids) < 2:
+            return
+
+        # -> pairs already known: one UPDATE covers all of them since both ends are products of this order
+        pairs = self.filter(product_id__in=product_ids, related_id__in=product_ids)
+        existing = set(pairs.values_list('product_id', 'related_id'))
+        pairs.update(score=models.F('score') + 1)
+
+        self.bulk_create(
+            [RelatedProduct(product_id=a, related_id=b, score=1) for a in product_ids for b in product_ids if a != b and (a, b) not in existing],
+            ignore_conflicts=True,
+        )
+
+        for product_id in product_ids:
+            self.trim(product_id)
+
+    # keep only the strongest pairs of a product so the table stays bounded
+    def trim(self, product_id, keep=None):
+        keep = keep or RelatedProduct.KEEP
+        stale = self.filter(product_id=product_id).order_by('-score', '-id').values_list('id', flat=True)[keep:]
+        self.filter(id__in=list(stale)).delete()
+
+# Co-purchase table behind the "Related Products" of the product detail page
+# Each row says "related was bought in the same order as product, score times"
+class RelatedProduct(models.Model):
+    KEEP = 50 # pairs kept per product - more than the page shows, so newer pairs can still climb the list
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="related_from")
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="related_to")
+    score = models.PositiveIntegerField(default=0)
+
+    objects = RelatedProductQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['product', 'related']
+        indexes = [models.Index(fields=['product', '-score'])]
+
+    def __str__(self):
+        return f"{self.product} -> {self.related} ({self.score})"
+
 class Cart(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     user = models.ForeignKey(user_models.User, on_delete=models.SET_NULL, null=True, blank=True)
@@ -161,23 +369,61 @@ class Cart(models.Model):
     shipping = models.DecimalField(decimal_places=2, max_digits=12, default=0.00, null=True, blank=True) # type: ignore
     tax = models.DecimalField(decimal_places=2, max_digits=12, default=0.00, null=True, blank=True) # type: ignore
     total = models.DecimalField(decimal_places=2, max_digits=12, default=0.00, null=True, blank=True) # type: ignore
-    size = models.CharField(max_length=100, null=True, blank=True)
-    color = models.CharField(max_length=100, null=True, blank=True)
+    size = models.CharField(max_length=100, blank=True, default="") # -> "" rather than NULL so the unique constraint below sees "no size" as one value
+    color = models.CharField(max_length=100, blank=True, default="")
     cart_id = models.CharField(max_length=1000, null=True, blank=True)
     date = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True) # -> last change of the line, purge_carts drops carts idle for too long
+
+    class Meta:
+        constraints = [
+            # one line per product variant in a cart -> add_to_cart upserts against it (its index also serves the cart_id lookups)
+            models.UniqueConstraint(fields=['cart_id', 'product', 'size', 'color'], name='unique_cart_line'),
+        ]
 
     def __str__(self):
         return f'{self.cart_id} - {self.product.name}'
 
 # used for coupons and discounts
+# Coupon rules are checked and redeemed in store/coupons.py
 class Coupon(models.Model):
     vendor = models.ForeignKey(user_models.User, on_delete=models.SET_NULL, null=True)
     code = models.CharField(max_length=100)
     discount = models.IntegerField(default=1)
+    active = models.BooleanField(default=True)
+    valid_from = models.DateTimeField(null=True, blank=True)
+    valid_to = models.DateTimeField(null=True, blank=True)
+    min_basket = models.DecimalField(max_digits=12, decimal_places=2, default=0.00, help_text="Minimum total of the vendor's items in the order") # type: ignore
+    max_uses = models.PositiveIntegerField(null=True, blank=True, help_text="Leave empty for unlimited redemptions")
+    max_uses_per_user = models.PositiveIntegerField(null=True, blank=True, help_text="Leave empty for unlimited redemptions per customer")
+    used = models.PositiveIntegerField(default=0, help_text="Redemptions so far (only counted when max uses is set)")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['code']), # coupon_apply looks coupons up by code
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['vendor', 'code'], name='unique_coupon_code_per_vendor'),
+        ]
     
     def __str__(self):
         return self.code
 
+
+# Redemptions of a coupon by one customer - only kept for coupons with a per customer limit
+class CouponUsage(models.Model):
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name="usages")
+    user = models.ForeignKey(user_models.User, on_delete=models.CASCADE)
+    used = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['coupon', 'user'], name='unique_coupon_usage'),
+        ]
+
+    def __str__(self):
+        return f"{self.coupon.code} used {self.used} times by {self.user}"
+
 class Order(models.Model):
     vendors = models.ManyToManyField(user_models.User, blank=True)
     customer = models.ForeignKey(user_models.User, on_delete=models.SET_NULL, null=True, related_name="customer", blank=True)
@@ -194,13 +440,16 @@ class Order(models.Model):
     address = models.ForeignKey("customer.Address", on_delete=models.SET_NULL, null=True) # the address should come from the customer profile
     # the addres should come during create order in the views.py file - though you can create it but comment it to
     coupons = models.ManyToManyField(Coupon, blank=True)
-    order_id = ShortUUIDField(length=6, max_length=25, alphabet="1234567890") # type: ignore
+    order_id = models.CharField(max_length=25, unique=True, default=ids.new_order_id, editable=False) # -> allocated from a sequence, see store/ids.py
     payment_id = models.CharField(null=True, blank=True, max_length=1000)
     date = models.DateTimeField(default=timezone.now)
     
     class Meta:
         verbose_name_plural = "Order"
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['customer', '-date']), # customer dashboard and order list
+        ]
 
     def __str__(self):
         return self.order_id
@@ -227,7 +476,7 @@ class OrderItem(models.Model):
     saved = models.DecimalField(max_digits=12, decimal_places=2, default=0.00, null=True, blank=True, help_text="Amount saved by customer") # type: ignore       
     coupon = models.ManyToManyField(Coupon, blank=True)
     applied_coupon = models.BooleanField(default=False)
-    item_id = ShortUUIDField(length=6, max_length=25, alphabet="1234567890") # type: ignore
+    item_id = models.CharField(max_length=25, unique=True, default=ids.new_item_id, editable=False)
     vendor = models.ForeignKey(user_models.User, on_delete=models.SET_NULL, null=True, related_name="vendor_order_items")
     date = models.DateTimeField(default=timezone.now)
 
@@ -239,6 +488,10 @@ class OrderItem(models.Model):
     
     class Meta:
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['tracking_id']), # order tracker by courier tracking id
+            models.Index(fields=['vendor', '-date']), # vendor revenue and order items
+        ]
 
 class Review(models.Model):
     user = models.ForeignKey(user_models.User, on_delete=models.SET_NULL, blank=True, null=True)
@@ -251,4 +504,113 @@ class Review(models.Model):
 
     def __str__(self):
         return f"{self.user.username} review on {self.product.name}" # type: ignore
-        
+
+
+# Inventory holds (store/inventory.py)
+# create_order takes the ordered qty off Product.stock straight away and records it here; the hold is committed
+# when the order is paid, or released (stock given back) by `manage.py release_stock_holds` once it expires.
+class StockHold(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="stock_holds")
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="stock_holds")
+    qty = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=HOLD_STATUS, default="Held")
+    expires = models.DateTimeField()
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires']), # the sweeper looks for expired holds
+        ]
+
+    def __str__(self):
+        return f"{self.qty} x {self.product.name} for order {self.order.order_id} ({self.status})"
+
+
+# Payment ledger (store/payments.py)
+# One row per gateway reference (Stripe session, PayPal order, Paystack reference, Flutterwave tx_ref) - once the
+# gateway has answered Paid or Failed the outcome is final, repeat verifications read it from here.
+class PaymentAttempt(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="payment_attempts")
+    gateway = models.CharField(max_length=100, choices=PAYMENT_METHOD)
+    reference = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=ATTEMPT_STATUS, default="Pending")
+    gateway_status = models.CharField(max_length=100, blank=True, default="") # -> the status as the gateway put it
+    date = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gateway', 'reference'], name='unique_payment_attempt'),
+        ]
+
+    def __str__(self):
+        return f"{self.gateway} {self.reference} for order {self.order.order_id} ({self.status})"
+
+
+# Payment inbox (store/payments.py)
+# Gateway webhooks and "check this payment" requests from the redirect pages are stored here and answered at once;
+# `manage.py process_payment_events` works through them and records the outcomes in the PaymentAttempt ledger.
+class PaymentEvent(models.Model):
+    gateway = models.CharField(max_length=100, choices=PAYMENT_METHOD)
+    event_id = models.CharField(max_length=255) # -> the gateway's event id, "check:<reference>" for a redirect or "refund:<reference>"
+    event_type = models.CharField(max_length=100)
+    reference = models.CharField(max_length=255, blank=True, default="")
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True, related_name="payment_events")
+    payload = models.JSONField(default=dict, blank=True)
+    headers = models.JSONField(default=dict, blank=True) # -> signature headers the worker still has to verify (PayPal)
+    verified = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=EVENT_STATUS, default="Received")
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    date = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['gateway', 'event_id'], name='unique_payment_event'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'updated']), # the worker picks up received (and stuck) events
+        ]
+
+    def __str__(self):
+        return f"{self.gateway} {self.event_type} {self.event_id} ({self.status})"
+
+
+# The snapshot store of plugin/exchange_rate.py (settings.EXCHANGE_RATE_SNAPSHOT_MODEL)
+class ExchangeRateQuerySet(models.QuerySet):
+    # one upsert for every currency
+    def save_snapshot(self, rates, now):
+        self.bulk_create(
+            [self.model(currency=currency, rate=rate, updated=now) for currency, rate in rates.items()],
+            update_conflicts=True,
+            unique_fields=['currency'],
+            update_fields=['rate', 'updated'],
+        )
+
+    # (rates, fetched timestamp) or None when no rate was ever saved
+    def load_snapshot(self):
+        rows = list(self.values_list('currency', 'rate', 'updated'))
+        if not rows:
+            return None
+        return {currency: rate for currency, rate, updated in rows}, min(updated for _, _, updated in rows).timestamp()
+
+# Exchange rates (plugin/exchange_rate.py) - the last rates fetched, served when the cache is empty
+class ExchangeRate(models.Model):
+    currency = models.CharField(max_length=3, unique=True)
+    rate = models.DecimalField(max_digits=20, decimal_places=8) # -> units of the currency for 1 USD
+    updated = models.DateTimeField()
+
+    objects = ExchangeRateQuerySet.as_manager()
+
+    def __str__(self):
+        return f"1 USD = {self.rate} {self.currency}"
+
+
+# Id sequences (store/ids.py) - next_value is the first value not reserved yet by any worker
+class IdSequence(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    next_value = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
@@ -0,0 +1,218 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from customer import models as customer_models
+from store import gateways
+from store import models as store_models
+from vendor import models as vendor_models
+
+# Payment confirmation
+# The customer's redirect back from the gateway no longer waits on the gateway. Events are stored in the
+# PaymentEvent inbox and the request returns straight away:
+# - webhooks, signed by the gateway (store/views.py -> payment_webhook) - a retried webhook lands on the same row
+# - checks, queued by the redirect pages for a payment that has no final outcome yet
+# - refunds, queued for an order paid after its stock was sold (cancel_oversold)
+# `manage.py process_payment_events` works through the inbox (process_events) and records what it learns in the
+# ledger, the redirect page polls the order until the outcome is there (payment_status).
+#
+# The ledger has a PaymentAttempt row per gateway reference with a small state machine:
+# - Pending -> no final answer from the gateway yet
+# - Paid    -> final, the gateway confirmed the payment
+# - Failed  -> final, the gateway declined / expired it
+# The Pending -> final transition is taken under select_for_update, so a webhook and a check arriving together
+# record the outcome once, and only the one that moves the order from Processing to Paid fires the side effects
+# (order signals, notifications).
+
+STUCK_AFTER = timedelta(minutes=10) # -> an event still Processing after this long lost its worker, it is picked up again
+
+
+def open_attempt(order, gateway, reference):
+    attempts = store_models.PaymentAttempt.objects.filter(gateway=gateway, reference=reference)
+    attempt = attempts.first()
+    if attempt is None:
+        attempts.bulk_create([store_models.PaymentAttempt(order=order, gateway=gateway, reference=reference)], ignore_conflicts=True)
+        attempt = attempts.get()
+    return attempt
+
+
+# Returns the status of the attempt - an attempt recorded for another order is never honoured
+def record(order, gateway, reference, gateway_status, status):
+    attempt = open_attempt(order, gateway, reference)
+    if attempt.order_id != order.id:
+        return "Failed"
+    if attempt.status != "Pending" or status == "Pending":
+        return attempt.status
+
+    with transaction.atomic():
+        attempt = store_models.PaymentAttempt.objects.select_for_update().get(pk=attempt.pk)
+        if attempt.status != "Pending":
+            return attempt.status # -> a concurrent event recorded it first
+
+        attempt.status = status
+        attempt.gateway_status = gateway_status
+        attempt.save(update_fields=['status', 'gateway_status', 'updated'])
+
+        if status == "Paid":
+            mark_paid(order.pk, gateway, reference)
+
+    return status
+
+
+# The redirect pages - a payment without a final outcome gets a check queued, no gateway call in the request
+def check_later(order, gateway, reference):
+    attempt = open_attempt(order, gateway, reference)
+    if attempt.order_id != order.id:
+        return "Failed"
+
+    if attempt.status == "Pending":
+        event_id = f"check:{reference}"
+        store_models.PaymentEvent.objects.bulk_create([
+            store_models.PaymentEvent(gateway=gateway, event_id=event_id, event_type="check", reference=reference, order=order, verified=True)
+        ], ignore_conflicts=True)
+        # -> a check that already ran while the payment was still pending is queued again
+        store_models.PaymentEvent.objects.filter(gateway=gateway, event_id=event_id, status__in=["Processed", "Failed"]).update(
+            status="Received", attempts=0, updated=timezone.now()
+        )
+    return attempt.status
+
+
+# The webhook views - verified is False when the signature can only be checked by the worker (PayPal)
+def receive(gateway, payload, headers=None, verified=True):
+    event_type = payload.get("type") or payload.get("event_type") or payload.get("event") or ""
+    event_id = gateways.get_gateway(gateway).event_id(payload)
+    store_models.PaymentEvent.objects.bulk_create([
+        store_models.PaymentEvent(gateway=gateway, event_id=event_id, event_type=event_type,
+                                  payload=payload, headers=headers or {}, verified=verified)
+    ], ignore_conflicts=True)
+
+
+# Returns the new status of the event
+def process_event(event):
+    gateway = gateways.get_gateway(event.gateway)
+
+    if event.event_type == "check":
+        gateway_status, status = gateway.verify(event.reference)
+        record(event.order, event.gateway, event.reference, gateway_status, status)
+        return "Processed"
+
+    if event.event_type == "refund":
+        gateway.refund(event.reference) # -> the adapters send an idempotency key, a retried refund isn't paid twice
+        store_models.Order.objects.filter(pk=event.order_id).update(payment_status="Refunded")
+        return "Processed"
+
+    if not event.verified and not gateway.verify_event(event.payload, event.headers):
+        return "Ignored" # -> not signed by the gateway
+
+    outcome = gateway.read_event(event.payload)
+    if outcome is None:
+        return "Ignored" # -> an event we don't act on
+    reference, order_id, gateway_status, status = outcome
+
+    # the order the payment was started for, or the one the checkout page attached to it
+    order = (
+        store_models.Order.objects.filter(payment_attempts__gateway=event.gateway, payment_attempts__reference=reference).first()
+        or store_models.Order.objects.filter(order_id=order_id).first()
+    )
+    if not reference or order is None:
+        return "Ignored"
+
+    store_models.PaymentEvent.objects.filter(pk=event.pk).update(reference=reference, order=order)
+    record(order, event.gateway, reference, gateway_status, status)
+    return "Processed"
+
+
+def process_events(batch_size=100):
+    processed = 0
+    last_id = 0 # -> an event put back for a retry waits for the next run instead of being retried in a tight loop
+
+    while True:
+        stuck = timezone.now() - STUCK_AFTER
+        ready = store_models.PaymentEvent.objects.filter(models.Q(status="Received") | models.Q(status="Processing", updated__lt=stuck))
+        batch = list(ready.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not batch:
+            return processed
+
+        for event_id in batch:
+            last_id = event_id
+            # claim the event -> of two workers only one gets it
+            if not ready.filter(pk=event_id).update(status="Processing", attempts=models.F('attempts') + 1, updated=timezone.now()):
+                continue
+
+            event = store_models.PaymentEvent.objects.select_related('order').get(pk=event_id)
+            try:
+                status, error = process_event(event), ""
+            except Exception as e: # -> gateway down, malformed payload ... the event is kept for a retry
+                status = "Failed" if event.attempts >= settings.STORE_PAYMENT_EVENT_MAX_ATTEMPTS else "Received"
+                error = repr(e)
+
+            store_models.PaymentEvent.objects.filter(pk=event_id).update(status=status, error=error, updated=timezone.now())
+            processed += 1
+
+
+# Processing -> Paid, once per order whatever the number of attempts; returns False when the order was not Processing
+def mark_paid(order_pk, gateway, reference):
+    order = store_models.Order.objects.select_for_update().get(pk=order_pk)
+    if order.payment_status != "Processing":
+        return False
+
+    order.payment_status = "Paid"
+    order.payment_method = gateway
+    order.payment_id = reference
+    order.save() # -> the Order receivers in store/signals.py commit the stock holds and record co-purchases
+
+    if order.order_status != "Cancelled": # -> paid too late, the stock was sold meanwhile (cancel_oversold)
+        notify_order_paid(order)
+    return True
+
+
+# An order paid after its stock holds expired and the units were sold to someone else (inventory.commit_holds
+# returned the short holds): it is cancelled, the customer and the vendors are told, and the refund is queued in
+# the PaymentEvent inbox - the gateway is called by the worker, after this transaction, and retried like a check.
+def cancel_oversold(order, short):
+    order.order_status = "Cancelled"
+    store_models.Order.objects.filter(pk=order.pk).update(order_status="Cancelled")
+    store_models.OrderItem.objects.filter(order=order).update(order_status="Cancelled")
+
+    if order.payment_method and order.payment_id:
+        store_models.PaymentEvent.objects.bulk_create([
+            store_models.PaymentEvent(gateway=order.payment_method, event_id=f"refund:{order.payment_id}", event_type="refund",
+                                      reference=order.payment_id, order=order, verified=True)
+        ], ignore_conflicts=True)
+
+    if order.customer_id:
+        customer_models.Notifications.objects.create(type="Order Cancelled", user_id=order.customer_id)
+
+    # the vendors of the products that ran out, the order item points them at the order
+    short_products = [hold.product_id for hold in short]
+    vendor_models.Notifications.objects.bulk_create([
+        vendor_models.Notifications(type="Order Cancelled", user_id=item.vendor_id, order=item)
+        for item in order.order_items().filter(product_id__in=short_products).only('id', 'vendor_id')
+    ])
+
+
+def notify_order_paid(order):
+    # Email Configuration
+    # customer_merge_data = {
+    #     'order': order,
+    #     'order_items': order.order_items(),
+    # }
+    # subject = f"New Order!"
+    # text_body = render_to_string("email/order/customer/customer_new_order.txt", customer_merge_data)
+    # html_body = render_to_string("email/order/customer/customer_new_order.html", customer_merge_data)
+    # msg = EmailMultiAlternatives(subject=subject, from_email=settings.FROM_EMAIL, to=[order.address.email], body=text_body)
+    # msg.attach_alternative(html_body, "text/html")
+    # msg.send()
+
+    # Create a notification of purchase order for the customer
+    if order.customer_id:
+        customer_models.Notifications.objects.create(type="New Order", user_id=order.customer_id)
+
+    # Create a notification of sale order for the vendor of every item - the order item is passed so the vendor
+    # can see the order details in the notification (the "New Sale!" vendor emails would go out here too)
+    vendor_models.Notifications.objects.bulk_create([
+        vendor_models.Notifications(type="New Sale", user_id=item.vendor_id, order=item)
+        for item in order.order_items().only('id', 'vendor_id')
+    ])
@@ -0,0 +1,168 @@
+import re
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.db import connection, models
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+
+# Full-text product search
+# The index covers the product name, the plain text of the CKEditor description, the category title and the
+# vendor store name. Each backend keeps its own table (created in store/migrations/0004_product_search_index.py)
+# and returns product ids ordered by relevance, which search() turns back into a product queryset. The ranking only
+# looks at the products of the queryset being searched (category, published, facet filters ...) - its ids go into
+# the full-text query as a subquery, so a common term never fills the capped results with products filtered out later.
+
+MAX_RESULTS = 1000 # -> relevance ranked results are capped so the id list handed back to the ORM stays small
+
+
+def search_terms(query):
+    # -> only word characters survive, so the terms are safe to hand to MATCH / to_tsquery
+    return re.findall(r"\w+", query or "")
+
+
+def product_document(product):
+    category = product.category.title if product.category else ""
+    vendor = getattr(getattr(product.vendor, "vendor", None), "store_name", None) or ""
+    return {
+        "name": product.name or "",
+        "description": strip_tags(product.description or ""),
+        "category": category,
+        "vendor": vendor,
+    }
+
+
+def id_subquery(queryset):
+    # -> SELECT id FROM store_product WHERE <the queryset's filters>, ready to embed in raw SQL
+    return queryset.order_by().values('id').query.sql_with_params()
+
+
+class SearchBackend(ABC):
+    table = None
+
+    @abstractmethod
+    def index(self, products):
+        ...
+
+    @abstractmethod
+    def remove(self, product_ids):
+        ...
+
+    # ids of the products of queryset matching query, best first
+    @abstractmethod
+    def rank(self, query, queryset, limit=MAX_RESULTS):
+        ...
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+
+
+# Default backend for db.sqlite3 - an FTS5 virtual table keyed by the product id (rowid)
+class SQLiteFTS5Backend(SearchBackend):
+    table = "store_product_fts"
+
+    def index(self, products):
+        rows = [(p.id, *product_document(p).values()) for p in products]
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(f"INSERT INTO {self.table} (rowid, name, description, category, vendor) VALUES (%s, %s, %s, %s, %s)", rows)
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(i,) for i in product_ids])
+
+    def rank(self, query, queryset, limit=MAX_RESULTS):
+        terms = search_terms(query)
+        if not terms:
+            return []
+
+        match = " ".join(f'"{term}"*' for term in terms) # -> every term must match, as a prefix
+        ids_sql, ids_params = id_subquery(queryset)
+        with connection.cursor() as cursor:
+            # bm25 weights follow the column order -> name, description, category, vendor
+            cursor.execute(
+                f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s AND rowid IN ({ids_sql}) "
+                f"ORDER BY bm25({self.table}, 10.0, 1.0, 4.0, 4.0) LIMIT %s",
+                [match, *ids_params, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+# PostgreSQL backend - a weighted tsvector per product behind a GIN index
+class PostgresSearchBackend(SearchBackend):
+    table = "store_product_search"
+    document = (
+        "setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'C') || "
+        "setweight(to_tsvector('english', %s), 'B') || setweight(to_tsvector('english', %s), 'B')"
+    )
+
+    def index(self, products):
+        rows = [(p.id, *product_document(p).values()) for p in products]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (product_id, document) VALUES (%s, {self.document}) "
+                "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+                rows,
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE product_id = ANY(%s)", [list(product_ids)])
+
+    def rank(self, query, queryset, limit=MAX_RESULTS):
+        terms = search_terms(query)
+        if not terms:
+            return []
+
+        tsquery = " & ".join(f"{term}:*" for term in terms)
+        ids_sql, ids_params = id_subquery(queryset)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {self.table}, to_tsquery('english', %s) query "
+                f"WHERE document @@ query AND product_id IN ({ids_sql}) ORDER BY ts_rank(document, query) DESC LIMIT %s",
+                [tsquery, *ids_params, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    "sqlite": SQLiteFTS5Backend,
+    "postgresql": PostgresSearchBackend,
+}
+
+
+def get_backend():
+    # settings.STORE_SEARCH_BACKEND can point at a custom backend class, otherwise pick one for the database in use
+    path = getattr(settings, "STORE_SEARCH_BACKEND", None)
+    if path:
+        return import_string(path)()
+
+    backend = BACKENDS.get(connection.vendor)
+    return backend() if backend else None
+
+
+def search(queryset, query):
+    backend = get_backend()
+
+    if backend is None: # -> databases without a full-text backend keep the old behaviour
+        return queryset.filter(name__icontains=query)
+
+    ids = backend.rank(query, queryset)
+    if not ids:
+        return queryset.none()
+
+    relevance = models.Case(*[models.When(id=product_id, then=position) for position, product_id in enumerate(ids)])
+    return queryset.filter(id__in=ids).order_by(relevance)
+
+
+def index_products(products):
+    backend = get_backend()
+    if backend:
+        backend.index(products)
+
+
+def remove_products(product_ids):
+    backend = get_backend()
+    if backend:
+        backend.remove(product_ids)
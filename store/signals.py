@@ -0,0 +1,192 @@
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from store import models as store_models
+from store import coupons
+from store import inventory
+from store import payments
+from store import search
+from store.cache import bump_version, invalidate_product_detail
+from store.cart import CartBusy, get_cart_store
+from vendor import models as vendor_models
+
+
+# Facet index - rebuilt after the surrounding transaction commits, so cascading deletes of a
+# product (variants -> items) never write facet rows for a product that is about to disappear
+def refresh_facets(product_id):
+    def refresh():
+        product = store_models.Product.objects.select_related('category').filter(pk=product_id).first()
+        if product:
+            product.update_facets()
+
+    if product_id:
+        transaction.on_commit(refresh)
+
+
+# Product detail cache - dropped once the change is committed, a request running meanwhile would otherwise cache
+# the old rows again for the whole CACHE_TIMEOUT
+def invalidate_after_commit(*slugs):
+    transaction.on_commit(lambda: invalidate_product_detail(*slugs))
+
+
+# Product cards - moving Product.updated forward gives the product a new fragment cache key
+# update() is used so this never fires the Product post_save receivers again
+def touch_products(queryset):
+    slugs = list(queryset.values_list('slug', flat=True))
+    queryset.update(updated=timezone.now())
+    invalidate_after_commit(*slugs) # -> and drop the cached detail page of those products
+
+
+# Categories - the cached category list used by the context processor, and the category title on the cards
+# -> bumped once the change is committed, or a request running meanwhile would cache the old list under the new version
+@receiver(post_save, sender=store_models.Category)
+@receiver(post_delete, sender=store_models.Category)
+def invalidate_categories(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_version("categories"))
+
+@receiver(post_save, sender=store_models.Category)
+@receiver(pre_delete, sender=store_models.Category) # -> before SET_NULL detaches the products from it
+def touch_category_products(sender, instance, **kwargs):
+    touch_products(store_models.Product.objects.filter(category_id=instance.pk))
+
+# -> the category facet rows of its products: a rename changes their label, a delete (SET_NULL, no Product save) drops them
+@receiver(post_save, sender=store_models.Category)
+def rename_category_facets(sender, instance, **kwargs):
+    store_models.ProductFacet.objects.filter(facet="Category", value=str(instance.pk)).update(label=instance.title[:100])
+
+@receiver(post_delete, sender=store_models.Category)
+def remove_category_facets(sender, instance, **kwargs):
+    store_models.ProductFacet.objects.filter(facet="Category", value=str(instance.pk)).delete()
+
+@receiver(post_save, sender=store_models.Gallery)
+@receiver(post_delete, sender=store_models.Gallery)
+def touch_gallery_product(sender, instance, **kwargs):
+    touch_products(store_models.Product.objects.filter(pk=instance.product_id))
+
+
+# Reviews - keep Product.rating_avg and Product.review_count in sync with the active reviews
+@receiver(pre_save, sender=store_models.Review)
+def remember_review_product(sender, instance, **kwargs):
+    # -> remember the product the review belonged to before this save, in case it was moved to another product
+    if instance.pk:
+        instance._previous_product_id = sender.objects.filter(pk=instance.pk).values_list('product_id', flat=True).first()
+    else:
+        instance._previous_product_id = None
+
+@receiver(post_save, sender=store_models.Review)
+@receiver(post_delete, sender=store_models.Review)
+def update_product_rating(sender, instance, **kwargs):
+    product_ids = {instance.product_id, getattr(instance, '_previous_product_id', None)}
+
+    for product in store_models.Product.objects.filter(id__in=[i for i in product_ids if i]):
+        product.update_rating()
+        invalidate_after_commit(product.slug) # the cached detail page lists the active reviews
+        refresh_facets(product.id) # the rating bucket may have changed
+
+
+# Products, variants and variant items - keep the facet index current
+@receiver(post_save, sender=store_models.Product)
+def update_product_facets(sender, instance, **kwargs):
+    refresh_facets(instance.id)
+
+# Product detail cache - any change to the product row itself (including a renamed slug)
+@receiver(pre_save, sender=store_models.Product)
+def remember_product_slug(sender, instance, **kwargs):
+    instance._previous_slug = sender.objects.filter(pk=instance.pk).values_list('slug', flat=True).first() if instance.pk else None
+
+@receiver(post_save, sender=store_models.Product)
+@receiver(post_delete, sender=store_models.Product)
+def invalidate_product_page(sender, instance, **kwargs):
+    invalidate_after_commit(instance.slug, getattr(instance, '_previous_slug', None))
+
+@receiver(post_save, sender=store_models.Variant)
+@receiver(post_delete, sender=store_models.Variant)
+def update_variant_facets(sender, instance, **kwargs):
+    touch_products(store_models.Product.objects.filter(pk=instance.product_id))
+    refresh_facets(instance.product_id)
+
+@receiver(post_save, sender=store_models.VariantItem)
+@receiver(post_delete, sender=store_models.VariantItem)
+def update_variant_item_facets(sender, instance, **kwargs):
+    product_id = store_models.Variant.objects.filter(pk=instance.variant_id).values_list('product_id', flat=True).first()
+    touch_products(store_models.Product.objects.filter(pk=product_id))
+    refresh_facets(product_id)
+
+
+# Search index - products are (re)indexed after commit; category and vendor renames reindex their products
+def reindex_products(queryset):
+    def reindex():
+        search.index_products(queryset.select_related('category', 'vendor__vendor'))
+
+    transaction.on_commit(reindex)
+
+@receiver(post_save, sender=store_models.Product)
+def update_product_search(sender, instance, **kwargs):
+    reindex_products(store_models.Product.objects.filter(pk=instance.pk))
+
+@receiver(post_delete, sender=store_models.Product)
+def remove_product_search(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+@receiver(post_save, sender=store_models.Category)
+def update_category_search(sender, instance, created, **kwargs):
+    if not created:
+        reindex_products(store_models.Product.objects.filter(category=instance))
+
+@receiver(post_save, sender=vendor_models.Vendor)
+def update_vendor_search(sender, instance, created, **kwargs):
+    if instance.user_id:
+        reindex_products(store_models.Product.objects.filter(vendor_id=instance.user_id))
+
+
+# Orders - a paid order feeds the co-purchase table used for the related products
+@receiver(pre_save, sender=store_models.Order)
+def remember_payment_status(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_payment_status = sender.objects.filter(pk=instance.pk).values_list('payment_status', flat=True).first()
+    else:
+        instance._previous_payment_status = None
+
+@receiver(post_save, sender=store_models.Order)
+def record_co_purchases(sender, instance, **kwargs):
+    if instance.payment_status == "Paid" and getattr(instance, '_previous_payment_status', None) != "Paid":
+        transaction.on_commit(lambda: store_models.RelatedProduct.objects.record_order(instance))
+
+# Inventory - the stock held for the order since create_order is now sold (store/inventory.py)
+@receiver(post_save, sender=store_models.Order)
+def commit_stock_holds(sender, instance, **kwargs):
+    if instance.payment_status == "Paid" and getattr(instance, '_previous_payment_status', None) != "Paid":
+        short = inventory.commit_holds(instance)
+        if short: # -> paid after the holds expired and the stock was sold meanwhile
+            payments.cancel_oversold(instance, short)
+
+
+# Coupons - drop the cached coupons of the code (and of the old code after a rename) and any "fully redeemed" mark
+@receiver(pre_save, sender=store_models.Coupon)
+def remember_coupon_code(sender, instance, **kwargs):
+    instance._previous_code = sender.objects.filter(pk=instance.pk).values_list('code', flat=True).first() if instance.pk else None
+
+@receiver(post_save, sender=store_models.Coupon)
+@receiver(post_delete, sender=store_models.Coupon)
+def invalidate_coupon(sender, instance, **kwargs):
+    coupons.invalidate_coupons(instance.code, getattr(instance, '_previous_code', None))
+    cache.delete(coupons.exhausted_key(instance.pk))
+
+
+# Carts - on login (and sign up) the anonymous cart of the session joins the customer's cart
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    cart_id = request.session.get('cart_id') if request is not None else None
+    if not cart_id:
+        return
+
+    cart_store = get_cart_store(request) # -> request.user is already the logged in user here
+    try:
+        cart_store.merge(cart_id)
+    except CartBusy:
+        pass # -> the anonymous cart is left as it is, the login goes on
+    request.session['total_cart_items'] = cart_store.totals()["count"]
@@ -0,0 +1,10 @@
+from django import template
+
+from store.cache import render_product_cards
+
+register = template.Library()
+
+# {% product_cards products "partials/_product_card.html" as cards %} -> one cached HTML fragment per product
+@register.simple_tag
+def product_cards(products, template_name):
+    return render_product_cards(products, template_name)
@@ -1,3 +1,1276 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import unittest
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import urlsplit
 
-# Create your tests here.
+import requests
+
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, models, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from plugin import exchange_rate
+from plugin import fake_gateway
+from plugin import http_client
+from plugin.paginate_queryset import KeysetPaginator, paginate_queryset
+from store import cache as store_cache
+from store import cart
+from store import coupons
+from store import gateways
+from store import inventory
+from store import payments
+from store import search
+from store import models as store_models
+from store.cart import CartLine, DatabaseCartStore
+from customer import models as customer_models
+from vendor import models as vendor_models
+from userauths import models as userauths_models
+
+
+# Query plan regression tests
+# Every hot lookup of the views is run through EXPLAIN QUERY PLAN against a seeded (and ANALYZEd) database and
+# must be answered from an index. A plan line "SCAN <table>" without an index means the query walks the whole table.
+@unittest.skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN is SQLite specific")
+class HotQueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.vendor = userauths_models.User.objects.create(email="vendor@example.com", username="vendor")
+        cls.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        others = userauths_models.User.objects.bulk_create([
+            userauths_models.User(email=f"user{i}@example.com", username=f"user{i}") for i in range(50)
+        ])
+
+        categories = store_models.Category.objects.bulk_create([
+            store_models.Category(title=f"Category {i}", slug=f"category-{i}") for i in range(10)
+        ])
+        products = store_models.Product.objects.bulk_create([
+            store_models.Product(
+                name=f"Product {i}", slug=f"product-{i}", sku=f"SKU{i}", category=categories[i % 10], vendor=others[i % 50],
+                status="Published" if i % 4 else "Draft",
+            )
+            for i in range(400)
+        ])
+
+        store_models.Cart.objects.bulk_create([
+            store_models.Cart(product=products[i], cart_id=f"cart-{i // 2}", user=others[i % 50] if i % 2 else None, qty=1) for i in range(400)
+        ])
+        store_models.Coupon.objects.bulk_create([
+            store_models.Coupon(vendor=others[i % 50], code=f"CODE{i}") for i in range(200)
+        ])
+
+        orders = store_models.Order.objects.bulk_create([
+            store_models.Order(customer=others[i % 50], payment_status="Paid") for i in range(400)
+        ])
+        store_models.OrderItem.objects.bulk_create([
+            store_models.OrderItem(order=orders[i], product=products[i], vendor=others[i % 50], tracking_id=f"TRACK{i}")
+            for i in range(400)
+        ])
+
+        for notifications in (customer_models.Notifications, vendor_models.Notifications):
+            notifications.objects.bulk_create([
+                notifications(user=others[i % 50], type="New Order", seen=bool(i % 3)) for i in range(400)
+            ])
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE") # -> plans are chosen from real statistics, as on a populated database
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, queryset):
+        table = queryset.model._meta.db_table
+        plan = self.query_plan(queryset)
+        full_scans = [line for line in plan if re.fullmatch(rf"SCAN {table}( AS \w+)?", line)]
+        self.assertFalse(full_scans, f"{table} is fully scanned:\n" + "\n".join(plan))
+        self.assertTrue(any(line.startswith(f"SEARCH {table}") for line in plan), "\n".join(plan))
+
+    def test_cart_by_cart_id(self):
+        self.assertUsesIndex(store_models.Cart.objects.filter(cart_id="cart-7"))
+        self.assertUsesIndex(store_models.Cart.objects.filter(cart_id="cart-7").values("cart_id").annotate(sub_total=models.Sum("sub_total")))
+
+    def test_cart_by_user(self):
+        self.assertUsesIndex(store_models.Cart.objects.filter(user=self.customer))
+
+    def test_coupon_by_code(self):
+        self.assertUsesIndex(store_models.Coupon.objects.filter(code="CODE7"))
+
+    def test_order_by_order_id(self):
+        self.assertUsesIndex(store_models.Order.objects.filter(order_id="10000007"))
+
+    def test_order_item_tracker(self):
+        self.assertUsesIndex(store_models.OrderItem.objects.filter(models.Q(item_id="abc") | models.Q(tracking_id="abc")))
+
+    def test_published_products_by_category(self):
+        category = store_models.Category.objects.first()
+        self.assertUsesIndex(store_models.Product.objects.published().filter(category=category))
+
+    def test_products_by_vendor(self):
+        self.assertUsesIndex(store_models.Product.objects.filter(vendor=self.vendor))
+
+    def test_unseen_notifications(self):
+        self.assertUsesIndex(customer_models.Notifications.objects.filter(user=self.customer, seen=False))
+        self.assertUsesIndex(vendor_models.Notifications.objects.filter(user=self.vendor, seen=False))
+
+    def test_customer_orders(self):
+        self.assertUsesIndex(store_models.Order.objects.filter(customer=self.customer))
+
+    def test_vendor_order_items(self):
+        self.assertUsesIndex(store_models.OrderItem.objects.filter(vendor=self.vendor))
+
+
+# Inventory holds under concurrent checkouts
+# Many threads race to check out one unit each of a product with fewer units in stock than threads;
+# exactly `stock` of them may win and the stock must end at zero, never below.
+class ConcurrentStockHoldTests(TransactionTestCase):
+    threads = 20
+    stock = 5
+
+    def setUp(self):
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.product = store_models.Product.objects.create(name="Last units", stock=self.stock, price=10, shipping=1)
+
+    def checkout(self, results, barrier):
+        line = CartLine(id=1, product=self.product, qty=1, price=10, sub_total=10, shipping=1, total=11)
+        barrier.wait()
+        try:
+            for attempt in range(200):
+                try:
+                    with transaction.atomic():
+                        order = store_models.Order.objects.create(customer=self.customer)
+                        inventory.place_holds(order, [line])
+                    results.append("held")
+                    return
+                except OperationalError: # -> SQLite lets one writer in at a time, the others retry after a short pause
+                    time.sleep(random.uniform(0, 0.01))
+            results.append("gave up")
+        except inventory.OutOfStock:
+            results.append("out of stock")
+        finally:
+            connection.close()
+
+    def test_concurrent_checkouts_never_oversell(self):
+        results, barrier = [], threading.Barrier(self.threads)
+        workers = [threading.Thread(target=self.checkout, args=(results, barrier)) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.product.refresh_from_db()
+        self.assertEqual(results.count("held"), self.stock)
+        self.assertEqual(results.count("out of stock"), self.threads - self.stock)
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(store_models.StockHold.objects.filter(product=self.product, status="Held").count(), self.stock)
+
+    def test_expired_holds_are_released_once(self):
+        order = store_models.Order.objects.create(customer=self.customer)
+        with transaction.atomic():
+            inventory.place_holds(order, [CartLine(id=1, product=self.product, qty=2, price=10, sub_total=20, shipping=2, total=22)])
+        store_models.StockHold.objects.update(expires=models.functions.Now())
+
+        self.assertEqual(inventory.release_expired_holds(), 1)
+        self.assertEqual(inventory.release_expired_holds(), 0)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, self.stock)
+
+        # paid after the hold expired -> the stock is taken again
+        self.assertEqual(inventory.commit_holds(order), [])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, self.stock - 2)
+
+    def test_paid_after_the_hold_expired_and_the_stock_was_resold(self):
+        vendor = userauths_models.User.objects.create(email="vendor@example.com", username="vendor")
+        line = CartLine(id=1, product=self.product, qty=self.stock, price=10, sub_total=10 * self.stock, shipping=self.stock, total=11 * self.stock)
+        late = store_models.Order.objects.create(customer=self.customer)
+        store_models.OrderItem.objects.create(order=late, product=self.product, vendor=vendor, qty=self.stock)
+        with transaction.atomic():
+            inventory.place_holds(late, [line])
+        store_models.StockHold.objects.update(expires=models.functions.Now())
+        inventory.release_expired_holds()
+
+        # the released units are bought by another customer before the first one pays
+        with transaction.atomic():
+            inventory.place_holds(store_models.Order.objects.create(customer=self.customer), [line])
+
+        self.assertEqual(payments.record(late, "Stripe", "cs_late", "paid", "Paid"), "Paid")
+
+        late.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((late.payment_status, late.order_status), ("Paid", "Cancelled"))
+        self.assertEqual(self.product.stock, 0) # -> never sold twice
+        self.assertFalse(store_models.StockHold.objects.filter(order=late, status="Committed").exists())
+        self.assertTrue(customer_models.Notifications.objects.filter(user=self.customer, type="Order Cancelled").exists())
+        self.assertFalse(customer_models.Notifications.objects.filter(user=self.customer, type="New Order").exists())
+        self.assertTrue(vendor_models.Notifications.objects.filter(user=vendor, type="Order Cancelled").exists())
+
+        # the refund is left to the payment worker
+        refund = store_models.PaymentEvent.objects.get(order=late, event_type="refund")
+        with mock.patch.object(gateways.StripeGateway, "refund", return_value="succeeded") as gateway_refund:
+            payments.process_events()
+        gateway_refund.assert_called_once_with("cs_late")
+        refund.refresh_from_db()
+        late.refresh_from_db()
+        self.assertEqual((refund.status, late.payment_status), ("Processed", "Refunded"))
+
+
+# Payment ledger
+# A webhook and the redirect page's check may both learn that a payment went through; the order turns Paid and its
+# side effects (notifications, stock, co-purchases) happen once. A reference is only ever honoured for its own order.
+class PaymentLedgerTests(TestCase):
+
+    def setUp(self):
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.order = store_models.Order.objects.create(customer=self.customer, total=20)
+
+    def test_webhook_and_check_mark_the_order_paid_once(self):
+        with mock.patch.object(payments, "mark_paid", wraps=payments.mark_paid) as mark_paid:
+            self.assertEqual(payments.record(self.order, "Stripe", "cs_1", "complete", "Paid"), "Paid") # -> the webhook
+            self.assertEqual(payments.record(self.order, "Stripe", "cs_1", "paid", "Paid"), "Paid") # -> the check
+        mark_paid.assert_called_once()
+
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.payment_id), ("Paid", "cs_1"))
+        self.assertEqual(store_models.PaymentAttempt.objects.get().status, "Paid")
+        self.assertEqual(customer_models.Notifications.objects.filter(user=self.customer, type="New Order").count(), 1)
+
+    def test_a_final_outcome_is_never_changed(self):
+        payments.record(self.order, "Stripe", "cs_1", "expired", "Failed")
+        self.assertEqual(payments.record(self.order, "Stripe", "cs_1", "paid", "Paid"), "Failed")
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, "Processing")
+
+    def test_an_attempt_for_another_order_is_refused(self):
+        other = store_models.Order.objects.create(customer=self.customer, total=1)
+        payments.record(other, "Stripe", "cs_other", "open", "Pending")
+
+        self.assertEqual(payments.record(self.order, "Stripe", "cs_other", "paid", "Paid"), "Failed")
+        self.assertEqual(payments.check_later(self.order, "Stripe", "cs_other"), "Failed")
+        self.order.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.order.payment_status, other.payment_status), ("Processing", "Processing"))
+        self.assertFalse(store_models.PaymentEvent.objects.exists())
+
+
+# Payment inbox
+# process_events claims each ready event with a conditional UPDATE, keeps an event whose gateway call failed for the
+# next run and gives up after STORE_PAYMENT_EVENT_MAX_ATTEMPTS; an event left Processing by a dead worker is taken again.
+class PaymentEventTests(TestCase):
+
+    def setUp(self):
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.order = store_models.Order.objects.create(customer=self.customer, total=20)
+        payments.check_later(self.order, "Stripe", "cs_1")
+        self.event = store_models.PaymentEvent.objects.get()
+
+    def test_a_check_records_the_outcome(self):
+        with mock.patch.object(gateways.StripeGateway, "verify", return_value=("paid", "Paid")):
+            self.assertEqual(payments.process_events(), 1)
+            self.assertEqual(payments.process_events(), 0) # -> nothing left to claim
+
+        self.event.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual((self.event.status, self.event.attempts), ("Processed", 1))
+        self.assertEqual(self.order.payment_status, "Paid")
+
+    def test_an_event_claimed_by_another_worker_is_left_alone(self):
+        store_models.PaymentEvent.objects.update(status="Processing")
+        with mock.patch.object(gateways.StripeGateway, "verify") as verify:
+            self.assertEqual(payments.process_events(), 0)
+        verify.assert_not_called()
+
+        # the worker died -> the event is picked up again once it has been stuck long enough
+        store_models.PaymentEvent.objects.update(updated=models.functions.Now() - payments.STUCK_AFTER)
+        with mock.patch.object(gateways.StripeGateway, "verify", return_value=("paid", "Paid")):
+            self.assertEqual(payments.process_events(), 1)
+        self.event.refresh_from_db()
+        self.assertEqual((self.event.status, self.event.attempts), ("Processed", 1))
+
+    @override_settings(STORE_PAYMENT_EVENT_MAX_ATTEMPTS=2)
+    def test_a_failing_event_is_retried_then_given_up(self):
+        with mock.patch.object(gateways.StripeGateway, "verify", side_effect=gateways.GatewayError("Stripe is down")):
+            self.assertEqual(payments.process_events(), 1)
+            self.event.refresh_from_db()
+            self.assertEqual((self.event.status, self.event.attempts), ("Received", 1)) # -> kept for the next run
+            self.assertIn("Stripe is down", self.event.error)
+
+            self.assertEqual(payments.process_events(), 1)
+            self.event.refresh_from_db()
+            self.assertEqual((self.event.status, self.event.attempts), ("Failed", 2))
+
+            self.assertEqual(payments.process_events(), 0)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, "Processing")
+
+
+# PayPal access token
+# Many threads needing a token at once make a single OAuth call, the others get its token; a refused token is replaced.
+class PayPalTokenTests(SimpleTestCase):
+    threads = 10
+
+    def setUp(self):
+        cache.delete_many([gateways.PAYPAL_TOKEN_KEY, gateways.PAYPAL_TOKEN_LOCK_KEY])
+        self.addCleanup(cache.delete_many, [gateways.PAYPAL_TOKEN_KEY, gateways.PAYPAL_TOKEN_LOCK_KEY])
+
+    def test_concurrent_refreshes_ask_paypal_once(self):
+        def slow_token():
+            time.sleep(0.05) # -> the other threads arrive while the token is being fetched
+            return "token-1", 3600
+
+        tokens, barrier = [], threading.Barrier(self.threads)
+        def get_token():
+            barrier.wait()
+            tokens.append(gateways.get_paypal_access_token())
+
+        with mock.patch.object(gateways, "request_paypal_token", side_effect=slow_token) as request_token:
+            workers = [threading.Thread(target=get_token) for _ in range(self.threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        request_token.assert_called_once()
+        self.assertEqual(tokens, ["token-1"] * self.threads)
+
+    def test_a_refused_token_is_replaced(self):
+        with mock.patch.object(gateways, "request_paypal_token", side_effect=[("token-1", 3600), ("token-2", 3600)]) as request_token:
+            self.assertEqual(gateways.get_paypal_access_token(), "token-1")
+            self.assertEqual(gateways.get_paypal_access_token(), "token-1") # -> from the cache
+            self.assertEqual(gateways.get_paypal_access_token(stale="token-1"), "token-2")
+        self.assertEqual(request_token.call_count, 2)
+
+
+# Exchange rates
+# Served from the cache, then from the database snapshot; the API is only waited on when there is neither.
+class ExchangeRateTests(TestCase):
+
+    def setUp(self):
+        cache.delete_many([exchange_rate.RATES_KEY, exchange_rate.REFRESH_LOCK_KEY])
+        self.addCleanup(cache.delete_many, [exchange_rate.RATES_KEY, exchange_rate.REFRESH_LOCK_KEY])
+
+    def test_rates_come_from_the_snapshot_then_the_cache(self):
+        exchange_rate.save_snapshot({"NGN": Decimal("1500"), "INR": Decimal("83")}, timezone.now())
+
+        with mock.patch.object(exchange_rate, "fetch_exchange_rates") as fetch:
+            self.assertEqual(exchange_rate.get_rate("NGN"), Decimal("1500")) # -> empty cache, read from the snapshot
+            store_models.ExchangeRate.objects.all().delete()
+            self.assertEqual(exchange_rate.get_rate("INR"), Decimal("83")) # -> cached since
+        fetch.assert_not_called()
+
+    def test_the_api_is_only_asked_without_a_snapshot(self):
+        with mock.patch.object(exchange_rate, "fetch_exchange_rates", return_value={"NGN": Decimal("1600")}) as fetch:
+            self.assertEqual(exchange_rate.get_rate("NGN"), Decimal("1600"))
+        fetch.assert_called_once()
+        self.assertEqual(store_models.ExchangeRate.objects.get().rate, Decimal("1600")) # -> the next restart starts from it
+
+    def test_no_rate_at_all(self):
+        with mock.patch.object(exchange_rate, "fetch_exchange_rates", side_effect=exchange_rate.RatesUnavailable("API down")):
+            with self.assertRaises(exchange_rate.RatesUnavailable):
+                exchange_rate.convert_usd_to_kobo(10)
+
+        exchange_rate.save_snapshot({"NGN": Decimal("1500")}, timezone.now())
+        cache.delete(exchange_rate.RATES_KEY)
+        with self.assertRaises(exchange_rate.RatesUnavailable): # -> a currency the snapshot doesn't know
+            exchange_rate.get_rate("INR")
+
+    @mock.patch.object(exchange_rate, "FIRST_LOAD_POLL", 0.01)
+    def test_a_cold_start_waits_for_the_fetch_in_flight(self):
+        cache.add(exchange_rate.REFRESH_LOCK_KEY, True) # -> another worker is fetching
+        def fetched():
+            exchange_rate.cache_rates({"NGN": Decimal("1700")}, time.time())
+            cache.delete(exchange_rate.REFRESH_LOCK_KEY)
+        timer = threading.Timer(0.05, fetched)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        with mock.patch.object(exchange_rate, "fetch_exchange_rates") as fetch:
+            self.assertEqual(exchange_rate.get_rate("NGN"), Decimal("1700"))
+        fetch.assert_not_called()
+
+    @mock.patch.object(exchange_rate, "FIRST_LOAD_POLL", 0.01)
+    def test_a_cold_start_gives_up_when_the_fetch_in_flight_fails(self):
+        cache.add(exchange_rate.REFRESH_LOCK_KEY, True)
+        timer = threading.Timer(0.05, cache.delete, [exchange_rate.REFRESH_LOCK_KEY])
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        with mock.patch.object(exchange_rate, "fetch_exchange_rates") as fetch:
+            with self.assertRaises(exchange_rate.RatesUnavailable):
+                exchange_rate.get_rate("NGN")
+        fetch.assert_not_called()
+
+
+# Checkout end to end against the fake gateway (plugin/fake_gateway.py, in-process) - the same path as
+# `manage.py benchmark_checkout`: cart -> order -> payment session -> the gateway's page -> redirect page -> worker
+@override_settings(STORE_FAKE_GATEWAY=True, FAKE_GATEWAY_URL="")
+class FakeGatewayCheckoutTests(TestCase):
+
+    def setUp(self):
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.address = customer_models.Address.objects.create(user=self.customer, full_name="Customer", email=self.customer.email, country="United States")
+        vendor = userauths_models.User.objects.create(email="vendor@example.com", username="vendor")
+        self.product = store_models.Product.objects.create(name="Product", status="Published", stock=5, price=10, shipping=1, vendor=vendor)
+        self.client.force_login(self.customer)
+
+    def checkout(self, decline_rate):
+        fake_gateway.start(latency_ms=0, failure_rate=0, decline_rate=decline_rate)
+
+        response = self.client.get(reverse("store:add_to_cart"), {"id": self.product.id, "qty": 2, "cart_id": "12345"})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse("store:create_order"), {"address": self.address.id})
+        order = store_models.Order.objects.get(customer=self.customer)
+        self.assertRedirects(response, reverse("store:checkout", args=[order.order_id]), fetch_redirect_response=False)
+
+        response = self.client.post(reverse("store:payment_session", args=["Stripe", order.order_id]))
+        self.assertEqual(response.status_code, 200)
+
+        # the customer pays on the gateway's page, which sends them back to the redirect page
+        paid = requests.get(response.json()["redirect_url"], allow_redirects=False, timeout=5)
+        self.assertEqual(paid.status_code, 302)
+        return_url = urlsplit(paid.headers["Location"])
+        self.client.get(return_url.path + "?" + return_url.query)
+
+        status_url = reverse("store:payment_status", args=[order.order_id])
+        self.assertEqual(self.client.get(status_url, {"format": "json"}).json()["payment_status"], "pending")
+        self.assertEqual(payments.process_events(), 1)
+        return order, self.client.get(status_url, {"format": "json"}).json()["payment_status"]
+
+    def test_paid_checkout(self):
+        order, payment_status = self.checkout(decline_rate=0)
+
+        order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((payment_status, order.payment_status, order.payment_method), ("paid", "Paid", "Stripe"))
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(store_models.StockHold.objects.get(order=order).status, "Committed")
+
+    def test_declined_checkout(self):
+        order, payment_status = self.checkout(decline_rate=1)
+
+        order.refresh_from_db()
+        self.assertEqual((payment_status, order.payment_status), ("failed", "Processing"))
+        self.assertEqual(store_models.StockHold.objects.get(order=order).status, "Held") # -> released when it expires
+
+
+# Stripe webhooks are only accepted with a valid signature made with the configured secret
+class StripeWebhookTests(TestCase):
+    body = json.dumps({"id": "evt_1", "type": "checkout.session.completed", "data": {"object": {
+        "id": "cs_1", "client_reference_id": "10000001", "payment_status": "paid"}}})
+
+    def signature(self, secret):
+        timestamp = int(time.time())
+        digest = hmac.new(secret.encode(), f"{timestamp}.{self.body}".encode(), hashlib.sha256).hexdigest()
+        return f"t={timestamp},v1={digest}"
+
+    def post(self, signature):
+        return self.client.post(reverse("store:stripe_webhook"), self.body, content_type="application/json", HTTP_STRIPE_SIGNATURE=signature)
+
+    @override_settings(STRIPE_WEBHOOK_SECRET="whsec_test")
+    def test_a_signed_event_is_stored(self):
+        self.assertEqual(self.post(self.signature("whsec_test")).status_code, 200)
+        self.assertEqual(store_models.PaymentEvent.objects.get().event_id, "evt_1")
+
+    @override_settings(STRIPE_WEBHOOK_SECRET="whsec_test")
+    def test_a_bad_signature_is_refused(self):
+        self.assertEqual(self.post(self.signature("whsec_other")).status_code, 400)
+        self.assertFalse(store_models.PaymentEvent.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET="")
+    def test_nothing_is_accepted_without_a_secret(self):
+        # older stripe versions (7.0.0, pinned in requirements.txt) accept a signature made with an empty key
+        with mock.patch.object(gateways.stripe.WebhookSignature, "verify_header", return_value=True):
+            self.assertEqual(self.post(self.signature("")).status_code, 400)
+        self.assertFalse(store_models.PaymentEvent.objects.exists())
+
+
+# Order ids follow a sequence -> the checkout and payment pages of an order answer its customer only
+class OrderOwnershipTests(TestCase):
+
+    def setUp(self):
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.other = userauths_models.User.objects.create(email="other@example.com", username="other")
+        self.order = store_models.Order.objects.create(customer=self.customer, total=20)
+
+    def test_another_customer_cant_reach_the_order(self):
+        for user in (None, self.other):
+            self.client.logout()
+            if user:
+                self.client.force_login(user)
+            self.assertEqual(self.client.get(reverse("store:checkout", args=[self.order.order_id])).status_code, 404)
+            self.assertEqual(self.client.get(reverse("store:payment_status", args=[self.order.order_id])).status_code, 404)
+            self.assertEqual(self.client.post(reverse("store:payment_session", args=["Stripe", self.order.order_id])).status_code, 404)
+            self.assertEqual(self.client.get(reverse("store:stripe_payment_verify", args=[self.order.order_id]), {"session_id": "cs_1"}).status_code, 404)
+            response = self.client.post(reverse("store:coupon_apply", args=[self.order.order_id]), {"coupon_code": "CODE"})
+            self.assertRedirects(response, reverse("store:cart"), fetch_redirect_response=False)
+        self.assertFalse(store_models.PaymentAttempt.objects.exists())
+
+    def test_the_customer_reaches_the_order(self):
+        self.client.force_login(self.customer)
+        response = self.client.get(reverse("store:payment_status", args=[self.order.order_id]), {"format": "json"})
+        self.assertEqual(response.json()["payment_status"], "failed")
+
+
+# The product detail bundle (price, stock) is only cached when the cache is shared by every worker
+class ProductDetailCacheTests(TestCase):
+
+    def setUp(self):
+        self.product = store_models.Product.objects.create(name="Product", slug="product", status="Published", stock=5, price=10)
+        self.addCleanup(store_cache.invalidate_product_detail, "product")
+
+    @override_settings(STORE_SHARED_CACHE=False)
+    def test_per_process_cache_reads_the_database(self):
+        store_cache.cached_product_detail("product")
+        store_models.Product.objects.filter(pk=self.product.pk).update(price=12, stock=1) # -> as saved by another worker
+        product = store_cache.cached_product_detail("product")
+        self.assertEqual((product.price, product.stock), (12, 1))
+
+    @override_settings(STORE_SHARED_CACHE=True)
+    def test_shared_cache_is_invalidated_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            store_cache.cached_product_detail("product")
+            self.product.price = 12
+            self.product.save()
+        self.assertEqual(store_cache.cached_product_detail("product").price, 12)
+
+
+# Categories are cached under a version bumped on commit, and only in a shared cache
+class CategoryCacheTests(TestCase):
+
+    def setUp(self):
+        self.category = store_models.Category.objects.create(title="Shoes", slug="shoes")
+
+    @override_settings(STORE_SHARED_CACHE=False)
+    def test_per_process_cache_reads_the_database(self):
+        store_cache.cached_categories()
+        store_models.Category.objects.filter(pk=self.category.pk).update(title="Boots") # -> as saved by another worker
+        self.assertEqual([c.title for c in store_cache.cached_categories()], ["Boots"])
+
+    @override_settings(STORE_SHARED_CACHE=True)
+    def test_shared_cache_follows_the_version(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            store_cache.cached_categories()
+            self.category.title = "Boots"
+            self.category.save()
+        self.assertEqual([c.title for c in store_cache.cached_categories()], ["Boots"])
+
+
+# Database cart lines - adding a line twice updates it, and two concurrent adds never make two lines
+class DatabaseCartStoreTests(TransactionTestCase):
+    threads = 2
+
+    def setUp(self):
+        self.product = store_models.Product.objects.create(name="Product", status="Published", stock=10, price=10, shipping=1)
+
+    def test_adding_a_line_again_updates_it(self):
+        store = DatabaseCartStore("12345")
+        line, created = store.add(self.product, 1, color="Red")
+        self.assertTrue(created)
+        line, created = store.add(self.product, 3, color="Red")
+        self.assertFalse(created)
+
+        self.assertEqual(store.totals()["count"], 1)
+        self.assertEqual(store_models.Cart.objects.get().qty, 3) # -> the cart page sends the line's new qty
+        self.assertTrue(store.add(self.product, 1, color="Blue")[1]) # -> another variant is another line
+
+    def test_concurrent_adds_make_one_line(self):
+        results, barrier = [], threading.Barrier(self.threads)
+        def add(qty):
+            barrier.wait()
+            try:
+                for attempt in range(200):
+                    try:
+                        results.append(DatabaseCartStore("12345").add(self.product, qty)[1])
+                        return
+                    except OperationalError: # -> SQLite lets one writer in at a time
+                        time.sleep(random.uniform(0, 0.01))
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=add, args=(qty,)) for qty in range(1, self.threads + 1)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        line = store_models.Cart.objects.get() # -> a single line
+        self.assertIn(line.qty, range(1, self.threads + 1))
+        self.assertEqual((line.sub_total, line.shipping), (10 * line.qty, line.qty))
+        self.assertEqual(sorted(results), [False] * (self.threads - 1) + [True]) # -> only one add created it
+
+
+# Cache cart locks - a change waits for the lock, gives up with CartBusy instead of going ahead without it, and a
+# holder whose lock expired never releases the next holder's lock
+class CacheCartLockTests(SimpleTestCase):
+    key = "cart:test:lock"
+
+    def setUp(self):
+        self.addCleanup(cache.delete_many, [self.key, cart.DIRTY_KEY, cart.DIRTY_LOCK_KEY])
+
+    def test_a_held_cart_is_busy(self):
+        cache.add(self.key, "another holder", 60)
+        with mock.patch.object(cart, "CART_LOCK_TIMEOUT", 0):
+            with self.assertRaises(cart.CartBusy):
+                with cart.cache_lock(self.key):
+                    self.fail("ran without the lock")
+        self.assertEqual(cache.get(self.key), "another holder")
+
+    def test_an_expired_holder_leaves_the_next_lock(self):
+        with cart.cache_lock(self.key):
+            cache.set(self.key, "next holder", 60) # -> this holder's lock expired and was taken meanwhile
+        self.assertEqual(cache.get(self.key), "next holder")
+
+    def test_no_dirty_cart_is_lost(self):
+        workers = [threading.Thread(target=cart.mark_dirty, args=(f"cart-{n}",)) for n in range(20)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(cache.get(cart.DIRTY_KEY), {f"cart-{n}" for n in range(20)})
+
+
+# Coupon rules (store/coupons.py) and the vendor's coupon form
+class CouponRuleTests(TestCase):
+
+    def setUp(self):
+        self.vendor = userauths_models.User.objects.create(email="vendor@example.com", username="vendor")
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.product = store_models.Product.objects.create(name="Product", status="Published", stock=10, price=100, shipping=0, vendor=self.vendor)
+
+    def coupon(self, **rules):
+        return store_models.Coupon.objects.create(vendor=self.vendor, code="SAVE10", discount=10, **rules)
+
+    def order(self):
+        order = store_models.Order.objects.create(customer=self.customer, total=100, sub_total=100, initial_total=100)
+        store_models.OrderItem.objects.create(order=order, product=self.product, vendor=self.vendor, qty=1, price=100, sub_total=100, total=100)
+        with transaction.atomic():
+            inventory.place_holds(order, [CartLine(id=1, product=self.product, qty=1, price=100, sub_total=100, shipping=0, total=100)])
+        return store_models.Order.objects.get(pk=order.pk) # -> Decimal amounts, as coupon_apply reads it
+
+    def test_basket_minimum(self):
+        coupon = self.coupon(min_basket=150)
+        with self.assertRaisesMessage(coupons.CouponError, "at least $150.00"):
+            coupons.apply(self.order(), coupon)
+        coupons.check(coupon, 150)
+
+    def test_validity_window(self):
+        now = timezone.now()
+        with self.assertRaisesMessage(coupons.CouponError, "not valid yet"):
+            coupons.check(self.coupon(valid_from=now + timedelta(days=1)), 100)
+        store_models.Coupon.objects.all().delete()
+        with self.assertRaisesMessage(coupons.CouponError, "expired"):
+            coupons.check(self.coupon(valid_to=now - timedelta(days=1)), 100)
+
+    def test_usage_caps(self):
+        coupon = self.coupon(max_uses=2, max_uses_per_user=1)
+        self.assertEqual(coupons.apply(self.order(), coupon), 10)
+        with self.assertRaisesMessage(coupons.CouponError, "maximum number of times"):
+            with transaction.atomic():
+                coupons.apply(self.order(), coupon) # -> same customer
+
+        other = userauths_models.User.objects.create(email="other@example.com", username="other")
+        coupons.redeem(coupon, other)
+        with self.assertRaisesMessage(coupons.CouponError, "fully redeemed"):
+            coupons.redeem(coupon, userauths_models.User.objects.create(email="third@example.com", username="third"))
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used, 2)
+
+    def test_an_expired_order_gives_its_use_back(self):
+        coupon = self.coupon(max_uses=1, max_uses_per_user=1)
+        order = self.order()
+        coupons.apply(order, coupon)
+
+        store_models.StockHold.objects.update(expires=models.functions.Now())
+        inventory.release_expired_holds()
+        coupon.refresh_from_db()
+        self.assertEqual((coupon.used, store_models.CouponUsage.objects.get().used), (0, 0))
+
+        # paid late all the same -> the use counts again
+        order.payment_status = "Paid"
+        order.save()
+        coupon.refresh_from_db()
+        self.assertEqual((coupon.used, store_models.CouponUsage.objects.get().used), (1, 1))
+
+    def test_malformed_coupon_form(self):
+        self.client.force_login(self.vendor)
+        for rules in ({"valid_from": "yesterday"}, {"min_basket": "ten"}, {"max_uses": "1.5"}, {"coupon_discount": "120"}):
+            response = self.client.post(reverse("vendor:create_coupon"), {"coupon_code": "NEW", "coupon_discount": "10", **rules})
+            self.assertRedirects(response, reverse("vendor:coupons"), fetch_redirect_response=False)
+        self.assertFalse(store_models.Coupon.objects.exists())
+
+        self.client.post(reverse("vendor:create_coupon"), {"coupon_code": "NEW", "coupon_discount": "10", "valid_from": "2026-10-18T10:00"})
+        self.assertEqual(store_models.Coupon.objects.get().valid_from.date().isoformat(), "2026-10-18")
+
+
+class HttpClientTests(SimpleTestCase):
+    def setUp(self):
+        self.http = http_client.HttpClient("Test", timeout=1, retries=2, backoff=0.5, breaker=http_client.CircuitBreaker(2, 30))
+        self.sleep = mock.patch.object(http_client.time, "sleep").start()
+        mock.patch.object(http_client.random, "uniform", side_effect=lambda low, high: high).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def answer(self, *statuses):
+        responses = []
+        for status in statuses:
+            response = requests.Response()
+            response.status_code = status
+            responses.append(response)
+        return mock.patch.object(self.http.session, "request", side_effect=responses)
+
+    def test_retries_with_backoff(self):
+        with self.answer(503, 502, 200) as transport:
+            response = self.http.get("https://gateway.test/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(transport.call_count, 3)
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [0.5, 1.0]) # -> backoff * 2 ** attempt
+        self.assertEqual(self.http.metrics.snapshot()["errors"], 2)
+        self.assertEqual(self.http.breaker.failures, 0)
+
+    def test_a_post_is_not_retried_once_processed(self):
+        with self.answer(502) as transport:
+            self.assertEqual(self.http.post("https://gateway.test/").status_code, 502)
+        self.assertEqual(transport.call_count, 1)
+
+    def test_a_retried_request_is_one_failure(self):
+        with self.answer(503, 503, 503):
+            self.http.get("https://gateway.test/")
+        self.assertEqual(self.http.breaker.failures, 1)
+        self.assertIsNone(self.http.breaker.opened)
+
+    def test_the_breaker_opens_and_half_opens(self):
+        with self.answer(*[503] * 6) as transport:
+            self.http.get("https://gateway.test/")
+            self.http.get("https://gateway.test/")
+            with self.assertRaises(http_client.CircuitOpen):
+                self.http.get("https://gateway.test/")
+        self.assertEqual(transport.call_count, 6)
+
+        self.http.breaker.opened -= 30 # -> the reset time has passed
+        with self.answer(200):
+            self.assertTrue(self.http.breaker.allow()) # -> a trial is in flight...
+            with self.assertRaises(http_client.CircuitOpen):
+                self.http.get("https://gateway.test/") # -> ...no other call goes through meanwhile
+            self.http.breaker.trial = False
+            self.assertEqual(self.http.get("https://gateway.test/").status_code, 200)
+        self.assertIsNone(self.http.breaker.opened)
+
+    def test_a_failed_trial_reopens_the_breaker(self):
+        for _ in range(2):
+            self.http.breaker.failure()
+        self.http.breaker.opened -= 30
+        with self.answer(503, 503, 503):
+            self.http.get("https://gateway.test/")
+        with self.assertRaises(http_client.CircuitOpen):
+            self.http.get("https://gateway.test/")
+
+
+# Pages built from ProductQuerySet run the same queries whether they show one product or many
+class ProductPageQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.vendor = userauths_models.User.objects.create(email="vendor@example.com", username="vendor")
+        self.reviewer = userauths_models.User.objects.create(email="reviewer@example.com", username="reviewer")
+        self.category = store_models.Category.objects.create(title="Shoes", slug="shoes")
+        self.product = self.add_product()
+
+    def add_product(self):
+        product = store_models.Product.objects.create(
+            name="Runner", status="Published", stock=5, price=10, shipping=1, vendor=self.vendor, category=self.category,
+        )
+        store_models.Gallery.objects.create(product=product)
+        variant = store_models.Variant.objects.create(product=product, name="Size")
+        store_models.VariantItem.objects.create(variant=variant, title="M", content="M")
+        store_models.Review.objects.create(product=product, user=self.reviewer, rating=4, active=True)
+        return product
+
+    def queries(self, url):
+        cache.clear() # -> both counts start from a cold cache
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(context)
+
+    def assertSameQueries(self, url, more):
+        self.client.get(url) # -> the session's first request saves it, keep that out of the counts
+        one = self.queries(url)
+        more()
+        self.assertEqual(self.queries(url), one)
+
+    def test_listing_pages(self):
+        for url in (reverse("store:index"), reverse("store:shop"), reverse("store:category", args=[self.category.id])):
+            with self.subTest(url=url):
+                self.assertSameQueries(url, lambda: [self.add_product() for _ in range(5)])
+
+    def test_product_detail(self):
+        def more():
+            for i in range(5):
+                store_models.Gallery.objects.create(product=self.product)
+                variant = store_models.Variant.objects.create(product=self.product, name=f"Variant {i}")
+                store_models.VariantItem.objects.create(variant=variant, title="A", content="A")
+            reviewers = userauths_models.User.objects.bulk_create([
+                userauths_models.User(email=f"reviewer{i}@example.com", username=f"reviewer{i}") for i in range(5)
+            ])
+            for reviewer in reviewers:
+                store_models.Review.objects.create(product=self.product, user=reviewer, rating=5, active=True)
+
+        self.assertSameQueries(reverse("store:product_detail", args=[self.product.slug]), more)
+
+    def test_vendor_pages(self):
+        self.client.force_login(self.vendor)
+        for url in (reverse("vendor:dashboard"), reverse("vendor:products")):
+            with self.subTest(url=url):
+                self.assertSameQueries(url, lambda: [self.add_product() for _ in range(5)])
+
+
+# Creating an order and applying a coupon run the same statements for one line as for many
+class OrderQueryCountTests(TestCase):
+    def setUp(self):
+        self.vendor = userauths_models.User.objects.create(email="vendor@example.com", username="vendor")
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.address = customer_models.Address.objects.create(user=self.customer, country="Nigeria")
+        self.client.force_login(self.customer)
+        session = self.client.session
+        session["cart_id"] = "cart-1"
+        session.save()
+
+    def fill_cart(self, lines):
+        store_models.Cart.objects.filter(cart_id="cart-1").delete()
+        for i in range(lines):
+            product = store_models.Product.objects.create(name=f"Product {i}", status="Published", stock=5, price=10, shipping=1, vendor=self.vendor)
+            store_models.Cart.objects.create(cart_id="cart-1", user=self.customer, product=product, qty=2, price=10, sub_total=20, shipping=2, total=22)
+
+    def create_order(self, lines):
+        self.fill_cart(lines)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse("store:create_order"), {"address": self.address.id})
+        self.assertEqual(response.status_code, 302)
+        return store_models.Order.objects.latest("id"), len(context)
+
+    def test_create_order(self):
+        self.create_order(1) # -> reserves the order and item id blocks, which the next orders draw from
+        _, one = self.create_order(1)
+        order, many = self.create_order(5)
+        self.assertEqual(many, one)
+        self.assertEqual(order.orderitem_set.count(), 5)
+        self.assertEqual(order.stock_holds.count(), 5)
+        self.assertEqual(list(store_models.Product.objects.filter(orderitem__order=order).values_list("stock", flat=True)), [3] * 5)
+
+    def test_create_order_out_of_stock(self):
+        self.fill_cart(3)
+        short = store_models.Product.objects.order_by("id")[1]
+        store_models.Product.objects.filter(pk=short.pk).update(stock=1)
+
+        response = self.client.post(reverse("store:create_order"), {"address": self.address.id})
+        self.assertRedirects(response, reverse("store:cart"), fetch_redirect_response=False)
+        self.assertIn(short.name, str(list(response.wsgi_request._messages)[0]))
+        self.assertFalse(store_models.Order.objects.exists())
+        self.assertEqual(list(store_models.Product.objects.order_by("id").values_list("stock", flat=True)), [5, 1, 5])
+
+    def apply_coupon(self, lines):
+        order, _ = self.create_order(lines)
+        store_models.Coupon.objects.get_or_create(vendor=self.vendor, code="SAVE10", discount=10)
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            self.client.post(reverse("store:coupon_apply", args=[order.order_id]), {"coupon_code": "SAVE10"})
+        return store_models.Order.objects.get(pk=order.pk), len(context)
+
+    def test_coupon_apply(self):
+        self.create_order(1)
+        _, one = self.apply_coupon(1)
+        order, many = self.apply_coupon(5)
+        self.assertEqual(many, one)
+        self.assertEqual(order.saved, Decimal("11.00")) # -> 10% of the five items' totals of 22
+
+
+class ProductRatingTests(TestCase):
+    def setUp(self):
+        self.product = store_models.Product.objects.create(name="Product", status="Published", stock=1, price=10, shipping=0)
+        self.users = userauths_models.User.objects.bulk_create([
+            userauths_models.User(email=f"user{i}@example.com", username=f"user{i}") for i in range(3)
+        ])
+
+    def review(self, user, rating, active=True, product=None):
+        return store_models.Review.objects.create(product=product or self.product, user=user, rating=rating, active=active)
+
+    def assertRating(self, avg, count, product=None):
+        product = store_models.Product.objects.get(pk=(product or self.product).pk)
+        self.assertEqual((product.rating_avg, product.review_count), (avg, count))
+
+    def test_unrated(self):
+        self.assertEqual(self.product.average_rating(), 0)
+        self.review(self.users[0], 5, active=False) # -> only active reviews count
+        self.assertRating(0, 0)
+        self.assertEqual(store_models.Product.objects.get(pk=self.product.pk).average_rating(), 0)
+
+    def test_create(self):
+        self.review(self.users[0], 5)
+        self.review(self.users[1], 2)
+        self.assertRating(3.5, 2)
+        self.assertEqual(store_models.Product.objects.get(pk=self.product.pk).average_rating(), 3.5)
+
+    def test_edit(self):
+        review = self.review(self.users[0], 5)
+        self.review(self.users[1], 3)
+
+        review.rating = 1
+        review.save()
+        self.assertRating(2, 2)
+
+        review.active = False
+        review.save()
+        self.assertRating(3, 1)
+
+        other = store_models.Product.objects.create(name="Other", status="Published", stock=1, price=10, shipping=0)
+        review.active = True
+        review.product = other
+        review.save() # -> moved, both products are recalculated
+        self.assertRating(3, 1)
+        self.assertRating(1, 1, product=other)
+
+    def test_delete(self):
+        review = self.review(self.users[0], 5)
+        self.review(self.users[1], 1)
+        review.delete()
+        self.assertRating(1, 1)
+        store_models.Review.objects.all().delete()
+        self.assertRating(0, 0)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        self.shoes = store_models.Category.objects.create(title="Shoes", slug="shoes")
+        self.hats = store_models.Category.objects.create(title="Hats", slug="hats")
+        self.red_shoe = self.product("Red shoe", self.shoes, colors=["Red"], sizes=["M", "L"])
+        self.blue_shoe = self.product("Blue shoe", self.shoes, colors=["Blue"], sizes=["M"])
+        self.red_hat = self.product("Red hat", self.hats, colors=["Red"])
+        self.draft = self.product("Draft", self.hats, colors=["Red"], status="Draft")
+
+    def product(self, name, category, colors=(), sizes=(), status="Published"):
+        with self.captureOnCommitCallbacks(execute=True): # -> the index is rewritten once the change is committed
+            product = store_models.Product.objects.create(name=name, category=category, status=status, stock=1, price=10, shipping=0)
+            for variant_name, values in (("Color", colors), ("Size", sizes)):
+                variant = store_models.Variant.objects.create(product=product, name=variant_name)
+                for value in values:
+                    store_models.VariantItem.objects.create(variant=variant, title=value, content=value)
+        return product
+
+    def counts(self, facet):
+        return {c["content"]: c["count"] for c in store_models.ProductFacet.objects.counts(facet)}
+
+    def filtered(self, **params):
+        response = self.client.get(reverse("store:filter_products"), {f"{k}[]": v for k, v in params.items()})
+        return response.json()["product_count"]
+
+    def test_counts(self):
+        self.assertEqual(self.counts("Color"), {"Red": 2, "Blue": 1}) # -> drafts are not indexed
+        self.assertEqual(self.counts("Size"), {"M": 2, "L": 1})
+        self.assertEqual(self.counts("Category"), {str(self.shoes.id): 2, str(self.hats.id): 1})
+
+    def test_counts_follow_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.red_hat.category = self.shoes
+            self.red_hat.save()
+            store_models.VariantItem.objects.filter(variant__product=self.blue_shoe).delete()
+        self.assertEqual(self.counts("Category"), {str(self.shoes.id): 3})
+        self.assertEqual(self.counts("Color"), {"Red": 2})
+
+    def test_filter(self):
+        self.assertEqual(self.filtered(colors=["Red"]), 2)
+        self.assertEqual(self.filtered(colors=["Red"], categories=[str(self.shoes.id)]), 1)
+        self.assertEqual(self.filtered(colors=["Red", "Blue"], sizes=["M"]), 2)
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "the default backend of SQLite is FTS5")
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.boots = store_models.Category.objects.create(title="Boots", slug="boots")
+        self.leather = self.product("Leather jacket", "Warm winter coat")
+        self.coat = self.product("Rain coat", "Light jacket for leather shoes")
+        self.hiking = self.product("Hiking shoes", "Leather uppers", category=self.boots)
+
+    def product(self, name, description, category=None, status="Published"):
+        with self.captureOnCommitCallbacks(execute=True): # -> indexed once the product is committed
+            return store_models.Product.objects.create(name=name, description=f"<p>{description}</p>", category=category, status=status, stock=1, price=10, shipping=0)
+
+    def found(self, query, queryset=None):
+        return list(search.search(queryset or store_models.Product.objects.published(), query).values_list("name", flat=True))
+
+    def test_ranking(self):
+        self.assertEqual(self.found("leather")[0], "Leather jacket") # -> a name match beats a description match
+        self.assertEqual(set(self.found("leather")), {"Leather jacket", "Rain coat", "Hiking shoes"})
+        self.assertEqual(self.found("leath jack"), ["Leather jacket", "Rain coat"]) # -> every term, as a prefix
+        self.assertEqual(self.found("boots"), ["Hiking shoes"]) # -> the category title is indexed
+        self.assertEqual(self.found("<p>"), []) # -> markup is not
+        self.assertEqual(self.found("!!"), [])
+
+    def test_ranking_within_the_queryset(self):
+        self.product("Leather draft", "Leather leather", status="Draft")
+        self.assertNotIn("Leather draft", self.found("leather"))
+        self.assertEqual(self.found("leather", store_models.Product.objects.filter(category=self.boots)), ["Hiking shoes"])
+        # -> a capped ranking is still taken among the queryset's products only
+        self.assertEqual(search.get_backend().rank("leather", store_models.Product.objects.filter(category=self.boots), limit=1), [self.hiking.id])
+
+    def test_the_index_follows_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.boots.title = "Footwear"
+            self.boots.save()
+        self.assertEqual(self.found("footwear"), ["Hiking shoes"])
+        self.assertEqual(self.found("boots"), [])
+
+        self.leather.delete()
+        self.assertEqual(self.found("jacket"), ["Rain coat"])
+
+    def test_fallback_without_a_backend(self):
+        with mock.patch.object(search, "get_backend", return_value=None):
+            self.assertEqual(self.found("coat"), ["Rain coat"]) # -> name__icontains, the description isn't searched
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # -> dates tie in threes, so the pages are also cut inside a run of equal dates (the id breaks the tie)
+        store_models.Product.objects.bulk_create([
+            store_models.Product(name=f"Product {i}", slug=f"product-{i}", date=now - timedelta(minutes=i // 3)) for i in range(25)
+        ])
+        self.products = store_models.Product.objects.order_by('-date')
+        self.expected = list(self.products.order_by('-date', '-id').values_list('id', flat=True))
+
+    def walk_forward(self, paginator):
+        pages, page = [], paginator.get_page()
+        while True:
+            pages.append([p.id for p in page])
+            if not page.has_next():
+                return pages, page
+            page = paginator.get_page(page.next_page_number())
+
+    def test_forward_and_back(self):
+        paginator = KeysetPaginator(self.products, 10)
+        pages, last = self.walk_forward(paginator)
+        self.assertEqual([len(p) for p in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), self.expected)
+
+        back, page = [], last
+        while page.has_previous():
+            page = paginator.get_page(page.previous_page_number())
+            back.append([p.id for p in page])
+        self.assertEqual(back, pages[-2::-1])
+        self.assertFalse(paginator.get_page().has_previous())
+
+    def test_last_page_exactly_full(self):
+        store_models.Product.objects.filter(id__in=self.expected[20:]).delete()
+        pages, last = self.walk_forward(KeysetPaginator(self.products, 10))
+        self.assertEqual([len(p) for p in pages], [10, 10]) # -> no empty third page
+        self.assertTrue(last.has_previous())
+
+    def test_bad_cursor_shows_the_first_page(self):
+        paginator = KeysetPaginator(self.products, 10)
+        for cursor in ("garbage", "eyJkIjoibmV4dCJ9"): # -> undecodable, then {"d":"next"} without values
+            self.assertEqual([p.id for p in paginator.get_page(cursor)], self.expected[:10])
+
+    def test_unsupported_ordering_falls_back_to_numbered_pages(self):
+        request = RequestFactory().get("/", {"page": 2})
+        page = paginate_queryset(request, store_models.Product.objects.order_by('category__title', 'id'), 10, keyset=True)
+        self.assertFalse(getattr(page.paginator, "keyset", False))
+        self.assertEqual(page.number, 2)
+
+
+class ProductCardCacheTests(TestCase):
+    template = "partials/_product_card.html"
+
+    def setUp(self):
+        cache.clear()
+        self.category = store_models.Category.objects.create(title="Shoes", slug="shoes")
+        self.product = store_models.Product.objects.create(name="Runner", category=self.category, status="Published", stock=1, price=10, shipping=0)
+
+    def card(self):
+        return str(store_cache.render_product_cards(store_models.Product.objects.for_listing().filter(pk=self.product.pk), self.template)[0])
+
+    def test_cards_are_rendered_once(self):
+        self.card()
+        with mock.patch("django.template.loader.render_to_string") as render:
+            self.card()
+        render.assert_not_called()
+
+    def test_a_change_renders_the_card_again(self):
+        self.assertIn("$10", self.card())
+
+        self.product.price = 12
+        self.product.save()
+        self.assertIn("$12", self.card())
+
+        self.category.title = "Trainers"
+        self.category.save() # -> touches the products of the category
+        self.assertIn("Trainers", self.card())
+
+        user = userauths_models.User.objects.create(email="user@example.com", username="user")
+        store_models.Review.objects.create(product=self.product, user=user, rating=5, active=True)
+        self.assertEqual(self.card().count("fa-star"), 5)
+
+
+class CoPurchaseTests(TestCase):
+    def setUp(self):
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.a, self.b, self.c, self.d = [
+            store_models.Product.objects.create(name=name, status="Published", stock=10, price=10, shipping=0) for name in "ABCD"
+        ]
+
+    def order(self, *products, paid=True):
+        order = store_models.Order.objects.create(customer=self.customer)
+        for product in products:
+            store_models.OrderItem.objects.create(order=order, product=product, qty=1, price=10, sub_total=10, total=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            order.payment_status = "Paid" if paid else "Processing"
+            order.save()
+        return order
+
+    def pairs(self):
+        return set(store_models.RelatedProduct.objects.values_list("product__name", "related__name", "score"))
+
+    def test_paid_orders_are_recorded(self):
+        order = self.order(self.a, self.b)
+        self.order(self.a, self.b, self.c)
+        self.order(self.a, self.d, paid=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save() # -> already paid, not counted twice
+
+        self.assertEqual(self.pairs(), {
+            ("A", "B", 2), ("B", "A", 2), ("A", "C", 1), ("C", "A", 1), ("B", "C", 1), ("C", "B", 1),
+        })
+        self.assertEqual([p.name for p in self.a.related_products()], ["B", "C"])
+
+    def test_rebuild_matches_the_recorded_pairs(self):
+        self.order(self.a, self.b)
+        self.order(self.a, self.b, self.c)
+        self.order(self.a, self.d, paid=False)
+        recorded = self.pairs()
+
+        store_models.RelatedProduct.objects.all().delete()
+        call_command("rebuild_related_products", stdout=mock.MagicMock())
+        self.assertEqual(self.pairs(), recorded)
+
+    @mock.patch.object(store_models.RelatedProduct, "KEEP", 1)
+    def test_only_the_strongest_pairs_are_kept(self):
+        self.order(self.a, self.b)
+        self.order(self.a, self.b)
+        self.order(self.a, self.c)
+        self.assertEqual(list(store_models.RelatedProduct.objects.filter(product=self.a).values_list("related__name", flat=True)), ["B"])
+
+        call_command("rebuild_related_products", stdout=mock.MagicMock())
+        self.assertEqual(list(store_models.RelatedProduct.objects.filter(product=self.a).values_list("related__name", flat=True)), ["B"])
+
+
+class PurgeCartsTests(TestCase):
+    def setUp(self):
+        self.products = [store_models.Product.objects.create(name=f"Product {i}", status="Published", stock=1, price=10, shipping=0) for i in range(3)]
+
+    def line(self, cart_id, product, days_idle):
+        line = store_models.Cart.objects.create(cart_id=cart_id, product=product, qty=1)
+        store_models.Cart.objects.filter(pk=line.pk).update(updated=timezone.now() - timedelta(days=days_idle)) # -> past auto_now
+        return line
+
+    def test_idle_carts_are_deleted_whole(self):
+        for product in self.products:
+            self.line("abandoned", product, 40)
+        self.line("in-use", self.products[0], 40)
+        self.line("in-use", self.products[1], 1) # -> edited yesterday, the whole cart stays
+        self.line("recent", self.products[0], 5)
+
+        out = mock.MagicMock()
+        call_command("purge_carts", "--days", "30", "--batch-size", "2", stdout=out)
+
+        self.assertEqual(sorted(store_models.Cart.objects.values_list("cart_id", flat=True)), ["in-use", "in-use", "recent"])
+        self.assertIn("Deleted 3 lines of 1 carts", out.write.call_args_list[0].args[0])
+
+    def test_expired_sessions_are_deleted(self):
+        Session.objects.create(session_key="expired", session_data="", expire_date=timezone.now() - timedelta(days=1))
+        Session.objects.create(session_key="live", session_data="", expire_date=timezone.now() + timedelta(days=1))
+
+        with self.settings(SESSION_ENGINE="django.contrib.sessions.backends.db"):
+            call_command("purge_carts", stdout=mock.MagicMock())
+        self.assertEqual(list(Session.objects.values_list("session_key", flat=True)), ["live"])
+
+
+class GuestCartMergeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.customer.set_password("secret-password")
+        self.customer.save()
+        self.shoe, self.hat, self.sock = [
+            store_models.Product.objects.create(name=name, status="Published", stock=10, price=10, shipping=1) for name in ("Shoe", "Hat", "Sock")
+        ]
+
+        session = self.client.session
+        session["cart_id"] = "guest"
+        session.save()
+
+    def merged_lines(self, backend):
+        backend("guest").add(self.shoe, 2)
+        backend("guest").add(self.hat, 1, size="M")
+        backend(None, self.customer).add(self.shoe, 1)
+        backend(None, self.customer).add(self.sock, 3)
+
+        self.client.post(reverse("userauths:sign-in"), {"email": "customer@example.com", "password": "secret-password"})
+        self.assertEqual(self.client.session["total_cart_items"], 3)
+        self.assertFalse(backend("guest").lines()) # -> nothing left behind in the guest cart
+        return {(line.product.name, line.size or "", line.qty, line.total) for line in backend(None, self.customer).lines()}
+
+    def test_database_carts(self):
+        self.assertEqual(self.merged_lines(DatabaseCartStore), {("Shoe", "", 3, Decimal("33.00")), ("Hat", "M", 1, Decimal("11.00")), ("Sock", "", 3, Decimal("33.00"))})
+
+    @override_settings(STORE_CART_BACKEND="store.cart.CacheCartStore")
+    def test_cache_carts(self):
+        self.assertEqual(self.merged_lines(cart.CacheCartStore), {("Shoe", "", 3, Decimal("33.00")), ("Hat", "M", 1, Decimal("11.00")), ("Sock", "", 3, Decimal("33.00"))})
+
+    def test_login_without_a_guest_cart(self):
+        session = self.client.session
+        del session["cart_id"]
+        session.save()
+        DatabaseCartStore(None, self.customer).add(self.sock, 1)
+
+        self.client.post(reverse("userauths:sign-in"), {"email": "customer@example.com", "password": "secret-password"})
+        self.assertEqual(len(DatabaseCartStore(None, self.customer).lines()), 1)
+
+
+class ReleaseStockHoldsCommandTests(TestCase):
+    def setUp(self):
+        self.customer = userauths_models.User.objects.create(email="customer@example.com", username="customer")
+        self.shoe, self.hat = [store_models.Product.objects.create(name=name, status="Published", stock=10, price=10, shipping=0) for name in ("Shoe", "Hat")]
+
+    def order(self, *products):
+        order = store_models.Order.objects.create(customer=self.customer)
+        lines = [CartLine(id=i, product=product, qty=2, price=10, sub_total=20, shipping=0, total=20) for i, product in enumerate(products)]
+        with transaction.atomic():
+            inventory.place_holds(order, lines)
+        return order
+
+    def test_only_expired_held_stock_goes_back(self):
+        expired = [self.order(self.shoe, self.hat), self.order(self.shoe)]
+        paid = self.order(self.shoe)
+        self.order(self.hat) # -> still inside its hold time
+        store_models.StockHold.objects.filter(order__in=expired + [paid]).update(expires=timezone.now() - timedelta(minutes=1))
+        store_models.StockHold.objects.filter(order=paid).update(status="Committed")
+
+        out = mock.MagicMock()
+        call_command("release_stock_holds", "--batch-size", "2", stdout=out)
+
+        self.assertIn("Released 3 expired stock holds", out.write.call_args.args[0])
+        self.assertEqual(store_models.StockHold.objects.filter(status="Released").count(), 3)
+        self.assertEqual(dict(store_models.Product.objects.values_list("name", "stock")), {"Shoe": 8, "Hat": 8})
+
+        call_command("release_stock_holds", stdout=out) # -> released holds are never given back twice
+        self.assertEqual(dict(store_models.Product.objects.values_list("name", "stock")), {"Shoe": 8, "Hat": 8})
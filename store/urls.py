@@ -20,11 +20,17 @@ urlpatterns = [
 
     path("payment_status/<order_id>/", views.payment_status, name="payment_status"),
 
-    path('paypal_payment_verify/<order_id>/', views.paypal_payment_verify, name='paypal_payment_verify'), # type: ignore
-    path('stripe_payment/<order_id>/', views.stripe_payment, name='stripe_payment'),
-    path('stripe_payment_verify/<order_id>/', views.stripe_payment_verify, name='stripe_payment_verify'),
-    path('paystack_payment_verify/<order_id>/', views.paystack_payment_verify, name='paystack_payment_verify'),
-    path('flutterwave_payment_callback/<order_id>/', views.flutterwave_payment_callback, name='flutterwave_payment_callback'),
+    path('paypal_payment_verify/<order_id>/', views.payment_verify, {"gateway": "PayPal"}, name='paypal_payment_verify'), # type: ignore
+    path('stripe_payment/<order_id>/', views.payment_session, {"gateway": "Stripe"}, name='stripe_payment'),
+    path('stripe_payment_verify/<order_id>/', views.payment_verify, {"gateway": "Stripe"}, name='stripe_payment_verify'),
+    path('paystack_payment_verify/<order_id>/', views.payment_verify, {"gateway": "Paystack"}, name='paystack_payment_verify'),
+    path('flutterwave_payment_callback/<order_id>/', views.payment_verify, {"gateway": "Flutterwave"}, name='flutterwave_payment_callback'),
+    path('payment_session/<gateway>/<order_id>/', views.payment_session, name='payment_session'),
+
+    path('webhooks/stripe/', views.payment_webhook, {"gateway": "Stripe"}, name='stripe_webhook'),
+    path('webhooks/paypal/', views.payment_webhook, {"gateway": "PayPal"}, name='paypal_webhook'),
+    path('webhooks/paystack/', views.payment_webhook, {"gateway": "Paystack"}, name='paystack_webhook'),
+    path('webhooks/flutterwave/', views.payment_webhook, {"gateway": "Flutterwave"}, name='flutterwave_webhook'),
 
     path("order_tracker_page/", views.order_tracker_page, name="order_tracker_page"),
     path("order_tracker_detail/<item_id>/", views.order_tracker_detail, name="order_tracker_detail"),
@@ -1,24 +1,30 @@
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
+from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt # -> csrf_exempt is used to exempt the view from CSRF verification
 from django.contrib import messages
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.urls import reverse
 from django.template.loader import render_to_string
 from django.core.mail import EmailMultiAlternatives, send_mail # for payment confirmation email
 
 from decimal import Decimal
-import requests
-import stripe
 
 from plugin.service_fee import calculate_service_fee
 from plugin.tax_calculation import tax_calculation
-from plugin.exchange_rate import convert_usd_to_kobo, convert_usd_to_ngn, get_usd_to_ngn_rate
+from plugin.exchange_rate import RatesUnavailable, convert_usd_to_kobo, convert_usd_to_ngn, get_usd_to_ngn_rate
 
 
 from plugin.paginate_queryset import paginate_queryset
 from store import models as store_models
+from store import coupons
+from store import gateways
+from store import inventory
+from store import payments
+from store import search
+from store.cache import cached_product_detail
+from store.cart import CartBusy, get_cart_store
 from customer import models as customer_models
 from vendor import models as vendor_models
 from userauths import models as userauths_models
@@ -27,21 +33,20 @@ from userauths import models as userauths_models
     All Payments use the same payment status for success and failure status are tunnelled in the same
     way, so you can use the same payment status for all payment methods.
 """
- 
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 #! -> Clear Cart Items Functionality
 def clear_cart_items(request):
     try:
         cart_id = request.session['cart_id'] # -> Get the cart_id from the session
-        store_models.Cart.objects.filter(cart_id=cart_id).delete() # -> Delete all items in the cart with the given cart_id
+        get_cart_store(request, cart_id).clear() # -> Delete all items in the cart with the given cart_id
+        request.session['total_cart_items'] = 0 # -> keep the cart counter shown in the navbar in sync
     except:
         pass
     return
 
 # 
 def index(request):
-    products = store_models.Product.objects.filter(status="Published")
+    products = store_models.Product.objects.published().for_listing()
     # categories = store_models.Category.objects.all()
     
     context = {
@@ -53,10 +58,16 @@ def index(request):
 
 # Shop
 def shop(request):
-    products_list = store_models.Product.objects.filter(status="Published")
+    products_list = store_models.Product.objects.published().for_listing()
     categories = store_models.Category.objects.all()
-    colors = store_models.VariantItem.objects.filter(variant__name='Color').values('title', 'content').distinct()
-    sizes = store_models.VariantItem.objects.filter(variant__name='Size').values('title', 'content').distinct()
+
+    # sidebar values and counts come from the precomputed facet index instead of joining the variant tables
+    facets = store_models.ProductFacet.objects
+    colors = facets.counts("Color")
+    sizes = facets.counts("Size")
+    category_counts = {int(c['content']): c['count'] for c in facets.counts("Category")}
+    for c in categories:
+        c.product_count = category_counts.get(c.id, 0) # type: ignore
     item_display = [
         {"id": "1", "value": 1},
         {"id": "2", "value": 2},
@@ -79,9 +90,7 @@ def shop(request):
         {"id": "highest", "value": "Lowest to Highest"},
     ]
 
-    print(sizes)
-
-    products = paginate_queryset(request, products_list, 10)
+    products = paginate_queryset(request, products_list, 10, keyset=True)
 
     context = {
         "products": products,
@@ -100,11 +109,11 @@ def shop(request):
 # Category
 def category(request, id):
     category = store_models.Category.objects.get(id=id)
-    products_list = store_models.Product.objects.filter(status="Published", category=category)
+    products_list = store_models.Product.objects.published().for_listing().filter(category=category)
 
     query = request.GET.get("q")
     if query:
-        products_list = products_list.filter(name__icontains=query)
+        products_list = search.search(products_list, query) # full-text search, best matches first
 
     products = paginate_queryset(request, products_list, 10)
 
@@ -129,13 +138,12 @@ def vendors(request):
 
 #! Product Detail Page 
 def product_detail(request, slug):
-    product = store_models.Product.objects.get(status="Published", slug=slug)
+    product = cached_product_detail(slug) # -> product, gallery, variants and active reviews, cached per slug
     
     # This guy is responsible for the number of products you want to
     product_stock_range = range(1, product.stock + 1) # type: ignore
 
-    related_products = store_models.Product.objects.filter(category=product.category).exclude(id=product.id) # type: ignore 
-    #-> exclude(id=product.id) -> will not display the current product in view in the related products
+    related_products = product.related_products() # -> co-purchased products first, then the same category
 
     context = {
         "product": product,
@@ -169,54 +177,28 @@ def add_to_cart(request):
     except store_models.Product.DoesNotExist:
         return JsonResponse({"error": "Product not found"}, status=404) # page not found error
 
-    # Check if the item is already in the cart
-    existing_cart_item = store_models.Cart.objects.filter(cart_id=cart_id, product=product).first()
-
     # Check if quantity that user is adding exceed item stock qty
     if int(qty) > product.stock: # type: ignore
         return JsonResponse({"error": "Qty exceed current stock amount"}, status=404) # page not found error
 
-    # If the item is not in the cart, create a new cart entry
-    if not existing_cart_item:
-        cart = store_models.Cart()
-        cart.product = product
-        cart.qty = qty
-        cart.price = product.price
-        cart.color = color
-        cart.size = size
-        cart.sub_total = Decimal(product.price) * Decimal(qty) 
-        cart.shipping = Decimal(product.shipping) * Decimal(qty) 
-        cart.total = cart.sub_total + cart.shipping
-        cart.user = request.user if request.user.is_authenticated else None
-        cart.cart_id = cart_id
-        cart.save()
-
-        message = "Item added to cart"  
-    else:
-        # If the item exists in the cart, update the existing entry
-        existing_cart_item.color = color
-        existing_cart_item.size = size
-        existing_cart_item.qty = qty
-        existing_cart_item.price = product.price
-        existing_cart_item.sub_total = Decimal(product.price) * Decimal(qty) 
-        existing_cart_item.shipping = Decimal(product.shipping) * Decimal(qty) 
-        existing_cart_item.total = existing_cart_item.sub_total +  existing_cart_item.shipping
-        existing_cart_item.user = request.user if request.user.is_authenticated else None
-        existing_cart_item.cart_id = cart_id
-        existing_cart_item.save()
-
-        message = "Cart updated"
+    # Create the cart entry, or update it if the item is already in the cart (cart store -> store/cart.py)
+    cart_store = get_cart_store(request, cart_id)
+    try:
+        item, created = cart_store.add(product, qty, color=color, size=size)
+    except CartBusy:
+        return JsonResponse({"error": "Your cart is being updated, please try again"}, status=409)
+    message = "Item added to cart" if created else "Cart updated"
 
     # Count the total number of items in the cart
-    total_cart_items = store_models.Cart.objects.filter(cart_id=cart_id)
-    cart_sub_total = store_models.Cart.objects.filter(cart_id=cart_id).aggregate(sub_total = models.Sum("sub_total"))['sub_total'] # type: ignore
+    totals = cart_store.totals()
+    request.session['total_cart_items'] = totals["count"] # -> read by the context processor for the navbar counter
 
     # Return the response with the cart update message and total cart items
     return JsonResponse({
         "message": message ,
-        "total_cart_items": total_cart_items.count(),
-        "cart_sub_total": "{:,.2f}".format(cart_sub_total), # {:,.2f} -> creates comas(,) and decimal points(.) to amounts
-        "item_sub_total": "{:,.2f}".format(existing_cart_item.sub_total) if existing_cart_item else "{:,.2f}".format(cart.sub_total) 
+        "total_cart_items": totals["count"],
+        "cart_sub_total": "{:,.2f}".format(totals["sub_total"]), # {:,.2f} -> creates comas(,) and decimal points(.) to amounts
+        "item_sub_total": "{:,.2f}".format(item.sub_total)
     })
 
 
@@ -227,8 +209,9 @@ def cart(request): # -> this guy is responsible for displaying the items in the
     else:
         cart_id = None
 
-    items = store_models.Cart.objects.filter(cart_id=cart_id) # Retrieve all items in the cart for the current session
-    cart_sub_total = store_models.Cart.objects.filter(cart_id=cart_id).aggregate(sub_total = models.Sum("sub_total"))['sub_total']
+    cart_store = get_cart_store(request, cart_id)
+    items = cart_store.lines() # Retrieve all items in the cart for the current session
+    cart_sub_total = cart_store.totals()["sub_total"]
     # this guy will get the sub_total of the items in the cart  
     
     try: # -> try to get the addresses of the user
@@ -264,18 +247,23 @@ def delete_cart_item(request):
     except store_models.Product.DoesNotExist: # -> If the product does not exist, return an error
         return JsonResponse({"error": "Product not found"}, status=404)
 
-    # Check if the item is already in the cart
-    item = store_models.Cart.objects.get(product=product, id=item_id)
-    item.delete() # -> Delete the item from the cart if it exists
+    # Delete the item from the cart if it exists
+    cart_store = get_cart_store(request, cart_id)
+    try:
+        removed = cart_store.remove(product, item_id)
+    except CartBusy:
+        return JsonResponse({"error": "Your cart is being updated, please try again"}, status=409)
+    if not removed:
+        return JsonResponse({"error": "Item not found in cart"}, status=404)
 
     # Count the total number of items in the cart
-    total_cart_items = store_models.Cart.objects.filter(cart_id=cart_id)
-    cart_sub_total = store_models.Cart.objects.filter(cart_id=cart_id).aggregate(sub_total = models.Sum("sub_total"))['sub_total']
+    totals = cart_store.totals()
+    request.session['total_cart_items'] = totals["count"] # -> read by the context processor for the navbar counter
 
     return JsonResponse({
         "message": "Item deleted",
-        "total_cart_items": total_cart_items.count(),
-        "cart_sub_total": "{:,.2f}".format(cart_sub_total) if cart_sub_total else 0.00
+        "total_cart_items": totals["count"],
+        "cart_sub_total": "{:,.2f}".format(totals["sub_total"]) if totals["sub_total"] else 0.00
     })
 
 
@@ -298,58 +286,91 @@ def create_order(request):
         else:
             cart_id = None # -> if it doesn't exist, set cart_id to None
 
-        # Retrieve all items in the cart for the current session
-        items = store_models.Cart.objects.filter(cart_id=cart_id) # Retrieve all items in the cart for the current session
-        
-        # this guy will get the sub_total of the items in the cart if there is
-        cart_sub_total = store_models.Cart.objects.filter(cart_id=cart_id).aggregate(sub_total = models.Sum("sub_total"))['sub_total'] 
+        cart_store = get_cart_store(request, cart_id)
+        cart_store.persist() # -> a cache-backed cart is written to the Cart table once, at checkout
 
-        # this guy will get the shipping total of the items in the cart if there is
-        cart_shipping_total = store_models.Cart.objects.filter(cart_id=cart_id).aggregate(shipping = models.Sum("shipping"))['shipping']
-        
+        # Retrieve all items in the cart for the current session - once, with their products and vendors
+        items = cart_store.lines()
 
-        order = store_models.Order() # -> Create a new order instance - more like getting it ready to put something
-        order.sub_total = cart_sub_total # -> Set the sub_total of the order to the cart sub_total
-        order.customer = request.user # -> Set the customer of the order to the current user
-        order.address = address # -> Set the address of the order to the selected address
-        order.shipping = cart_shipping_total # -> Set the shipping total of the order to the cart shipping total
-        order.tax = tax_calculation(address.country, cart_sub_total) # type: ignore # -> Calculate the tax based on the address country and cart sub_total
-        order.total = order.sub_total + order.shipping + Decimal(order.tax) # -> Set the total of the order to the sum of sub_total, shipping, and tax
-        order.service_fee = calculate_service_fee(order.total) # -> Calculate the service fee based on the order total
-        order.total += order.service_fee # -> Add the service fee to the total of the order
-        order.initial_total = order.total
-        order.save()
-
-
-        for i in items: # -> Loop through each item in the cart
-            store_models.OrderItem.objects.create( # -> Create a new order item for each item in the cart
-                order=order,
-                product=i.product,
-                qty=i.qty,
-                color=i.color,
-                size=i.size,
-                price=i.price,
-                sub_total=i.sub_total,
-                shipping=i.shipping,
-                tax=tax_calculation(address.country, i.sub_total), # type: ignore
-                total=i.total,
-                initial_total=i.total,
-                vendor=i.product.vendor
-            )
-
-            order.vendors.add(i.product.vendor) # -> Add the vendor of the product to the order vendors
-            #* Note: The order.vendors is a ManyToManyField in the Order model, so you can add multiple vendors to the order if there are multiple products from different vendors in the cart which is just the logic above it -> order.vendors.add(i.product.vendor)
+        if not items: # -> nothing to order
+            messages.warning(request, "No item in cart")
+            return redirect("store:cart")
+
+        # this guy will get the sub_total and the shipping total of the items in the cart - from the lines already loaded
+        cart_sub_total = sum((i.sub_total for i in items), Decimal("0.00"))
+        cart_shipping_total = sum((i.shipping for i in items), Decimal("0.00"))
+
+        # -> the order, its items, its vendors and the stock it holds are written together or not at all
+        try:
+            with transaction.atomic():
+                order = store_models.Order() # -> Create a new order instance - more like getting it ready to put something
+                order.sub_total = cart_sub_total # -> Set the sub_total of the order to the cart sub_total
+                order.customer = request.user # -> Set the customer of the order to the current user
+                order.address = address # -> Set the address of the order to the selected address
+                order.shipping = cart_shipping_total # -> Set the shipping total of the order to the cart shipping total
+                order.tax = tax_calculation(address.country, cart_sub_total) # type: ignore # -> Calculate the tax based on the address country and cart sub_total
+                order.total = order.sub_total + order.shipping + Decimal(order.tax) # -> Set the total of the order to the sum of sub_total, shipping, and tax
+                order.service_fee = calculate_service_fee(order.total) # -> Calculate the service fee based on the order total
+                order.total += order.service_fee # -> Add the service fee to the total of the order
+                order.initial_total = order.total
+                order.save()
+
+                # -> one INSERT for all the order items instead of one per cart line
+                store_models.OrderItem.objects.bulk_create([
+                    store_models.OrderItem(
+                        order=order,
+                        product=i.product,
+                        qty=i.qty,
+                        color=i.color,
+                        size=i.size,
+                        price=i.price,
+                        sub_total=i.sub_total,
+                        shipping=i.shipping,
+                        tax=tax_calculation(address.country, i.sub_total), # type: ignore
+                        total=i.total,
+                        initial_total=i.total,
+                        vendor=i.product.vendor
+                    )
+                    for i in items
+                ])
+
+                # -> Add the vendors of the products to the order vendors, in one INSERT into the order.vendors through table
+                #* Note: The order.vendors is a ManyToManyField in the Order model, so you can add multiple vendors to the order if there are multiple products from different vendors in the cart
+                vendor_ids = {i.product.vendor_id for i in items if i.product.vendor_id}
+                store_models.Order.vendors.through.objects.bulk_create(
+                    [store_models.Order.vendors.through(order_id=order.id, user_id=vendor_id) for vendor_id in vendor_ids],
+                    ignore_conflicts=True,
+                )
+
+                # -> take the ordered qty off the stock now, it is given back if the order isn't paid in time
+                inventory.place_holds(order, items)
+        except inventory.OutOfStock as e:
+            messages.warning(request, f"Sorry, {e.product.name} doesn't have enough stock left for your order")
+            return redirect("store:cart")
     
     return redirect("store:checkout", order.order_id)
     # You can only be redirected to the checkout page if you make an order and -> order.order_id - means order with its ID
 
 
+# Order ids come from a sequence (store/ids.py) and are easy to guess -> the checkout and payment pages only ever
+# find the orders of the logged in customer, anyone else gets a 404
+def customer_orders(request):
+    if not request.user.is_authenticated:
+        return store_models.Order.objects.none()
+    return store_models.Order.objects.filter(customer=request.user)
+
+def customer_order(request, order_id):
+    order = customer_orders(request).filter(order_id=order_id).first()
+    if order is None:
+        raise Http404("Order not found")
+    return order
+
+
 #! Coupon Functionality
 def coupon_apply(request, order_id):
     
     try: 
-        order = store_models.Order.objects.get(order_id=order_id) # -> Get the order with the given order_id
-        order_items = store_models.OrderItem.objects.filter(order=order) # -> Get all order items associated with the order
+        order = customer_orders(request).get(order_id=order_id) # -> Get the order with the given order_id
         
     except store_models.Order.DoesNotExist: # -> If the order does not exist, return an error message
         messages.error(request, "Order not found")
@@ -362,41 +383,31 @@ def coupon_apply(request, order_id):
             messages.error(request, "No coupon entered")
             return redirect("store:checkout", order.order_id)
             
-        try: # -> Try to fetch the coupon using the code
-            coupon = store_models.Coupon.objects.get(code=coupon_code) # -> Get the coupon with the given code
-            
-        except store_models.Coupon.DoesNotExist: # -> If the coupon does not exist, return an error message
-            messages.error(request, "Coupon does not exist")
+        # The coupon rules and the set-based application live in store/coupons.py
+        try:
+            with transaction.atomic():
+                order = store_models.Order.objects.select_for_update().get(pk=order.pk) # -> two tabs applying coupons to the same order wait for each other
+
+                # -> codes are unique per vendor, so the code picks at most one coupon per vendor of the order
+                vendor_ids = set(order.vendors.values_list('id', flat=True))
+                candidates = [c for c in coupons.cached_coupons(coupon_code) if c.vendor_id in vendor_ids]
+                if not candidates: # -> If the coupon does not exist, return an error message
+                    messages.error(request, "Coupon does not exist")
+                    return redirect("store:checkout", order.order_id)
+
+                applied = set(order.coupons.values_list('id', flat=True))
+                if all(c.id in applied for c in candidates): # -> Check if the coupon is already applied to the order
+                    messages.warning(request, "Coupon already activated")
+                    return redirect("store:checkout", order.order_id)
+
+                for coupon in candidates:
+                    if coupon.id not in applied:
+                        coupons.apply(order, coupon)
+
+        except coupons.CouponError as e: # -> a rule failed, nothing was applied
+            messages.error(request, str(e))
             return redirect("store:checkout", order.order_id)
         
-        if coupon in order.coupons.all(): # -> Check if the coupon is already applied to the order
-            messages.warning(request, "Coupon already activated")
-            return redirect("store:checkout", order.order_id)
-        
-        
-        else: # -> If the coupon is not already applied, proceed to apply it
-            total_discount = 0 # -> Initialize total discount to 0
-            
-            # Note: If a vendor gives you a coupon and you select two items from different vendors, the coupon will only apply to the items from the vendor that issued the coupon to you not with the other vendors items
-            for item in order_items: # -> Loop through each order item
-                # -> Check if the coupon is applicable to the item and not already applied, if its already applied, it will not apply again, it will throw the error of (Coupon does not exist) as done above,  
-                if coupon.vendor == item.product.vendor and coupon not in item.coupon.all(): 
-                    item_discount = item.total * coupon.discount / 100  # Discount for this item
-                    total_discount += item_discount # -> Add the item discount to the total discount
-
-                    item.coupon.add(coupon) # -> Add the coupon to the item
-                    item.total -= item_discount # -> Subtract the item discount from the item total
-                    item.saved += item_discount # -> Add the item discount to the item saved amount
-                    item.save() # -> Save the item with the updated totals
-
-            # Apply total discount to the order after processing all items
-            if total_discount > 0: # -> If there is a total discount, apply it to the order
-                order.coupons.add(coupon) # -> Add the coupon to the order
-                order.total -= total_discount # -> Subtract the total discount from the order total
-                order.sub_total -= total_discount # -> Subtract the total discount from the order sub_total
-                order.saved += total_discount # -> Add the total discount to the order saved amount
-                order.save() # -> Save the order with the updated totals
-        
         messages.success(request, "Coupon Activated")
         return redirect("store:checkout", order.order_id)
 
@@ -404,15 +415,19 @@ def coupon_apply(request, order_id):
 #! Checkout Functionality - The Checkout payments functionalities and contexts should come after writing each of the payments method except -> order = store_models.Order.objects.get(order_id=order_id)
 def checkout(request, order_id):
     # This guy will come first then after writing payment methods you start passing them in the conext
-    order = store_models.Order.objects.get(order_id=order_id) # -> Get the order with the given order_id
+    order = customer_order(request, order_id) # -> Get the order with the given order_id
     
-    amount_in_kobo = convert_usd_to_kobo(order.total)
-    amount_in_ngn = convert_usd_to_ngn(order.total)
+    try:
+        amount_in_kobo = convert_usd_to_kobo(order.total)
+        amount_in_ngn = round(convert_usd_to_ngn(order.total), 2)
+    except RatesUnavailable: # -> no rate has ever been fetched and the exchange rate API is down
+        amount_in_kobo = amount_in_ngn = None
+        messages.warning(request, "Naira payments (Paystack, Flutterwave) are unavailable right now, please try again later")
 
     context = {
         "order": order,
         "amount_in_kobo":amount_in_kobo,
-        "amount_in_ngn":round(amount_in_ngn, 2),
+        "amount_in_ngn":amount_in_ngn,
         
         "stripe_public_key": settings.STRIPE_PUBLIC_KEY,
         "paypal_client_id": settings.PAYPAL_CLIENT_ID, # coming from paypal configuration
@@ -423,221 +438,90 @@ def checkout(request, order_id):
     return render(request, "store/checkout.html", context)
 
 
-#! Stripe Payment Functionality
-# -> This is the function that will handle the stripe payment
-@csrf_exempt
-def stripe_payment(request, order_id):
-    order = store_models.Order.objects.get(order_id=order_id) # -> Get the order with the given order_id
-    stripe.api_key = settings.STRIPE_SECRET_KEY # -> Set the Stripe secret key from settings
-
-    checkout_session = stripe.checkout.Session.create( # -> Create a new checkout session with Stripe
-        customer_email = order.address.email,
-        payment_method_types=['card'],
-        line_items = [
-            {
-                'price_data': {
-                    'currency': 'USD',
-                    'product_data': {
-                        'name': order.address.full_name
-                    },
-                    'unit_amount': int(order.total * 100) # -> Convert the total amount to cents (Stripe requires amounts in cents)
-                },
-                'quantity': 1 # -> Set the quantity to 1 since we are charging for the entire order
-            }
-        ],
-        mode = 'payment',
-        success_url = request.build_absolute_uri(reverse("store:stripe_payment_verify", args=[order.order_id])) + "?session_id={CHECKOUT_SESSION_ID}" + "&payment_method=Stripe", # -> Redirect to this URL on successful payment with the session ID and payment method
-        cancel_url = request.build_absolute_uri(reverse("store:stripe_payment_verify", args=[order.order_id])) # -> Redirect to this URL on payment cancellation with the session ID and order ID
-    )
-
-    # print("checkkout session", checkout_session)
-    return JsonResponse({"sessionId": checkout_session.id}) # checkout_session -> has been given to (sessionId) and will be redirected accoording to the payment status
+#! Payment Sessions
+# The gateways' hosted payment pages are started through the gateway adapters (store/gateways.py). The Stripe
+# button of the checkout page posts to stripe_payment/<order_id>/ and hands sessionId to Stripe.js, the others
+# can be started at payment_session/<gateway>/<order_id>/ and send the customer to redirect_url.
+RETURN_VIEWS = {
+    "Stripe": "store:stripe_payment_verify",
+    "PayPal": "store:paypal_payment_verify",
+    "Paystack": "store:paystack_payment_verify",
+    "Flutterwave": "store:flutterwave_payment_callback",
+}
 
+@csrf_exempt
+@require_POST
+def payment_session(request, order_id, gateway):
+    order = customer_order(request, order_id) # -> Get the order with the given order_id
 
-#! Stripe Payment Verification Functionality
-def stripe_payment_verify(request, order_id):
-    order = store_models.Order.objects.get(order_id=order_id) # -> Get the order with the given order_id
-
-    session_id = request.GET.get("session_id") # -> Get the session ID from the request
-    session = stripe.checkout.Session.retrieve(session_id) # -> Retrieve the checkout session from Stripe using the session ID
-
-    if session.payment_status == "paid": # -> Check if the payment status of the session is "paid"
-        if order.payment_status == "Processing": # -> but you have to Check if the order payment status is "Processing"
-            order.payment_status = "Paid" # but if its successfull
-            order.save() # save it
+    try:
+        adapter = gateways.get_gateway(gateway)
+    except gateways.GatewayError:
+        raise Http404("Unknown payment gateway")
 
-            # -> Clear the cart items after successful payment
-            clear_cart_items(request)
-            
-            # Email Configuration
-            # #  -> Prepare the data to be used in the email template for the customer
-            # customer_merge_data = { 
-            #     'order': order,
-            #     'order_items': order.order_items(),
-            # }
-            
-            # # Send Order Emails to Customer
-            # subject = f"New Order!"
-            # text_body = render_to_string("email/order/customer/customer_new_order.txt", customer_merge_data)
-            # html_body = render_to_string("email/order/customer/customer_new_order.html", customer_merge_data)
-
-            # # -> Create a new email message
-            # msg = EmailMultiAlternatives( 
-            #     subject=subject, from_email=settings.FROM_EMAIL,
-            #     to=[order.address.email], body=text_body
-            # )
-            
-            # msg.attach_alternative(html_body, "text/html") # -> Attach the HTML alternative to the email message
-            # # -> Send the email message to the customer
-            # msg.send()
-            
-            # # Create a notification of purchase order for the user - that's after placing the order
-            customer_models.Notifications.objects.create(type="New Order", user=request.user) 
-            # -> Create a new notification for the user
-
-
-            # Send Order Emails to Vendors - the items that have been purchased by the customer
-            # -> Loop through each item in the order and send an email to the vendor 
-            for item in order.order_items():
-                
-            #     vendor_merge_data = {
-            #         'item': item,
-            #     }
-                
-            #     subject = f"New Sale!"
-            #     text_body = render_to_string("email/order/vendor/vendor_new_order.txt", vendor_merge_data)
-            #     html_body = render_to_string("email/order/vendor/vendor_new_order.html", vendor_merge_data)
-
-            #     msg = EmailMultiAlternatives(
-            #         subject=subject, from_email=settings.FROM_EMAIL,
-            #         to=[item.vendor.email], body=text_body
-            #         # Note: items is the variable name of the loop
-            #     )
-                
-            #     msg.attach_alternative(html_body, "text/html") # -> Attach the HTML alternative to the email message
-            #     # -> Send the email message to the Vendor
-            #     msg.send()
-            
-            #     # Create a notification of sale order for the vendor - that's after customer place an order
-                vendor_models.Notifications.objects.create(type="New Sale", user=item.vendor, order=item) 
-            #     # -> Create a new notification for the user
-            #     # Note: The order is passed to the notification so that the vendor can see the order details in the notification
+    return_url = request.build_absolute_uri(reverse(RETURN_VIEWS[gateway], args=[order.order_id])) # -> the gateway sends the customer back here
+    try:
+        session = adapter.create_session(order, return_url)
+    except (gateways.GatewayError, RatesUnavailable) as e:
+        return JsonResponse({"error": str(e)}, status=502)
 
-            return redirect(f"/payment_status/{order.order_id}/?payment_status=paid") # -> Redirect to the payment status page with the order ID and payment status as "paid"
-    
-    return redirect(f"/payment_status/{order.order_id}/?payment_status=failed") # # -> If the payment status is not "paid", redirect to the payment status page with the order ID and payment status as "failed"
-    
-    
-    
-#! Paypal Configuration
-# Get the access first
-def get_paypal_access_token():
-    token_url = 'https://api.sandbox.paypal.com/v1/oauth2/token' # Use the sandbox URL for testing
-    data = {'grant_type': 'client_credentials'} # grant_type is client_credentials for PayPal API
-    auth = (settings.PAYPAL_CLIENT_ID, settings.PAYPAL_SECRET_ID) # Use your PayPal client ID and secret ID from settings
-    response = requests.post(token_url, data=data, auth=auth) # Make a POST request to get the access token
-
-    if response.status_code == 200:
-        return response.json()['access_token']
-    else:
-        raise Exception(f'Failed to get access token from PayPal. Status code: {response.status_code}') 
+    return JsonResponse({"sessionId": session["reference"], "redirect_url": session["redirect_url"]}) # sessionId -> is given to Stripe.js for the redirection
 
-#! PayPal Payment Functionality
-def paypal_payment_verify(request, order_id):
-    order = store_models.Order.objects.get(order_id=order_id) # Get the order with the given order_id
 
-    transaction_id = request.GET.get("transaction_id") # Get the transaction ID from the request
-    paypal_api_url = f'https://api-m.sandbox.paypal.com/v2/checkout/orders/{transaction_id}' # Use the sandbox URL for testing
-    headers = { # Set the headers for the request
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {get_paypal_access_token()}',
-    }
-    response = requests.get(paypal_api_url, headers=headers)
-
-    if response.status_code == 200: # Check if the response status code is 200 (OK)
-        paypal_order_data = response.json() # Parse the JSON response to get the order data
-        paypal_payment_status = paypal_order_data['status'] # Get the payment status from the order data
-        if paypal_payment_status == 'COMPLETED': # -> Check if the payment status is COMPLETED
-            if order.payment_status == "Processing": # -> Check if the order payment status is Processing
-                order.payment_status = "Paid" # -> Update the order payment status to Paid
-                payment_method = request.GET.get("payment_method") # Get the payment method from the request (url)
-                order.payment_method = payment_method # -> Set the payment method for the order
-                order.save()
-                clear_cart_items(request) # Clear the cart items after successful payment
-                return redirect(f"/payment_status/{order.order_id}/?payment_status=paid")
-    else:
-        return redirect(f"/payment_status/{order.order_id}/?payment_status=failed")
+#! Payment Verification Functionality
+# The gateways send the customer back to these pages (stripe_payment_verify, paypal_payment_verify, ... in
+# store/urls.py) with the payment reference. They don't call the gateway: the reference is recorded
+# (payments.check_later queues a check for `manage.py process_payment_events`) and the customer goes to the payment
+# status page, which waits for the outcome - a webhook usually has it recorded by then.
+def payment_verify(request, order_id, gateway):
+    order = customer_order(request, order_id) # -> Get the order with the given order_id
+    adapter = gateways.get_gateway(gateway)
+    # -> missing when the payment was cancelled
+    reference = next((request.GET[param] for param in adapter.reference_params if request.GET.get(param)), None)
+    return payment_redirect(order, gateway, reference)
 
 
-# Paystack Integration
-def paystack_payment_verify(request, order_id):
-    order = store_models.Order.objects.get(order_id=order_id) # Get the order with the given order_id
-    reference = request.GET.get('reference', '') 
-    # Get the reference from the request, which is used to verify the payment - if reference is not appended return an empty string
-
-    if reference: # Check if the reference is provided in the request
-        headers = { # Set the headers for the request to Paystack API
-            "Authorization": f"Bearer {settings.PAYSTACK_PRIVATE_KEY}",
-            "Content-Type": "application/json"
-        }
-
-        # Verify the transaction
-        response = requests.get(f'https://api.paystack.co/transaction/verify/{reference}', headers=headers)
-        response_data = response.json()
-
-        # Check if the response is successful
-        if response_data['status']:
-            if response_data['data']['status'] == 'success':
-                if order.payment_status == "Processing":
-                    order.payment_status = "Paid"
-                    payment_method = request.GET.get("payment_method")
-                    order.payment_method = payment_method
-                    order.save()
-                    
-                    clear_cart_items(request)
-                    
-                    return redirect(f"/payment_status/{order.order_id}/?payment_status=paid")
-                else:
-                    return redirect(f"/payment_status/{order.order_id}/?payment_status=failed")
-            else:
-                # Payment failed
-                return redirect(f"/payment_status/{order.order_id}/?payment_status=failed")
-        else:
-            return redirect(f"/payment_status/{order.order_id}/?payment_status=failed")
-    else:
+def payment_redirect(order, gateway, reference):
+    if not reference or payments.check_later(order, gateway, reference) == "Failed":
         return redirect(f"/payment_status/{order.order_id}/?payment_status=failed")
+    return redirect(f"/payment_status/{order.order_id}/")
 
 
-#! Flutterwave Integration
-def flutterwave_payment_callback(request, order_id):
-    order = store_models.Order.objects.get(order_id=order_id)
-
-    payment_id = request.GET.get('tx_ref')
-    status = request.GET.get('status')
+#! Payment Webhooks
+# Signed events from the gateways go straight into the payment inbox (store/payments.py) - the response never
+# waits on the gateway or on the order updates; a bad signature is refused so the gateway doesn't retry it
+@csrf_exempt
+@require_POST
+def payment_webhook(request, gateway):
+    adapter = gateways.get_gateway(gateway)
+    received = adapter.webhook_payload(request.body, request.headers)
+    if received is None:
+        return HttpResponse(status=adapter.rejected_status)
 
-    headers = {
-        'Authorization': f'Bearer {settings.FLUTTERWAVE_PRIVATE_KEY}'
-    }
-    response = requests.get(f'https://api.flutterwave.com/v3/charges/verify_by_id/{payment_id}', headers=headers)
-
-    if response.status_code == 200:
-        if order.payment_status == "Processing":
-            order.payment_status = "Paid"
-            payment_method = request.GET.get("payment_method")
-            order.payment_method = payment_method
-            order.save()
-            clear_cart_items(request)
-            return redirect(f"/payment_status/{order.order_id}/?payment_status=paid")
-        else:
-            return redirect(f"/payment_status/{order.order_id}/?payment_status=failed")
-    else:
-        return redirect(f"/payment_status/{order.order_id}/?payment_status=failed")
+    payload, headers, verified = received
+    payments.receive(gateway, payload, headers=headers, verified=verified) # -> verified is False when the worker checks the signature (PayPal)
+    return HttpResponse(status=200)
 
 
 # Payment Status Functionality
+# The status comes from the order and the payment ledger; while a payment is still being confirmed the page polls
+# this view (?format=json) and reloads once there is an outcome
 def payment_status(request, order_id):
-    order = store_models.Order.objects.get(order_id=order_id) # Get the order with the given order_id
-    payment_status = request.GET.get("payment_status") # Get the payment status from the request -> from the search url
+    # -> the ledger is read before the order: the worker updates both in one transaction, so a payment recorded
+    #    between the two reads shows as paid instead of neither pending nor paid
+    pending = store_models.PaymentAttempt.objects.filter(order__in=customer_orders(request), order__order_id=order_id, status="Pending").exists()
+    order = customer_order(request, order_id) # Get the order with the given order_id
+
+    if order.payment_status == "Paid":
+        payment_status = "paid"
+        clear_cart_items(request) # Clear the cart items after successful payment
+    elif request.GET.get("payment_status") != "failed" and pending:
+        payment_status = "pending"
+    else:
+        payment_status = "failed"
+
+    if request.GET.get("format") == "json":
+        return JsonResponse({"payment_status": payment_status})
 
     context = {
         "order": order,
@@ -645,15 +529,17 @@ def payment_status(request, order_id):
     }
     return render(request, "store/payment_status.html", context)
 
+
 # Filter Products
 def filter_products(request):
-    products = store_models.Product.objects.all()
+    products = store_models.Product.objects.published().for_listing()
 
     # Get filters from the AJAX request
     categories = request.GET.getlist('categories[]')
     rating = request.GET.getlist('rating[]')
     sizes = request.GET.getlist('sizes[]')
     colors = request.GET.getlist('colors[]')
+    price_bands = request.GET.getlist('price_bands[]')
     price_order = request.GET.get('prices')
     search_filter = request.GET.get('searchFilter')
     display = request.GET.get('display')
@@ -667,23 +553,32 @@ def filter_products(request):
     # print("display =======", display)
 
    
+    # Each selected facet narrows the products to the ids indexed under its values (IN subqueries on the facet index, no DISTINCT joins)
+    facets = store_models.ProductFacet.objects
+
     # Apply category filtering
     if categories:
-        products = products.filter(category__id__in=categories)
+        products = products.filter(id__in=facets.product_ids("Category", categories))
 
     # Apply rating filtering
     if rating:
-        products = products.filter(reviews__rating__in=rating).distinct()
+        products = products.filter(id__in=facets.product_ids("Rating", rating))
 
-    
+    # Apply price band filtering
+    if price_bands:
+        products = products.filter(id__in=facets.product_ids("Price", price_bands))
 
     # Apply size filtering
     if sizes:
-        products = products.filter(variant__variant_items__content__in=sizes).distinct()
+        products = products.filter(id__in=facets.product_ids("Size", sizes))
 
     # Apply color filtering
     if colors:
-        products = products.filter(variant__variant_items__content__in=colors).distinct()
+        products = products.filter(id__in=facets.product_ids("Color", colors))
+
+    # Apply search filter - results come back in relevance order unless a price ordering is picked below
+    if search_filter:
+        products = search.search(products, search_filter)
 
     # Apply price ordering
     if price_order == 'lowest':
@@ -691,10 +586,6 @@ def filter_products(request):
     elif price_order == 'highest':
         products = products.order_by('price')
 
-    # Apply search filter
-    if search_filter:
-        products = products.filter(name__icontains=search_filter)
-
     if display:
         products = products.filter()[:int(display)]
 
@@ -706,19 +597,35 @@ def filter_products(request):
 
 
 # Tracking Order
+# Item ids come from a sequence (store/ids.py) and are easy to guess -> the email of the order is asked too, and the
+# items found are remembered in the session, the detail page shows no other item (except to the customer of the order)
+TRACKED_ITEMS = 20
+
 def order_tracker_page(request):
     if request.method == "POST":
         item_id = request.POST.get("item_id")
-        return redirect("store:order_tracker_detail", item_id)
+        email = (request.POST.get("email") or "").strip().lower()
+        item = store_models.OrderItem.objects.filter(models.Q(item_id=item_id) | models.Q(tracking_id=item_id)).select_related('order__address', 'order__customer').first()
+
+        emails = {item.order.address.email if item.order.address else None, item.order.customer.email if item.order.customer else None} if item else set()
+        if not email or email not in {e.lower() for e in emails if e}:
+            messages.error(request, "No order matches this id and email")
+            return redirect("store:order_tracker_page")
+
+        tracked = [i for i in request.session.get("tracked_items", []) if i != item.item_id]
+        request.session["tracked_items"] = (tracked + [item.item_id])[-TRACKED_ITEMS:]
+        return redirect("store:order_tracker_detail", item.item_id)
     
     return render(request, "store/order_tracker_page.html")
 
 # Tracking Order Page
 def order_tracker_detail(request, item_id):
-    try:
-        item = store_models.OrderItem.objects.filter(models.Q(item_id=item_id) | models.Q(tracking_id=item_id)).first()
-    except:
-        item = None
+    item = store_models.OrderItem.objects.filter(item_id=item_id).select_related('order').first()
+    allowed = item is not None and (
+        item_id in request.session.get("tracked_items", [])
+        or (request.user.is_authenticated and item.order.customer_id == request.user.id)
+    )
+    if not allowed:
         messages.error(request, "Order not found!")
         return redirect("store:order_tracker_page")
     